@@ -0,0 +1,133 @@
+"""
+Records the tts and mp_volume events along with the routing state changes.
+
+Writes a JSON line per record to a log that event_replay.py feeds back into
+the apps. Every log file starts with a snapshot of the recorded states so it
+can be replayed on its own. The log is gzip compressed if its name ends with
+`.gz` and is rotated to `<path>.1` once it grows over `max_bytes`.
+
+Records:
+
+  {"t":1700000000.123,"snapshot":{"binary_sensor.den_motion_5m":"on"}}
+  {"t":1700000000.456,"event":"tts","data":{"text":"Hello"}}
+  {"t":1700000000.789,"entity_id":"binary_sensor.den_motion_5m","state":"off"}
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+# pylint: disable=attribute-defined-outside-init
+# pylint: disable=import-error
+
+import gzip
+import json
+import os
+import time
+from threading import Lock
+
+from appdaemon.plugins.hass import hassapi as hass
+
+DOMAINS_DEFAULT = ('binary_sensor', 'media_player', 'switch')
+EVENTS_DEFAULT = ('tts', 'mp_volume')
+MAX_BYTES_DEFAULT = 10 * 1024 * 1024
+PATH_DEFAULT = 'recordings/events.jsonl.gz'
+
+
+def open_log(path, mode='r'):
+  """Open the log for reading or appending text, gzip compressed for `.gz`."""
+  if path.endswith('.gz'):
+    return gzip.open(path, f'{mode}t', encoding='utf-8')
+
+  # pylint: disable=consider-using-with
+  return open(path, mode, encoding='utf-8')
+
+
+def read_log(path):
+  """Yield the log records in the recorded order."""
+  with open_log(path) as log_file:
+    for line in log_file:
+      line = line.strip()
+      if line:
+        yield json.loads(line)
+
+
+class EventRecorder(hass.Hass):
+  """Event and state change recorder App Daemon class."""
+
+  def initialize(self):
+    """Open the log and initialize event and state listeners."""
+    self.domains = tuple(self.args.get('domains', DOMAINS_DEFAULT))
+    self.lock = Lock()
+    self.log_file = None
+    self.max_bytes = self.args.get('max_bytes', MAX_BYTES_DEFAULT)
+    self.path = os.path.join(self.config_dir,
+                             self.args.get('path', PATH_DEFAULT))
+    self.records = 0
+
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with self.lock:
+      self.open()
+
+    for event in self.args.get('events', EVENTS_DEFAULT):
+      self.listen_event(self.handle_event, event)
+    for domain in self.domains:
+      self.listen_state(self.handle_state, domain)
+
+  def terminate(self):
+    """Close the log."""
+    with self.lock:
+      if self.log_file is not None:
+        self.log_file.close()
+        self.log_file = None
+
+  # pylint: disable=unused-argument
+  def handle_event(self, event, data, kwargs):
+    """Record the event data without the AppDaemon metadata."""
+    self.write({
+        'event': event,
+        'data': {
+            name: value
+            for name, value in data.items()
+            if name != 'metadata'
+        },
+    })
+
+  # pylint: disable=too-many-arguments
+  def handle_state(self, entity, attribute, old, new, kwargs):
+    """Record the entity state change."""
+    self.write({'entity_id': entity, 'state': new})
+
+  def open(self):
+    """Open the log and record the current states snapshot."""
+    self.log_file = open_log(self.path, 'a')
+    states = self.get_state() or {}
+    self._write({
+        'snapshot': {
+            entity_id: entity.get('state')
+            for entity_id, entity in states.items()
+            if entity_id.split('.')[0] in self.domains
+        }
+    })
+
+  def rotate(self):
+    """Move the log to `<path>.1` and start a new one."""
+    self.log_file.close()
+    os.replace(self.path, f'{self.path}.1')
+    self.open()
+
+  def write(self, record):
+    """Append the record to the log, rotate the log if it's too big."""
+    with self.lock:
+      if self.log_file is None:
+        return
+
+      self._write(record)
+      if self.max_bytes and os.path.getsize(self.path) > self.max_bytes:
+        self.rotate()
+
+  def _write(self, record):
+    """Append the timestamped record to the log."""
+    record = {'t': round(time.time(), 3), **record}
+    self.log_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+    self.log_file.flush()
+    self.records += 1
@@ -0,0 +1,133 @@
+"""Tests for event_recorder.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import os
+import tempfile
+import unittest
+
+import event_recorder
+import hass_fake
+
+
+class TestEventRecorder(unittest.TestCase):
+  """Event recorder tests."""
+
+  DEN_MOTION = 'binary_sensor.den_motion_5m'
+
+  def setUp(self):
+    self.config_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.config_dir.cleanup)
+
+    self.hass = hass_fake.HassBackend(states={
+        self.DEN_MOTION: 'on',
+        'sensor.outdoor_temperature': '20',
+    })
+    self.addCleanup(self.hass.shutdown)
+
+  def _create_recorder(self, args=None):
+    recorder = hass_fake.create_app(event_recorder.EventRecorder, {
+        'path': 'recordings/events.jsonl',
+        **(args or {})
+    })
+    recorder.config_dir = self.config_dir.name
+    self.hass.install(recorder)
+    recorder.initialize()
+    self.addCleanup(recorder.terminate)
+
+    return recorder
+
+  def _read_log(self, recorder):
+    return [{
+        name: value for name, value in record.items() if name != 't'
+    } for record in event_recorder.read_log(recorder.path)]
+
+  def test_snapshot(self):
+    recorder = self._create_recorder()
+
+    self.assertListEqual(self._read_log(recorder),
+                         [{
+                             'snapshot': {
+                                 self.DEN_MOTION: 'on'
+                             }
+                         }])
+
+  def test_event(self):
+    recorder = self._create_recorder()
+
+    recorder.handle_event('tts', {
+        'metadata': {
+            'origin': 'LOCAL'
+        },
+        'text': 'Hello'
+    }, {})
+
+    self.assertDictEqual(self._read_log(recorder)[-1], {
+        'data': {
+            'text': 'Hello'
+        },
+        'event': 'tts'
+    })
+
+  def test_listens_events(self):
+    recorder = self._create_recorder({'events': ['tts']})
+
+    for event in ('tts', 'mp_volume'):
+      for future in self.hass.fire_event(event, text='Hello'):
+        future.result()
+
+    self.assertListEqual([
+        record.get('event') for record in self._read_log(recorder)
+    ], [None, 'tts'])
+
+  def test_state(self):
+    recorder = self._create_recorder()
+
+    self.hass.set_state(self.DEN_MOTION, 'off')
+    self.hass.set_state('sensor.outdoor_temperature', '21')
+
+    self.assertDictEqual(self._read_log(recorder)[-1], {
+        'entity_id': self.DEN_MOTION,
+        'state': 'off'
+    })
+    self.assertEqual(recorder.records, 2)
+
+  def test_timestamps(self):
+    recorder = self._create_recorder()
+    recorder.handle_event('tts', {'text': 'Hello'}, {})
+
+    records = list(event_recorder.read_log(recorder.path))
+    self.assertLessEqual(records[0]['t'], records[1]['t'])
+
+  def test_gzip(self):
+    recorder = self._create_recorder({'path': 'events.jsonl.gz'})
+    recorder.handle_event('tts', {'text': 'Hello'}, {})
+    recorder.terminate()
+
+    self.assertEqual(len(self._read_log(recorder)), 2)
+    with open(recorder.path, 'rb') as log_file:
+      self.assertEqual(log_file.read(2), b'\x1f\x8b')
+
+  def test_rotate(self):
+    recorder = self._create_recorder({'max_bytes': 200})
+
+    for idx in range(10):
+      recorder.handle_event('tts', {'text': f'Message {idx}'}, {})
+
+    self.assertTrue(os.path.exists(f'{recorder.path}.1'))
+    self.assertLessEqual(os.path.getsize(recorder.path), 200)
+    self.assertIn('snapshot', self._read_log(recorder)[0])
+
+  def test_terminate(self):
+    recorder = self._create_recorder()
+    recorder.terminate()
+
+    recorder.handle_event('tts', {'text': 'Hello'}, {})
+
+    self.assertEqual(recorder.records, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,257 @@
+"""
+Replays an event_recorder.py log into the tts and mp_volume apps.
+
+The apps run against the in-process fake Home Assistant on a virtual clock.
+The replayer advances the clock straight to the next record or the next
+scheduler pass, so the playback pacing doesn't take real time. With `--speed`
+the virtual time passes at the given multiple of the real time, 0 replays as
+fast as possible. The report covers the queue behavior and the routing cost.
+`--save` writes it to a baseline file and `--compare` prints the ratios to a
+saved baseline, e.g. to compare the same evening across app versions.
+
+Usage:
+
+  python event_replay.py events.jsonl.gz
+  python event_replay.py events.jsonl.gz --speed 10
+  python event_replay.py events.jsonl.gz --save baseline.json
+  python event_replay.py events.jsonl.gz --compare baseline.json
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+
+import event_recorder
+import hass_fake
+import hass_loadtest
+import mp_volume
+import tts
+import tts_metrics
+
+
+class VirtualClock:
+  """A clock advanced by the replayer, optionally in scaled real time."""
+
+  def __init__(self, now=0, speed=0):
+    """
+      Parameters:
+        now: The initial time in seconds.
+        speed: The virtual to real time ratio, 0 doesn't wait at all.
+      """
+    self.now = now
+    self.speed = speed
+
+  def __call__(self):
+    return self.now
+
+  def advance(self, now):
+    """Move the clock forward to `now`."""
+    if now <= self.now:
+      return
+
+    if self.speed:
+      time.sleep((now - self.now) / self.speed)
+    self.now = now
+
+
+class Replayer:
+  """Feeds the log records into the apps in the virtual time."""
+
+  def __init__(self, tts_args, speed=0):
+    """
+      Parameters:
+        tts_args: The tts app args.
+        speed: The virtual to real time ratio, 0 for as fast as possible.
+      """
+    self.clock = VirtualClock(speed=speed)
+    self.errors = 0
+    self.events = defaultdict(int)
+    self.hass = hass_fake.HassBackend(threads=1)
+    self.next_at = None
+    self.queue_depth_max = 0
+    # Scheduling pass (routing and dispatch) times in microseconds.
+    self.schedule_times = []
+    self.states = 0
+    self.version = None
+
+    self.mp_volume = hass_fake.create_app(mp_volume.AmazonEcho, {})
+    self.hass.install(self.mp_volume)
+    self.mp_volume.configure_metrics()
+
+    # The dispatch pool threads would run outside of the virtual time.
+    self.tts = hass_fake.create_app(tts.AmazonEcho,
+                                    dict(tts_args, dispatch_threads=None))
+    self.tts.clock = self.clock
+    self.hass.install(self.tts)
+    self.tts.configure()
+
+  def apply(self, record):
+    """Apply a state snapshot, a state change or an event record."""
+    if 'snapshot' in record:
+      for entity_id, state in record['snapshot'].items():
+        self.hass.set_state(entity_id, state)
+      return
+
+    if 'entity_id' in record:
+      self.hass.set_state(record['entity_id'], record['state'])
+      self.states += 1
+      return
+
+    event = record['event']
+    self.events[event] += 1
+    app = {
+        mp_volume.AmazonEcho.EVENT_NAME: self.mp_volume,
+        tts.AmazonEcho.EVENT_NAME: self.tts,
+    }.get(event)
+    if app is None:
+      return
+
+    try:
+      app.handle_event(event, record.get('data') or {}, {})
+    except Exception:  # pylint: disable=broad-except
+      self.errors += 1
+      self.hass.log(sys.exc_info())
+
+    self.queue_depth_max = max(self.queue_depth_max, len(self.tts.messages))
+
+  def run(self, records):
+    """
+      Replay the records and the scheduling passes until the queue drains.
+
+      Returns:
+        dict: The replay report.
+    """
+    started_at = time.perf_counter()
+    virtual_started_at = None
+
+    try:
+      for record in records:
+        if virtual_started_at is None:
+          virtual_started_at = self.clock.now = record['t']
+        self.run_until(record['t'])
+        self.apply(record)
+        # The worker wakes up on the queue changes and notifications.
+        if self.tts.messages.version != self.version:
+          self.schedule()
+      self.run_until(None)
+    finally:
+      self.hass.shutdown()
+
+    return self.get_report(
+        time.perf_counter() - started_at,
+        self.clock.now - (virtual_started_at or self.clock.now))
+
+  def run_until(self, until):
+    """Run the scheduling passes due by `until`, all of them for None."""
+    while self.next_at is not None and (until is None or self.next_at <= until):
+      self.clock.advance(self.next_at)
+      self.schedule()
+
+    if until is not None:
+      self.clock.advance(until)
+
+  def schedule(self):
+    """Run a worker scheduling pass at the current virtual time."""
+    self.version = self.tts.messages.version
+    started_at = time.perf_counter()
+    try:
+      self.next_at = self.tts.scheduler.schedule(self.clock())
+    except Exception:  # pylint: disable=broad-except
+      self.errors += 1
+      self.next_at = None
+      self.hass.log(sys.exc_info())
+    self.schedule_times.append((time.perf_counter() - started_at) * 1e6)
+
+  def get_report(self, elapsed, duration):
+    """Return the replay report."""
+    messages = self.tts.messages
+    scheduler = self.tts.scheduler
+
+    wait_times = tts_metrics.Histogram()
+    for histogram in messages.wait_times.values():
+      wait_times.merge(histogram)
+
+    report = {
+        'coalesced': scheduler.coalesced,
+        'dispatched': scheduler.dispatched,
+        'duration_s': round(duration, 3),
+        'elapsed_s': round(elapsed, 3),
+        'errors': self.errors,
+        'preempted': scheduler.preempted,
+        'queue_depth_max': self.queue_depth_max,
+        'schedule_p50_us': 0,
+        'schedule_p99_us': 0,
+        'schedule_passes': len(self.schedule_times),
+        'service_calls': len(self.hass.service_calls),
+        'states': self.states,
+        'wait_p50_s': wait_times.quantile(0.5),
+        'wait_p99_s': wait_times.quantile(0.99),
+    }
+    if self.schedule_times:
+      report['schedule_p50_us'] = round(
+          tts_metrics.get_percentile(self.schedule_times, 50), 1)
+      report['schedule_p99_us'] = round(
+          tts_metrics.get_percentile(self.schedule_times, 99), 1)
+    report.update(
+        {f'events_{event}': count for event, count in self.events.items()})
+    report.update({
+        f'queue_{outcome}': count
+        for outcome, count in messages.counters.items()
+    })
+    report.update({
+        f'rate_limited_{policy}': count
+        for policy, count in self.tts.rate_limiter.limited.items()
+    })
+    report.update(hass_loadtest.get_dispatch_outcomes(self.tts))
+    return report
+
+
+def print_report(report, baseline=None):
+  """Print the replay report and the ratios to the baseline values."""
+  for name, value in sorted(report.items()):
+    line = f'{name:<32} {value:>12}'
+    previous = (baseline or {}).get(name)
+    if previous:
+      line += f'  {value / previous:.2f}x'
+    print(line)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('log', help='an event_recorder.py log file')
+  parser.add_argument('--args', help='JSON tts app args overrides')
+  parser.add_argument('--compare', help='a baseline file to compare with')
+  parser.add_argument('--config',
+                      default=hass_loadtest.APPS_CONFIG,
+                      help='apps config')
+  parser.add_argument('--save', help='a baseline file to save the report to')
+  parser.add_argument('--speed',
+                      default=0,
+                      type=float,
+                      help='virtual to real time ratio, 0 for no waiting')
+  options = parser.parse_args()
+
+  baseline = None
+  if options.compare:
+    with open(options.compare, 'r', encoding='utf-8') as baseline_file:
+      baseline = json.load(baseline_file)
+
+  tts_args = hass_loadtest.load_args(
+      'tts',
+      json.loads(options.args) if options.args else None, options.config)
+  report = Replayer(tts_args, options.speed).run(
+      event_recorder.read_log(options.log))
+  print_report(report, baseline)
+
+  if options.save:
+    with open(options.save, 'w', encoding='utf-8') as baseline_file:
+      json.dump(report, baseline_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
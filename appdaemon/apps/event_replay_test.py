@@ -0,0 +1,131 @@
+"""Tests for event_replay.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import time
+import unittest
+
+import event_replay
+import hass_loadtest
+
+
+class TestVirtualClock(unittest.TestCase):
+  """Virtual clock tests."""
+
+  def test_advance(self):
+    clock = event_replay.VirtualClock(10)
+
+    clock.advance(3600)
+    clock.advance(5)
+
+    self.assertEqual(clock(), 3600)
+
+  def test_advance_speed(self):
+    clock = event_replay.VirtualClock(0, speed=100)
+
+    started_at = time.perf_counter()
+    clock.advance(2)
+
+    self.assertGreaterEqual(time.perf_counter() - started_at, 0.02)
+
+
+class TestReplayer(unittest.TestCase):
+  """Replayer tests."""
+
+  STARTED_AT = 1700000000
+
+  def setUp(self):
+    self.replayer = event_replay.Replayer(
+        hass_loadtest.load_args('tts', {
+            'coalesce': None,
+            'rate_limit': None
+        }))
+
+  def _tts(self, offset, text, area='garage', priority=None):
+    data = {'areas_on': [area], 'text': text}
+    if priority is not None:
+      data['priority'] = priority
+    return {'t': self.STARTED_AT + offset, 'event': 'tts', 'data': data}
+
+  def test_virtual_time(self):
+    records = [{'t': self.STARTED_AT, 'snapshot': {}}]
+    records.extend(
+        self._tts(0, f'The garage door is open for {idx} minutes.')
+        for idx in range(5))
+
+    started_at = time.perf_counter()
+    report = self.replayer.run(records)
+
+    self.assertLess(time.perf_counter() - started_at, report['duration_s'])
+    self.assertGreater(report['duration_s'], 10)
+    self.assertEqual(report['dispatched'], 5)
+    self.assertEqual(report['events_tts'], 5)
+    self.assertEqual(report['queue_enqueued'], 5)
+    self.assertEqual(report['service_calls'], 5)
+    # The first message is dispatched as soon as it's queued.
+    self.assertEqual(report['queue_depth_max'], 4)
+
+  def test_state_changes(self):
+    report = self.replayer.run([
+        {
+            't': self.STARTED_AT,
+            'snapshot': {
+                'binary_sensor.den_lights': 'on'
+            }
+        },
+        {
+            't': self.STARTED_AT + 1,
+            'entity_id': 'binary_sensor.den_motion_5m',
+            'state': 'on'
+        },
+        self._tts(2, 'Hello', 'garage'),
+    ])
+
+    self.assertEqual(report['states'], 1)
+    _, kwargs = self.replayer.hass.service_calls[-1]
+    self.assertIn('media_player.den_echo', kwargs['target'])
+
+  def test_mp_volume(self):
+    report = self.replayer.run([
+        {
+            't': self.STARTED_AT,
+            'event': 'mp_volume',
+            'data': {
+                'areas': ['den'],
+                'volume_level': 30
+            }
+        },
+        {
+            't': self.STARTED_AT + 1,
+            'event': 'mp_volume',
+            'data': {
+                'volume_level': 'loud'
+            }
+        },
+    ])
+
+    self.assertEqual(report['events_mp_volume'], 2)
+    self.assertEqual(report['errors'], 1)
+    self.assertListEqual(self.replayer.hass.service_calls,
+                         [('media_player/volume_set', {
+                             'entity_id': 'media_player.den_echo',
+                             'volume_level': 0.3
+                         })])
+
+  def test_ttl(self):
+    records = [
+        self._tts(0, 'The garage door is open for 15 minutes.'),
+        self._tts(0, 'Still open.'),
+    ]
+    records[1]['data']['ttl'] = 1
+
+    report = self.replayer.run(records)
+
+    self.assertEqual(report['dispatched'], 1)
+    self.assertEqual(report['queue_expired'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
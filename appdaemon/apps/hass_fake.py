@@ -0,0 +1,347 @@
+"""
+In-process fake of the AppDaemon API for the app tests and benchmarks.
+
+The state backend keeps entity states in memory and calls the state callbacks
+on state changes. The async backend replaces the AppDaemon async API of an app
+instance with mocks bound to an event loop. The sync adapter exposes coroutine
+methods of an async app as regular methods so that the sync app tests can run
+against it. The hass backend adds an event bus and a service registry with
+injectable service latency and failure rate to the state backend for the
+end-to-end load tests.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import asyncio
+import inspect
+import itertools
+import random
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from threading import Lock
+from unittest import mock
+
+
+def create_app(app_class, args):
+  """Return an app instance with mocked AppDaemon internals."""
+  return app_class(mock.Mock(), mock.Mock(), mock.MagicMock(), args,
+                   mock.Mock(), mock.Mock(), mock.Mock())
+
+
+class StateBackend:
+  """Fake AppDaemon state and service API backed by in-memory states."""
+
+  def __init__(self, states=None):
+    # An entity ID or domain to {handle: callback} mapping.
+    self.callbacks = defaultdict(dict)
+    # An entity ID to state object mapping, e.g. {'state': 'on'}.
+    self.entities = {}
+    self.handles = itertools.count(1)
+    self.service_calls = []
+
+    for entity_id, state in (states or {}).items():
+      self.entities[entity_id] = {'state': state}
+
+  def call_service(self, service, **kwargs):
+    """Record the service call."""
+    self.service_calls.append((service, kwargs))
+
+  def cancel_listen_state(self, handle):
+    """Cancel a state callback."""
+    for callbacks in self.callbacks.values():
+      if callbacks.pop(handle, None) is not None:
+        return True
+
+    return False
+
+  # pylint: disable=unused-argument
+  def get_state(self, entity_id=None, attribute=None, copy=True, **kwargs):
+    """
+      Return the entity state or all state objects if `entity_id` is None.
+
+      Like AppDaemon, the internal state objects are returned if `copy` is
+      False.
+      """
+    if entity_id is None:
+      return deepcopy(self.entities) if copy else self.entities
+
+    try:
+      entity = self.entities[entity_id]
+    except KeyError:
+      return None
+
+    if attribute == 'all':
+      return deepcopy(entity) if copy else entity
+
+    return entity.get('state')
+
+  def install(self, app):
+    """Replace the app state and service API with the fake ones."""
+    app.call_service = self.call_service
+    app.cancel_listen_state = self.cancel_listen_state
+    app.get_state = self.get_state
+    app.listen_state = self.listen_state
+
+  def listen_state(self, callback, entity_id=None, **kwargs):
+    """
+      Register a state callback for an entity ID, a domain or all entities.
+
+      Returns:
+        str: The callback handle.
+      """
+    handle = f'handle_{next(self.handles)}'
+    self.callbacks[entity_id][handle] = (callback, kwargs)
+    return handle
+
+  # pylint: disable=unused-argument
+  def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    """Set the entity state and call the state callbacks on change."""
+    entity = self.entities.setdefault(entity_id, {})
+    old = entity.get('state')
+    if state is None:
+      del self.entities[entity_id]
+    else:
+      entity['state'] = state
+      if attributes is not None:
+        entity['attributes'] = attributes
+
+    if old == state:
+      return
+
+    domain = entity_id.split('.')[0]
+    for key in (entity_id, domain, None):
+      for callback, kwargs in list(self.callbacks.get(key, {}).values()):
+        callback(entity_id, 'state', old, state, kwargs)
+
+
+class ServiceError(Exception):
+  """An injected service call failure."""
+
+
+class HassBackend(StateBackend):
+  """
+  Fake Home Assistant: a state store, an event bus and a service registry.
+
+  Like AppDaemon, the event callbacks run on a pool of worker threads. The
+  service calls sleep for the injected latency and fail at the injected rate
+  before calling the registered service handler.
+  """
+
+  LOG_SIZE = 1000
+
+  # pylint: disable=too-many-arguments
+  def __init__(self,
+               states=None,
+               latency=0,
+               jitter=0,
+               failure_rate=0,
+               seed=None,
+               threads=10):
+    """
+      Parameters:
+        states: An entity ID to initial state mapping.
+        latency: The service call latency in seconds.
+        jitter: The maximum random addition to the latency in seconds.
+        failure_rate: The probability of a service call failure.
+        seed: The random seed for the latency and failure injection.
+        threads: The number of event callback worker threads.
+      """
+    super().__init__(states)
+    self.callback_errors = 0
+    # An event name to {handle: callback} mapping, None for all events.
+    self.event_callbacks = defaultdict(dict)
+    self.executor = ThreadPoolExecutor(threads)
+    self.failure_rate = failure_rate
+    self.failures = 0
+    self.jitter = jitter
+    self.latency = latency
+    self.lock = Lock()
+    self.logs = deque(maxlen=self.LOG_SIZE)
+    self.pending = 0
+    self.random = random.Random(seed)
+    self.services = {}
+    # (callback, interval, kwargs) of the registered timers.
+    self.timers = []
+
+  def call_service(self, service, **kwargs):
+    """
+      Call the registered service handler after the injected latency.
+
+      The injected failures raise ServiceError.
+      """
+    with self.lock:
+      self.service_calls.append((service, kwargs))
+      failed = self.random.random() < self.failure_rate
+      latency = self.latency + self.random.uniform(0, self.jitter)
+
+    if latency:
+      time.sleep(latency)
+
+    if failed:
+      with self.lock:
+        self.failures += 1
+      raise ServiceError(f'Service call failed: {service}.')
+
+    handler = self.services.get(service)
+    return handler(**kwargs) if handler else None
+
+  def cancel_listen_event(self, handle):
+    """Cancel an event callback."""
+    for callbacks in self.event_callbacks.values():
+      if callbacks.pop(handle, None) is not None:
+        return True
+
+    return False
+
+  def fire_event(self, event, **kwargs):
+    """
+      Call the event callbacks on the worker threads.
+
+      Returns:
+        list: The callback futures.
+      """
+    futures = []
+    for key in (event, None):
+      for callback, kwargs_callback in list(
+          self.event_callbacks.get(key, {}).values()):
+        with self.lock:
+          self.pending += 1
+        futures.append(
+            self.executor.submit(self._call_event_callback, callback, event,
+                                 kwargs, kwargs_callback))
+
+    return futures
+
+  def _call_event_callback(self, callback, event, data, kwargs):
+    """Call the event callback and count the errors like AppDaemon logs them."""
+    try:
+      callback(event, data, kwargs)
+    except Exception:  # pylint: disable=broad-except
+      with self.lock:
+        self.callback_errors += 1
+    finally:
+      with self.lock:
+        self.pending -= 1
+
+  def install(self, app):
+    """Replace the app state, event, service, timer and log API with fakes."""
+    super().install(app)
+    app.cancel_listen_event = self.cancel_listen_event
+    app.fire_event = self.fire_event
+    app.listen_event = self.listen_event
+    app.log = self.log
+    app.run_every = self.run_every
+    app.set_state = self.set_state
+
+  def listen_event(self, callback, event=None, **kwargs):
+    """
+      Register an event callback for an event name or all events.
+
+      Returns:
+        str: The callback handle.
+      """
+    handle = f'handle_{next(self.handles)}'
+    self.event_callbacks[event][handle] = (callback, kwargs)
+    return handle
+
+  # pylint: disable=unused-argument
+  def log(self, msg, *args, **kwargs):
+    """Keep the recent log messages."""
+    self.logs.append(msg)
+
+  def register_service(self, service, handler):
+    """Register a service handler called with the service call kwargs."""
+    self.services[service] = handler
+
+  # pylint: disable=unused-argument
+  def run_every(self, callback, start, interval, **kwargs):
+    """
+      Register a timer, the timers are run by run_timers().
+
+      Returns:
+        str: The timer handle.
+      """
+    self.timers.append((callback, interval, kwargs))
+    return f'handle_{next(self.handles)}'
+
+  def run_timers(self):
+    """Call all registered timer callbacks once."""
+    for callback, _, kwargs in list(self.timers):
+      callback(kwargs)
+
+  def shutdown(self):
+    """Wait for the pending event callbacks and stop the worker threads."""
+    self.executor.shutdown(wait=True)
+
+
+class AsyncBackend:
+  """Fake AppDaemon async API running on an event loop."""
+
+  def __init__(self, loop=None):
+    self.handles = itertools.count(1)
+    self.loop = loop or asyncio.new_event_loop()
+
+  def close(self):
+    """Cancel the pending tasks and close the event loop."""
+    tasks = asyncio.all_tasks(self.loop)
+    if tasks:
+      for task in tasks:
+        task.cancel()
+      self.run(asyncio.gather(*tasks, return_exceptions=True))
+    self.loop.close()
+
+  def install(self, app):
+    """
+      Replace the app async API with mocks.
+
+      Like AppDaemon async API, the methods called from outside of a coroutine
+      (`create_task`, `listen_state`) return futures.
+      """
+    app.call_service = mock.AsyncMock()
+    app.cancel_listen_state = mock.AsyncMock(return_value=True)
+    app.create_task = mock.Mock(side_effect=lambda coro, *args, **kwargs: self.
+                                resolve(self.loop.create_task(coro)))
+    app.get_state = mock.AsyncMock(return_value={})
+    app.listen_event = mock.AsyncMock()
+    app.listen_state = mock.Mock(side_effect=lambda *args, **kwargs: self.
+                                 resolve(f'handle_{next(self.handles)}'))
+    app.run_every = mock.AsyncMock()
+    app.set_state = mock.AsyncMock()
+
+  def resolve(self, value):
+    """Return a future resolved with `value`."""
+    future = self.loop.create_future()
+    future.set_result(value)
+    return future
+
+  def run(self, awaitable):
+    """Run the awaitable to completion on the event loop."""
+    return self.loop.run_until_complete(awaitable)
+
+  def run_pending(self, seconds=0):
+    """Let the scheduled tasks run for `seconds`."""
+    self.run(asyncio.sleep(seconds))
+
+
+class SyncAdapter:
+  """A proxy running async app methods to completion on each call."""
+
+  def __init__(self, app, backend):
+    object.__setattr__(self, 'app', app)
+    object.__setattr__(self, 'backend', backend)
+
+  def __getattr__(self, name):
+    value = getattr(self.app, name)
+    if not (inspect.ismethod(value) and inspect.iscoroutinefunction(value)):
+      return value
+
+    def run(*args, **kwargs):
+      return self.backend.run(value(*args, **kwargs))
+
+    return run
+
+  def __setattr__(self, name, value):
+    setattr(self.app, name, value)
@@ -0,0 +1,131 @@
+"""Tests for hass_fake.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import time
+import unittest
+from unittest import mock
+
+import hass_fake
+
+
+class TestHassBackend(unittest.TestCase):
+  """Fake Home Assistant backend tests."""
+
+  def setUp(self):
+    self.hass = hass_fake.HassBackend(seed=42, threads=2)
+    self.addCleanup(self.hass.shutdown)
+
+  def test_fire_event(self):
+    callback = mock.Mock()
+    self.hass.listen_event(callback, 'tts', key='value')
+
+    for future in self.hass.fire_event('tts', text='Hello'):
+      future.result()
+    self.hass.fire_event('other')
+
+    callback.assert_called_once_with('tts', {'text': 'Hello'},
+                                     {'key': 'value'})
+    self.assertEqual(self.hass.pending, 0)
+
+  def test_fire_event_all_events(self):
+    callback = mock.Mock()
+    self.hass.listen_event(callback)
+
+    for event in ('tts', 'mp_volume'):
+      for future in self.hass.fire_event(event):
+        future.result()
+
+    self.assertEqual(callback.call_count, 2)
+
+  def test_cancel_listen_event(self):
+    callback = mock.Mock()
+    handle = self.hass.listen_event(callback, 'tts')
+
+    self.assertTrue(self.hass.cancel_listen_event(handle))
+    self.assertFalse(self.hass.cancel_listen_event(handle))
+    self.assertListEqual(self.hass.fire_event('tts'), [])
+
+  def test_callback_errors(self):
+    self.hass.listen_event(mock.Mock(side_effect=ValueError), 'tts')
+
+    for future in self.hass.fire_event('tts'):
+      future.result()
+
+    self.assertEqual(self.hass.callback_errors, 1)
+    self.assertEqual(self.hass.pending, 0)
+
+  def test_call_service(self):
+    handler = mock.Mock(return_value='result')
+    self.hass.register_service('media_player/volume_set', handler)
+
+    self.assertEqual(
+        self.hass.call_service('media_player/volume_set', volume_level=0.5),
+        'result')
+    self.assertIsNone(self.hass.call_service('notify/alexa_media'))
+
+    handler.assert_called_once_with(volume_level=0.5)
+    self.assertListEqual(self.hass.service_calls,
+                         [('media_player/volume_set', {
+                             'volume_level': 0.5
+                         }), ('notify/alexa_media', {})])
+
+  def test_call_service_latency(self):
+    self.hass.latency = 0.05
+
+    started_at = time.perf_counter()
+    self.hass.call_service('notify/alexa_media')
+
+    self.assertGreaterEqual(time.perf_counter() - started_at, 0.05)
+
+  def test_call_service_failure_rate(self):
+    self.hass.failure_rate = 0.5
+    handler = mock.Mock()
+    self.hass.register_service('notify/alexa_media', handler)
+
+    for _ in range(100):
+      try:
+        self.hass.call_service('notify/alexa_media')
+      except hass_fake.ServiceError:
+        pass
+
+    self.assertGreater(self.hass.failures, 30)
+    self.assertLess(self.hass.failures, 70)
+    self.assertEqual(handler.call_count, 100 - self.hass.failures)
+
+  def test_run_timers(self):
+    callback = mock.Mock()
+    self.hass.run_every(callback, 'now', 60, key='value')
+
+    self.hass.run_timers()
+
+    callback.assert_called_once_with({'key': 'value'})
+
+  def test_set_state_attributes(self):
+    self.hass.set_state('sensor.tts_events', state=1, attributes={'max': 2})
+
+    self.assertDictEqual(
+        self.hass.get_state('sensor.tts_events', attribute='all'), {
+            'attributes': {
+                'max': 2
+            },
+            'state': 1
+        })
+
+  def test_install(self):
+    app = mock.Mock()
+    self.hass.install(app)
+
+    app.log('Message')
+    app.listen_event(app.handle_event, 'tts')
+    for future in app.fire_event('tts'):
+      future.result()
+
+    self.assertListEqual(list(self.hass.logs), ['Message'])
+    app.handle_event.assert_called_once_with('tts', {}, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,411 @@
+"""
+End-to-end load test for the tts and mp_volume apps.
+
+Runs an app against the in-process fake Home Assistant (hass_fake.HassBackend)
+and fires events through the whole path: listen_event, handle_event, the
+message queue, the worker and call_service. The fake Echo devices report the
+playback through their media player states so the tts completion pacing
+releases the targets as soon as the (scaled down) playback ends. Reports the
+throughput, the queue depth over time and the end-to-end latency percentiles.
+
+Usage:
+
+  python hass_loadtest.py tts --events 5000 --rate 500 --latency 0.05
+  python hass_loadtest.py tts --args '{"queue_size": 1000}'
+  python hass_loadtest.py mp_volume --events 5000 --failure-rate 0.01
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import argparse
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from threading import Event, Lock, Thread, Timer
+
+import yaml
+
+import hass_fake
+import mp_volume
+import tts
+import tts_metrics
+import tts_queue
+
+APPS_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'apps.yaml')
+SAMPLE_INTERVAL_SECONDS = 0.05
+TIMELINE_ROWS = 10
+# The tts app args the load test depends on: the fake devices release their
+# targets through the completion pacing and the report includes the metrics.
+TTS_ARGS = {
+    'completion_pacing': {},
+    'metrics': {},
+}
+
+
+def load_args(app_name, overrides=None, path=APPS_CONFIG):
+  """Return the app args from the apps config updated with `overrides`."""
+  with open(path, 'r', encoding='utf-8') as config_file:
+    args = yaml.safe_load(config_file)[app_name]
+
+  args = {
+      name: value
+      for name, value in args.items()
+      if name not in ('class', 'module')
+  }
+  args.update(overrides or {})
+  return args
+
+
+class EchoDevices:
+  """Fake Echo devices playing the notify/alexa_media messages."""
+
+  STATE_IDLE = 'idle'
+
+  def __init__(self, hass, get_duration, playback_scale, on_played):
+    """
+      Parameters:
+        hass: The fake Home Assistant backend.
+        get_duration: A function returning the text playback duration.
+        playback_scale: The playback duration multiplier.
+        on_played: A callback called with the played text.
+      """
+    # A target to its last playback number mapping.
+    self.generations = defaultdict(int)
+    self.get_duration = get_duration
+    self.hass = hass
+    self.lock = Lock()
+    self.on_played = on_played
+    self.playback_scale = playback_scale
+
+  # pylint: disable=unused-argument
+  def notify(self, message=None, target=None, **kwargs):
+    """Start the message playback on the targets."""
+    self.on_played(message)
+
+    duration = self.get_duration(message) * self.playback_scale
+    for entity_id in target or ():
+      with self.lock:
+        self.generations[entity_id] += 1
+        generation = self.generations[entity_id]
+
+      if self.hass.get_state(entity_id) == tts.AmazonEcho.STATE_PLAYING:
+        self.hass.set_state(entity_id, self.STATE_IDLE)
+      self.hass.set_state(entity_id, tts.AmazonEcho.STATE_PLAYING)
+
+      timer = Timer(duration, self.stop, (entity_id, generation))
+      timer.daemon = True
+      timer.start()
+
+  def stop(self, entity_id, generation):
+    """Finish the playback unless the target started a newer one."""
+    with self.lock:
+      if self.generations[entity_id] != generation:
+        return
+
+    self.hass.set_state(entity_id, self.STATE_IDLE)
+
+
+class LoadTest:
+  """Fires events at an app and collects the end-to-end measurements."""
+
+  def __init__(self, hass, get_queue_depth, is_idle):
+    """
+      Parameters:
+        hass: The fake Home Assistant backend the app is installed to.
+        get_queue_depth: A function returning the app queue depth.
+        is_idle: A function checking whether the app has nothing to do.
+      """
+    # A message key to its completion time mapping.
+    self.completed = {}
+    # A message key to its firing time mapping.
+    self.fired = {}
+    self.get_queue_depth = get_queue_depth
+    self.hass = hass
+    self.is_idle = is_idle
+    self.lock = Lock()
+    # (time, pending event callbacks, queued messages) samples.
+    self.samples = []
+    self.started_at = None
+
+  def complete(self, key):
+    """Record the message completion."""
+    completed_at = time.perf_counter()
+    with self.lock:
+      self.completed.setdefault(key, completed_at)
+
+  def sample(self, stopped):
+    """Sample the queue depths until stopped."""
+    while not stopped.wait(SAMPLE_INTERVAL_SECONDS):
+      self.samples.append((time.perf_counter() - self.started_at,
+                           self.hass.pending, self.get_queue_depth()))
+
+  def run(self, events, rate=0, timeout=60):
+    """
+      Fire the events and wait until the app has processed them.
+
+      Parameters:
+        events: A list of (key, event, data) tuples, the key identifies the
+          message in the completion records.
+        rate: The events per second, 0 for as fast as possible.
+        timeout: The maximum time to wait for the app to become idle.
+
+      Returns:
+        dict: The load test report.
+      """
+    stopped = Event()
+    self.started_at = time.perf_counter()
+    sampler = Thread(target=self.sample, args=(stopped,))
+    sampler.daemon = True
+    sampler.start()
+
+    for idx, (key, event, data) in enumerate(events):
+      if rate:
+        delay = self.started_at + idx / rate - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+      self.fired[key] = time.perf_counter()
+      self.hass.fire_event(event, **data)
+    fired_in = time.perf_counter() - self.started_at
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+      if not self.hass.pending and self.is_idle():
+        break
+      time.sleep(SAMPLE_INTERVAL_SECONDS)
+    elapsed = time.perf_counter() - self.started_at
+
+    stopped.set()
+    sampler.join()
+
+    with self.lock:
+      latencies = [(completed_at - self.fired[key]) * 1000
+                   for key, completed_at in self.completed.items()
+                   if key in self.fired]
+
+    return {
+        'callback_errors': self.hass.callback_errors,
+        'delivered': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'events': len(events),
+        'fired_in_s': round(fired_in, 3),
+        'latency_ms': {
+            name: round(tts_metrics.get_percentile(latencies, percentile), 1)
+            if latencies else 0
+            for name, percentile in (('p50', 50), ('p90', 90), ('p99', 99),
+                                     ('max', 100))
+        },
+        'queue_depth': self.samples,
+        'service_calls': len(self.hass.service_calls),
+        'service_failures': self.hass.failures,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0,
+    }
+
+
+def create_hass(options):
+  """Return the fake Home Assistant backend for the load test options."""
+  return hass_fake.HassBackend(latency=options.latency,
+                               jitter=options.jitter,
+                               failure_rate=options.failure_rate,
+                               seed=options.seed,
+                               threads=options.threads)
+
+
+def run_tts(options):
+  """
+    Drive the tts app with `options.events` messages for random areas.
+
+    Returns:
+      dict: The load test report with the queue, rate limiter and retry
+      outcomes.
+  """
+  rnd = random.Random(options.seed)
+  overrides = dict(TTS_ARGS)
+  if options.args:
+    overrides.update(json.loads(options.args))
+  args = load_args('tts', overrides, options.config)
+
+  hass = create_hass(options)
+  app = hass_fake.create_app(tts.AmazonEcho, args)
+  hass.install(app)
+
+  load_test = LoadTest(hass, lambda: len(app.messages),
+                       lambda: is_tts_idle(app))
+  separator = tts_queue.MessageQueue.COALESCE_SEPARATOR
+
+  def on_played(text):
+    for key in text.split(separator):
+      load_test.complete(key)
+
+  devices = EchoDevices(hass, app.calculate_duration, options.playback_scale,
+                        on_played)
+  hass.register_service('notify/alexa_media', devices.notify)
+  app.initialize()
+
+  areas = list(args['rules'])
+  events = []
+  for idx in range(options.events):
+    text = f'Load test message {idx}.'
+    events.append((text, tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [rnd.choice(areas)],
+        'text': text
+    }))
+
+  try:
+    report = load_test.run(events, options.rate, options.timeout)
+  finally:
+    hass.shutdown()
+
+  if app.metrics:
+    hass.run_timers()
+    report['metrics'] = {
+        entity_id: hass.get_state(entity_id)
+        for entity_id, _ in sorted(app.metrics.get_sensors().items())
+        if entity_id.endswith('_seconds')
+    }
+
+  report['outcomes'] = dict(app.messages.counters)
+  report['outcomes'].update({
+      f'rate_limited_{policy}': count
+      for policy, count in app.rate_limiter.limited.items()
+  })
+  report['outcomes'].update(get_dispatch_outcomes(app))
+  return report
+
+
+def get_dispatch_outcomes(app):
+  """Return the tts app circuit breaker and retry queue outcomes."""
+  outcomes = {}
+  if app.breaker is not None:
+    outcomes['breaker_rejected'] = app.breaker.rejected
+    outcomes['breaker_trips'] = app.breaker.trips
+  if app.scheduler.retries is not None:
+    outcomes.update({
+        f'retry_{outcome}': count
+        for outcome, count in app.scheduler.retries.counters.items()
+    })
+  return outcomes
+
+
+def is_tts_idle(app):
+  """Return True if the tts app has no pending messages or busy targets."""
+  depths = app.scheduler.get_depths(0)
+  if len(app.messages) or depths['dispatch'] or depths['retry']:
+    return False
+
+  now = time.monotonic()
+  return all(busy_until <= now
+             for busy_until, _ in list(app.scheduler.busy.values()))
+
+
+def run_mp_volume(options):
+  """
+    Drive the mp_volume app with `options.events` volume changes.
+
+    Returns:
+      dict: The load test report.
+  """
+  rnd = random.Random(options.seed)
+  args = load_args('mp_volume', None, options.config)
+
+  hass = create_hass(options)
+  app = hass_fake.create_app(mp_volume.AmazonEcho, args)
+  hass.install(app)
+
+  load_test = LoadTest(hass, lambda: 0, lambda: True)
+
+  # pylint: disable=unused-argument
+  def volume_set(entity_id=None, **kwargs):
+    load_test.complete(entity_id)
+
+  hass.register_service('media_player/volume_set', volume_set)
+  app.initialize()
+
+  events = []
+  for idx in range(options.events):
+    area = f'load_test_{idx}'
+    events.append((mp_volume.AmazonEcho.get_target(area),
+                   mp_volume.AmazonEcho.EVENT_NAME, {
+                       'areas': [area],
+                       'volume_level': rnd.randint(0, 100)
+                   }))
+
+  try:
+    return load_test.run(events, options.rate, options.timeout)
+  finally:
+    hass.shutdown()
+
+
+def get_timeline(samples, rows=TIMELINE_ROWS):
+  """Return up to `rows` (time, max callbacks, max messages) samples."""
+  if not samples:
+    return []
+
+  size = -(-len(samples) // rows)
+  return [(chunk[0][0], max(s[1] for s in chunk), max(s[2] for s in chunk))
+          for chunk in (samples[idx:idx + size]
+                        for idx in range(0, len(samples), size))]
+
+
+def print_report(report):
+  """Print the load test report."""
+  events = report['events']
+  delivered = report['delivered']
+  latency = report['latency_ms']
+
+  print(f'events     {events} fired in {report["fired_in_s"]:.2f}s')
+  print(f'delivered  {delivered} ({delivered / events:.1%}) in '
+        f'{report["elapsed_s"]:.2f}s, {report["throughput"]:.1f} msg/s')
+  print(f'latency    p50 {latency["p50"]:.1f}ms  p90 {latency["p90"]:.1f}ms  '
+        f'p99 {latency["p99"]:.1f}ms  max {latency["max"]:.1f}ms')
+  print(f'service    {report["service_calls"]} calls, '
+        f'{report["service_failures"]} failures, '
+        f'{report["callback_errors"]} callback errors')
+  if report.get('outcomes'):
+    print('outcomes   ' + ', '.join(
+        f'{outcome} {count}'
+        for outcome, count in sorted(report['outcomes'].items())))
+
+  for entity_id, median in report.get('metrics', {}).items():
+    print(f'{entity_id:<32} p50 {median}s')
+
+  print(f'{"t, s":>10} {"callbacks":>10} {"messages":>10}')
+  for started_at, callbacks, messages in get_timeline(report['queue_depth']):
+    print(f'{started_at:>10.2f} {callbacks:>10} {messages:>10}')
+
+
+def parse_args(argv=None):
+  """Return the load test options parsed from the command line arguments."""
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('app', choices=('tts', 'mp_volume'))
+  parser.add_argument('--args', help='JSON app args overrides')
+  parser.add_argument('--config', default=APPS_CONFIG, help='apps config')
+  parser.add_argument('--events', default=1000, type=int)
+  parser.add_argument('--failure-rate', default=0, type=float)
+  parser.add_argument('--jitter', default=0, type=float, help='seconds')
+  parser.add_argument('--latency', default=0.05, type=float, help='seconds')
+  parser.add_argument('--playback-scale',
+                      default=0.01,
+                      type=float,
+                      help='the tts playback duration multiplier')
+  parser.add_argument('--rate',
+                      default=0,
+                      type=float,
+                      help='events per second, 0 for as fast as possible')
+  parser.add_argument('--seed', default=42, type=int)
+  parser.add_argument('--threads', default=10, type=int)
+  parser.add_argument('--timeout', default=60, type=float, help='seconds')
+  return parser.parse_args(argv)
+
+
+def main():
+  options = parse_args()
+  run = run_tts if options.app == 'tts' else run_mp_volume
+  print_report(run(options))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,63 @@
+"""Tests for hass_loadtest.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+
+import hass_loadtest
+
+
+class TestLoadTest(unittest.TestCase):
+  """End-to-end load test tests."""
+
+  def test_tts(self):
+    report = hass_loadtest.run_tts(
+        hass_loadtest.parse_args([
+            'tts', '--events', '20', '--latency', '0', '--timeout', '10',
+            '--args', '{"queue_size": 100}'
+        ]))
+
+    self.assertEqual(report['events'], 20)
+    self.assertEqual(report['delivered'], 20)
+    self.assertEqual(report['outcomes']['enqueued'], 20)
+    self.assertEqual(report['callback_errors'], 0)
+    self.assertGreater(report['throughput'], 0)
+    self.assertIn('sensor.tts_wait_seconds', report['metrics'])
+
+  def test_tts_rate_limited(self):
+    report = hass_loadtest.run_tts(
+        hass_loadtest.parse_args([
+            'tts', '--events', '20', '--latency', '0', '--timeout', '10',
+            '--args',
+            '{"rate_limit": [{"policy": "global_budget", "limit": 10}]}'
+        ]))
+
+    self.assertGreater(report['outcomes']['rate_limited_global_budget'], 0)
+    self.assertLess(report['delivered'], 20)
+
+  def test_mp_volume(self):
+    report = hass_loadtest.run_mp_volume(
+        hass_loadtest.parse_args([
+            'mp_volume', '--events', '50', '--latency', '0.001',
+            '--failure-rate', '0.1', '--timeout', '10'
+        ]))
+
+    self.assertEqual(report['service_calls'], 50)
+    self.assertEqual(report['delivered'] + report['service_failures'], 50)
+    self.assertEqual(report['callback_errors'], report['service_failures'])
+    self.assertLessEqual(report['latency_ms']['p50'],
+                         report['latency_ms']['max'])
+
+  def test_get_timeline(self):
+    samples = [(idx / 10, idx, 20 - idx) for idx in range(20)]
+
+    self.assertListEqual(hass_loadtest.get_timeline(samples, 4),
+                         [(0, 4, 20), (0.5, 9, 15), (1, 14, 10),
+                          (1.5, 19, 5)])
+    self.assertListEqual(hass_loadtest.get_timeline([]), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
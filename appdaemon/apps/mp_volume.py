@@ -2,8 +2,14 @@
 
 __author__ = 'Ark (ark@cho.red)'
 
+# pylint: disable=attribute-defined-outside-init
+
+import time
+
 from appdaemon.plugins.hass import hassapi as hass
 
+import tts_metrics
+
 
 class AmazonEcho(hass.Hass):
   """Amazon Echo App Daemon class."""
@@ -21,12 +27,32 @@ class AmazonEcho(hass.Hass):
       'stairway',
   )
   EVENT_NAME = 'mp_volume'
+  METRICS_BUCKETS = {
+      'service_seconds': tts_metrics.Metrics.LATENCY_BUCKETS,
+  }
+  METRICS_PREFIX = 'mp_volume'
 
   def initialize(self):
     """Initialize event listener."""
 
+    self.configure_metrics()
+    if self.metrics:
+      self.run_every(self.publish_metrics, 'now', self.metrics.interval)
+
     self.listen_event(self.handle_event, self.EVENT_NAME)
 
+  def configure_metrics(self):
+    """Create the metrics if the `metrics` config value is set."""
+    self.metrics = tts_metrics.Metrics.from_config(self.METRICS_PREFIX,
+                                                   self.args.get('metrics'),
+                                                   self.config_dir,
+                                                   self.METRICS_BUCKETS)
+
+  # pylint: disable=unused-argument
+  def publish_metrics(self, kwargs):
+    """Publish the metrics as sensors and to the Prometheus textfile."""
+    self.metrics.publish(self.set_state)
+
   @staticmethod
   def get_target(area):
     """Return media player target ID for an area."""
@@ -49,6 +75,34 @@ class AmazonEcho(hass.Hass):
         string: a comma separated list of the targets for HASS API call.
       """
 
+    entity_id, volume_level = self.get_volume_data(volume_level, areas)
+
+    started_at = time.perf_counter()
+    self.call_service('media_player/volume_set',
+                      entity_id=entity_id,
+                      volume_level=volume_level)
+    self.observe_service_call(started_at)
+
+    return entity_id
+
+  def observe_service_call(self, started_at):
+    """Record the volume service call metrics if the metrics are enabled."""
+    if self.metrics:
+      self.metrics.increment('volume_set')
+      self.metrics.observe('service_seconds', time.perf_counter() - started_at)
+
+  @staticmethod
+  def get_volume_data(volume_level, areas):
+    """Validate set_volume() arguments.
+
+      Parameters:
+        volume_level: A volume level to set.
+        areas: A list of areas.
+      Returns:
+        tuple: a comma separated list of the targets and a volume level
+        in the 0..1 range for HASS API call.
+      """
+
     error_message = 'The volume level must be a number from 0 to 100.'
 
     try:
@@ -62,8 +116,4 @@ class AmazonEcho(hass.Hass):
     entity_id = ','.join(AmazonEcho.get_target(area) for area in areas)
     volume_level = float(volume_level / 100)
 
-    self.call_service('media_player/volume_set',
-                      entity_id=entity_id,
-                      volume_level=volume_level)
-
-    return entity_id
+    return entity_id, volume_level
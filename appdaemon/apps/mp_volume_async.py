@@ -0,0 +1,57 @@
+"""Asyncio variant of mp_volume.py."""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=invalid-overridden-method
+
+import time
+
+import mp_volume
+
+
+class AmazonEcho(mp_volume.AmazonEcho):
+  """Amazon Echo App Daemon async class."""
+
+  async def initialize(self):
+    """Initialize event listener."""
+
+    self.configure_metrics()
+    if self.metrics:
+      await self.run_every(self.publish_metrics, 'now', self.metrics.interval)
+
+    await self.listen_event(self.handle_event, self.EVENT_NAME)
+
+  # pylint: disable=unused-argument
+  async def publish_metrics(self, kwargs):
+    """Publish the metrics as sensors and to the Prometheus textfile."""
+    for entity_id, (state, attributes) in self.metrics.get_sensors().items():
+      await self.set_state(entity_id, state=state, attributes=attributes)
+
+    if self.metrics.path:
+      self.metrics.write_prometheus()
+
+  async def handle_event(self, event, data, kwargs):
+    """Handle the event."""
+
+    await self.set_volume(data.get('volume_level'),
+                          data.get('areas', self.AREAS))
+
+  async def set_volume(self, volume_level, areas):
+    """Set volume level for a set of devices.
+
+      Parameters:
+        volume_level: A volume level to set.
+        areas: A list of areas.
+      Returns:
+        string: a comma separated list of the targets for HASS API call.
+      """
+
+    entity_id, volume_level = self.get_volume_data(volume_level, areas)
+
+    started_at = time.perf_counter()
+    await self.call_service('media_player/volume_set',
+                            entity_id=entity_id,
+                            volume_level=volume_level)
+    self.observe_service_call(started_at)
+
+    return entity_id
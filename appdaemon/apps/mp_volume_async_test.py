@@ -0,0 +1,42 @@
+"""Tests for mp_volume_async.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+
+import hass_fake
+import mp_volume
+import mp_volume_async
+import mp_volume_test
+
+
+class TestAmazonEcho(mp_volume_test.TestAmazonEcho):
+  """Amazon Echo async volume tests."""
+
+  def _create_app(self):
+    backend = hass_fake.AsyncBackend()
+    self.addCleanup(backend.close)
+
+    alexa_volume = hass_fake.create_app(mp_volume_async.AmazonEcho, {})
+    backend.install(alexa_volume)
+    backend.run(alexa_volume.initialize())
+
+    return hass_fake.SyncAdapter(alexa_volume, backend)
+
+  def test_handle_event(self):
+    self.alexa_volume.handle_event(mp_volume.AmazonEcho.EVENT_NAME, {
+        'areas': ['den'],
+        'volume_level': 30
+    }, {})
+
+    self._assert_hass_called_with(30, ['den'])
+
+  def test_listens_to_event(self):
+    self.alexa_volume.listen_event.assert_awaited_once_with(
+        self.alexa_volume.app.handle_event, mp_volume.AmazonEcho.EVENT_NAME)
+
+
+if __name__ == '__main__':
+  unittest.main()
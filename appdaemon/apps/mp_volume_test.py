@@ -6,20 +6,25 @@ import unittest
 from unittest import mock
 
 import mp_volume
+import tts_metrics
 
 
 class TestAmazonEcho(unittest.TestCase):
   """Amazon Echo volume tests."""
 
   def setUp(self):
-    self.alexa_volume = mp_volume.AmazonEcho(mock.Mock(), mock.Mock(),
-                                             mock.MagicMock(), mock.MagicMock(),
-                                             mock.Mock(), mock.Mock(),
-                                             mock.Mock())
-    self.alexa_volume.initialize()
+    self.alexa_volume = self._create_app()
+
+  def _create_app(self):
+    alexa_volume = mp_volume.AmazonEcho(mock.Mock(), mock.Mock(),
+                                        mock.MagicMock(), {}, mock.Mock(),
+                                        mock.Mock(), mock.Mock())
+    alexa_volume.initialize()
 
     mp_volume.AmazonEcho.call_service = mock.Mock()
 
+    return alexa_volume
+
   def _assert_hass_called_with(self, volume_level, areas):
     entity_id = ','.join(
         mp_volume.AmazonEcho.get_target(area) for area in areas)
@@ -61,6 +66,26 @@ class TestAmazonEcho(unittest.TestCase):
       self.assertIn('The volume level must be a number from 0 to 100.',
                     str(ctx.exception))
 
+  def test_metrics(self):
+    """Test the volume service call metrics."""
+
+    self.alexa_volume.metrics = tts_metrics.Metrics('mp_volume')
+    self.alexa_volume.set_volume(42, ('den',))
+
+    self.assertEqual(self.alexa_volume.metrics.counters['volume_set'], 1)
+    self.assertEqual(self.alexa_volume.metrics.totals['service_seconds'][0], 1)
+
+  @mock.patch.object(mp_volume.AmazonEcho, 'set_state')
+  def test_publish_metrics(self, _):
+    """Test the metrics are published as sensors."""
+
+    self.alexa_volume.metrics = tts_metrics.Metrics('mp_volume')
+    self.alexa_volume.metrics.increment('volume_set')
+    self.alexa_volume.publish_metrics({})
+
+    self.alexa_volume.set_state.assert_called_once_with(
+        'sensor.mp_volume_volume_set', state=1, attributes={})
+
 
 if __name__ == '__main__':
   unittest.main()
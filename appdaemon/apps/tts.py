@@ -11,139 +11,489 @@ __author__ = 'Arkadii Yakovets (ark@cho.red)'
 # pylint: disable=import-error
 # pylint: disable=too-many-instance-attributes
 
-import hashlib
-import re
+import os
 import sys
 import time
-from collections import defaultdict
-from queue import Queue
-from threading import Thread
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import BoundedSemaphore, Lock, Thread
 
 from appdaemon.plugins.hass import hassapi as hass
 
+import tts_bitset
+import tts_dispatch
+import tts_duration
+import tts_metrics
+import tts_profile
+import tts_queue
+import tts_scheduler
+import tts_throttle
+
 
 class AmazonEcho(hass.Hass):
   """Amazon Echo TTS App Daemon class."""
 
   EVENT_NAME = 'tts'
+  METRICS_BUCKETS = {
+      'routing_seconds': tts_metrics.Metrics.LATENCY_BUCKETS,
+      'service_seconds': tts_metrics.Metrics.LATENCY_BUCKETS,
+      'state_lookups': tts_metrics.Metrics.LOOKUP_BUCKETS,
+  }
+  METRICS_PREFIX = 'tts'
+  PROFILE_DIR_DEFAULT = 'profiles'
+  PROFILE_EVENT_NAME = 'tts_profile'
+  ROUTING_ENGINE_BITSET = 'bitset'
+  ROUTING_ENGINE_PLAN = 'plan'
+  SERVICE_THREADS = 4
   STATE_OFF = 'off'
   STATE_ON = 'on'
   STATE_PLAYING = 'playing'
   THROTTLED_ENTITY_TIME_DEFAULT_SECONDS = 60
-  TTS_CHARACTERS_PER_SECOND = 7
+  WORKER_ERROR_DELAY_SECONDS = 1
+
+  clock = staticmethod(time.monotonic)
+  message_queue_class = tts_queue.MessageQueue
+  scheduler_class = tts_scheduler.PlaybackScheduler
 
   def initialize(self):
     """Initialize event listener."""
 
+    self.configure()
+
+    thread = Thread(target=self.worker)
+    thread.daemon = True
+    thread.start()
+
+    if self.metrics:
+      self.run_every(self.publish_metrics, 'now', self.metrics.interval)
+
+    self.listen_event(self.handle_event, self.EVENT_NAME)
+    self.listen_event(self.handle_profile_event, self.PROFILE_EVENT_NAME)
+
+  def terminate(self):
+    """Stop the dispatch pool and the running profile."""
+    if self.scheduler.pool is not None:
+      self.scheduler.pool.shutdown()
+    if self.service_executor is not None:
+      self.service_executor.shutdown(wait=False)
+    if self.profiler is not None:
+      self.profiler.stop()
+
+  def configure(self):
+    """Configure the app from config values."""
     self.env = self.args['env']
-    self.play_always_normal_time = []
-    self.play_always_quite_time = []
-    self.play_default_normal_time = []
-    self.play_default_quite_time = []
     self.rules = self.args['rules']
     self.quite_time = self.args['quite_time']
     self.throttle = self.args['throttle']
     self.throttled_entity_time_mapping = defaultdict(
         lambda: self.THROTTLED_ENTITY_TIME_DEFAULT_SECONDS)
-    self.throttled_events = {}
+    self.throttled_events = tts_throttle.ThrottleStore(
+        self.throttled_entity_time_mapping,
+        self.args.get('throttle_size', tts_throttle.ThrottleStore.SIZE_DEFAULT))
+    self.rate_limiter = tts_throttle.RateLimiter.from_config(
+        self.args.get('rate_limit'))
+    self.state_lookups = 0
+    self.mirror = None
+    self.profiler = None
+    self.breaker = tts_dispatch.CircuitBreaker.from_config(
+        self.args.get('circuit_breaker'), self.clock)
+    self.service_executor = None
+    self.service_slots = BoundedSemaphore(self.SERVICE_THREADS)
+    self.service_timeout = self.args.get('service_timeout')
+    self.metrics = tts_metrics.Metrics.from_config(self.METRICS_PREFIX,
+                                                   self.args.get('metrics'),
+                                                   self.config_dir,
+                                                   self.METRICS_BUCKETS,
+                                                   self.clock)
 
+    duration_config = self.args.get('duration') or {}
+    self.durations = tts_duration.DurationEstimator(
+        duration_config.get(
+            'words_per_second',
+            tts_duration.DurationEstimator.WORDS_PER_SECOND_DEFAULT),
+        duration_config.get('audio'), duration_config.get('voices'))
+
+    self.configure_routing()
     self.configure_throttling()
 
-    self.messages = Queue(maxsize=5)
-    thread = Thread(target=self.worker)
-    thread.daemon = True
-    thread.start()
+    self.messages = self.message_queue_class(
+        self.args.get('queue_size', tts_queue.MessageQueue.SIZE_DEFAULT),
+        self.args.get('queue_overflow',
+                      tts_queue.MessageQueue.POLICY_DROP_OLDEST),
+        self.args.get('queue_deduplicate', True), self.clock)
+    chunk_config = self.args.get('chunk')
+    coalesce_config = self.args.get('coalesce')
+    self.scheduler = self.scheduler_class(
+        self, self.messages, self.args.get('preempt_priority'),
+        None if coalesce_config is None else (coalesce_config or {}).get(
+            'length', tts_scheduler.PlaybackScheduler.COALESCE_LENGTH_DEFAULT),
+        self.args.get('dispatch_threads'),
+        tts_dispatch.RetryQueue.from_config(self.args.get('retry')),
+        None if chunk_config is None else (chunk_config or {}).get(
+            'length', tts_scheduler.PlaybackScheduler.CHUNK_LENGTH_DEFAULT),
+        self.service_timeout)
 
-    self.listen_event(self.handle_event, self.EVENT_NAME)
+    self.monitor = None
+    completion_config = self.args.get('completion_pacing')
+    if completion_config is not None:
+      self.monitor = self.create_playback_monitor(
+          (completion_config or {}).get('calibrate', True))
 
-  @staticmethod
-  def calculate_duration(text):
-    clean_text = re.sub(r'<.*?>', '', text)
-    duration = round(len(clean_text) / AmazonEcho.TTS_CHARACTERS_PER_SECOND)
+  def count_metric(self, name, value=1):
+    """Increment a metrics counter if the metrics are enabled."""
+    if self.metrics:
+      self.metrics.increment(name, value)
 
-    if 'beeps_and_bloops/tone_05' in text:
-      duration += 1
+  def observe_metric(self, name, value):
+    """Record a message span value if the metrics are enabled."""
+    if self.metrics:
+      self.metrics.observe(name, value)
 
-    return duration
+  # pylint: disable=unused-argument
+  def publish_metrics(self, kwargs):
+    """Publish the metrics as sensors and to the Prometheus textfile."""
+    self.set_gauges()
+    self.metrics.publish(self.set_state)
+
+  def set_gauges(self):
+    """Update the gauges of the queue, the pipeline stages and the stores."""
+    self.metrics.set_gauge('queue_depth', len(self.messages))
+    for stage, depth in self.scheduler.get_depths(self.clock()).items():
+      self.metrics.set_gauge(f'{stage}_queue_depth', depth)
+    if self.breaker is not None:
+      self.metrics.set_gauge(
+          'breaker_open',
+          int(self.breaker.state != tts_dispatch.CircuitBreaker.STATE_CLOSED))
+    if self.mirror is not None:
+      self.metrics.set_gauge('mirror_resyncs', self.mirror.resyncs)
+    for name, value in self.throttled_events.stats().items():
+      self.metrics.set_gauge(f'throttle_{name}', value)
+
+    self.metrics.set_histograms('queue_wait_seconds', 'priority',
+                                self.messages.wait_times)
+    self.metrics.set_histograms('expired_age_seconds', 'priority',
+                                self.messages.expired_ages)
+
+  def calculate_duration(self, text, voice=None):
+    """Return the estimated text playback duration in seconds."""
+    return self.durations.estimate(text, voice)
+
+  @staticmethod
+  def get_area(target):
+    """Return the area of a media player target ID."""
+    name = target.split('.', 1)[-1]
+    return name[:-len('_echo')] if name.endswith('_echo') else name
 
   @staticmethod
   def get_target(area):
     """Return media player target ID for an area."""
     return f'media_player.{area}_echo'
 
+  def create_playback_monitor(self, calibrate):
+    """Return a playback monitor releasing the scheduler targets."""
+    return PlaybackMonitor(self, calibrate)
+
+  def create_state_mirror(self, max_age):
+    """Return a state mirror for the routing plan."""
+    return StateMirror(self, self.plan, max_age)
+
+  def configure_routing(self):
+    """Compiles the routing plan from config values."""
+    self.plan = RoutingPlan(self.env, self.rules, self.quite_time)
+
+    routing_engine = self.args.get('routing_engine', self.ROUTING_ENGINE_PLAN)
+    if routing_engine == self.ROUTING_ENGINE_BITSET:
+      self.router = tts_bitset.BitsetRouter(self.plan)
+    elif routing_engine == self.ROUTING_ENGINE_PLAN:
+      self.router = self.plan
+    else:
+      raise ValueError(f'Unknown routing engine: {routing_engine}.')
+
+    if self.mirror:
+      self.mirror.cancel()
+      self.mirror = None
+
+    mirror_config = self.args.get('state_mirror')
+    cache_config = self.args.get('routing_cache')
+    if cache_config is not None and mirror_config is None:
+      raise ValueError('The routing cache requires the state mirror.')
+
+    if mirror_config is not None:
+      self.mirror = self.create_state_mirror(
+          (mirror_config or {}).get('max_age',
+                                    StateMirror.MAX_AGE_DEFAULT_SECONDS))
+    if cache_config is not None:
+      self.mirror.cache = RoutingCache(
+          (cache_config or {}).get('size', RoutingCache.SIZE_DEFAULT))
+
   def configure_throttling(self):
     """Populates throttle rules from config values."""
     self.throttled_entity_time_mapping.update({
         entity_id: throttle_time for throttle_mapping in self.throttle
         for entity_id, throttle_time in throttle_mapping.items()
     })
+    self.ttl_mapping = {
+        entity_id: ttl for ttl_mapping in self.args.get('ttl') or ()
+        for entity_id, ttl in ttl_mapping.items()
+    }
 
   # pylint: disable=unused-argument
   def handle_event(self, event, data, kwargs):
-    """Put new message to the queue."""
+    """Put new message to the queue without blocking."""
     entity_id = data.get('entity_id')
     text = data.get('text')
+    self.count_metric('events')
 
-    if not self.is_throttled(entity_id, text):
-      self.messages.put({
-          'areas_off': data.get('areas_off'),
-          'areas_on': data.get('areas_on'),
-          'text': text,
-      })
+    if self.is_throttled(entity_id, text):
+      self.count_metric('throttled')
+      return
 
-  def set_environment(self):
-    """Add play always and play default area targets."""
+    policy = self.rate_limiter.limit(entity_id, self.clock())
+    if policy:
+      # A dropped event doesn't throttle its repeats.
+      self.throttled_events.discard(entity_id, text)
+      self.count_metric('rate_limited')
+      self.log(f'Rate limited: {text} ({policy})')
+      return
 
-    try:
-      self.play_always_normal_time = [
-          self.get_target(area)
-          for area in self.env['play_always']['normal_time']
-      ]
-    except KeyError:
-      pass
+    message = {
+        'areas_off': data.get('areas_off'),
+        'areas_on': data.get('areas_on'),
+        'priority': int(data.get('priority', tts_queue.PRIORITY_DEFAULT)),
+        'text': text,
+    }
+    ttl = data.get('ttl', self.ttl_mapping.get(entity_id))
+    if ttl is not None:
+      message['ttl'] = float(ttl)
+    voice = data.get('voice')
+    if voice:
+      message['voice'] = voice
 
-    try:
-      self.play_always_quite_time = [
-          self.get_target(area)
-          for area in self.env['play_always']['quite_time']
-      ]
-    except KeyError:
-      pass
+    outcome = self.messages.put(message)
+    self.count_metric(f'queue_{outcome}')
+    if outcome == tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST:
+      self.throttled_events.discard(entity_id, text)
+    if outcome != tts_queue.MessageQueue.OUTCOME_ENQUEUED:
+      self.log(f'Queue is full: {text} ({outcome})')
 
-    try:
-      self.play_default_normal_time = [
-          self.get_target(area)
-          for area in self.env['play_default']['normal_time']
-      ]
-    except KeyError:
-      pass
+  # pylint: disable=unused-argument
+  def handle_profile_event(self, event, data, kwargs):
+    """Start sampling the worker and the event callbacks stacks."""
+    if self.profiler is not None:
+      self.log('Profile is already running')
+      return
+
+    duration = min(
+        float(
+            data.get('duration',
+                     tts_profile.SamplingProfiler.DURATION_DEFAULT_SECONDS)),
+        tts_profile.SamplingProfiler.DURATION_MAX_SECONDS)
+    self.profiler = tts_profile.SamplingProfiler(
+        self.get_profile_entries(),
+        float(
+            data.get('interval',
+                     tts_profile.SamplingProfiler.INTERVAL_DEFAULT_SECONDS)))
+
+    thread = Thread(target=self.profile, args=(self.profiler, duration))
+    thread.daemon = True
+    thread.start()
 
+  def get_profile_entries(self):
+    """Return the code objects of the profiled app entry points."""
+    return (type(self).handle_event.__code__, type(self).worker.__code__,
+            self.scheduler.pool_class.run.__code__)
+
+  def profile(self, profiler, duration):
+    """Record the profile and write it to the profile directory."""
+    path = os.path.join(self.config_dir,
+                        self.args.get('profile_dir', self.PROFILE_DIR_DEFAULT),
+                        f'tts-{time.strftime("%Y%m%d-%H%M%S")}.folded')
     try:
-      self.play_default_quite_time = [
-          self.get_target(area)
-          for area in self.env['play_default']['quite_time']
-      ]
-    except KeyError:
-      pass
+      profiler.run(duration)
+      profiler.write(path)
+      self.log(f'Profile saved: {path} ({profiler.samples} samples)')
+    except Exception:  # pylint: disable=broad-except
+      self.log(sys.exc_info())
+    finally:
+      self.profiler = None
+
+  def limit_targets(self, targets, now):
+    """Return the message targets over their per area rate limits."""
+    areas = {self.get_area(target): target for target in targets}
+    return frozenset(
+        areas[area] for area in self.rate_limiter.limit_areas(areas, now))
 
   def is_throttled(self, entity_id, text):
     """Determines whether the `entity_id` event has to be throttled."""
     if not entity_id or not text:
       return False
 
-    event_key = hashlib.blake2b(f'{entity_id}_{text}'.encode()).hexdigest()
-    event_time = self.throttled_events.get(event_key)
-    now = time.time()
-    is_throttled = (
-        event_time
-        and now - event_time < self.throttled_entity_time_mapping[entity_id])
+    return self.throttled_events.is_throttled(entity_id, text, self.clock())
+
+  @staticmethod
+  def get_snapshot(states, entity_ids):
+    """Return an entity ID to state mapping for `entity_ids` entities."""
+    snapshot = {}
+    for entity_id in entity_ids:
+      try:
+        snapshot[entity_id] = states[entity_id]['state']
+      except KeyError:
+        pass
 
-    if not is_throttled:
-      self.throttled_events[event_key] = now
+    return snapshot
+
+  def get_states(self):
+    """
+      Return the entity states for routing several messages.
 
-    return is_throttled
+      Returns:
+        dict: The entity states of a single state read or None if the messages
+        are routed against the state mirror.
+      """
+    if self.mirror:
+      return None
+
+    return self.get_state(copy=False) or {}
+
+  def read_states(self, entity_ids, states=None):
+    """
+      Return a snapshot of entity states using a single state read.
+
+      Parameters:
+        entity_ids: A list of entity IDs to include into the snapshot.
+        states: The get_states() entity states to use instead of a state read.
+
+      Returns:
+        dict: An entity ID to state mapping. Unknown entities are skipped.
+      """
+    if states is None:
+      self.state_lookups += 1
+      states = self.get_state(copy=False) or {}
+
+    return self.get_snapshot(states, entity_ids)
+
+  def get_route_targets(self, areas_off=None, areas_on=None):
+    """
+      Return areas_off/areas_on targets and extra entities for routing.
+
+      Returns:
+        tuple: The areas_off targets, the areas_on targets and the entities
+        outside of the routing plan whose states are required.
+      """
+    plan = self.plan
+    targets_off = plan.get_targets(areas_off)
+    targets_on = plan.get_targets(areas_on)
+
+    # Explicitly included targets may be outside of the plan.
+    entities_extra = ()
+    if not targets_on <= plan.targets_all:
+      entities_extra = tuple(
+          plan.get_dnd_switch(target)
+          for target in targets_on.difference(plan.targets_all))
+
+    return targets_off, targets_on, entities_extra
+
+  def route(self, areas_off=None, areas_on=None, states=None):
+    """
+      Return a sorted list of targets a message has to be played on.
+
+      Parameters:
+        areas_off: A list of explicitly excluded areas.
+        areas_on: A list of explicitly included areas.
+        states: The get_states() entity states shared by several messages.
+      """
+    targets_off, targets_on, entities_extra = self.get_route_targets(
+        areas_off, areas_on)
+
+    self.state_lookups = 0
+    if self.mirror:
+      if self.mirror.is_stale():
+        self.mirror.resync(self.read_states(self.plan.entities, states))
+      states_extra = (self.read_states(entities_extra, states)
+                      if entities_extra else {})
+      return self.mirror.route(targets_off, targets_on, states_extra)
+
+    states = self.read_states(self.plan.entities + entities_extra, states)
+    return self.router.route(states, targets_off, targets_on)
+
+  def call_notify(self, text, targets):
+    """Call the notify service, time out after `service_timeout` seconds."""
+    pool = self.scheduler.pool
+    if self.service_timeout is None or (pool is not None and
+                                        pool.is_pool_thread()):
+      # The dispatch pool times out the dispatches in flight itself.
+      self.call_service('notify/alexa_media',
+                        data={'type': 'tts'},
+                        message=text,
+                        target=targets)
+      return
+
+    # A hung call keeps its thread, the caller moves on. Don't queue the calls
+    # behind the hung ones.
+    if not self.service_slots.acquire(blocking=False):
+      raise tts_dispatch.ServiceBusyError(text)
+
+    if self.service_executor is None:
+      self.service_executor = ThreadPoolExecutor(
+          self.SERVICE_THREADS, thread_name_prefix='tts_service')
+    future = self.service_executor.submit(self.call_service,
+                                          'notify/alexa_media',
+                                          data={'type': 'tts'},
+                                          message=text,
+                                          target=targets)
+    future.add_done_callback(lambda _: self.service_slots.release())
+    try:
+      future.result(self.service_timeout)
+    except FutureTimeoutError:
+      # A call still waiting for a thread never runs.
+      future.cancel()
+      raise
+
+  def check_breaker(self, text):
+    """Fail fast if the circuit breaker is open."""
+    if self.breaker is not None and not self.breaker.allow():
+      self.count_metric('breaker_rejected')
+      raise tts_dispatch.CircuitOpenError(text)
+
+  def record_service_call(self, started_at, failed):
+    """Record the service call outcome and latency."""
+    self.observe_metric('service_seconds', time.perf_counter() - started_at)
+    if failed:
+      self.count_metric('service_errors')
+
+    if self.breaker is None:
+      return
+
+    if not failed:
+      self.breaker.record_success()
+    elif self.breaker.record_failure():
+      self.count_metric('breaker_trips')
+      self.log('Circuit breaker opened')
+
+  @staticmethod
+  def get_voice_text(text, voice=None):
+    """Return the text wrapped into the SSML voice tag."""
+    if not voice:
+      return text
+
+    return f'<voice name="{voice}">{text}</voice>'
+
+  def play(self, text, targets, duration=None, voice=None):
+    """Play the text on the targets."""
+    if targets:
+      self.check_breaker(text)
+      started_at = time.perf_counter()
+      try:
+        self.call_notify(self.get_voice_text(text, voice), targets)
+      except Exception:
+        self.record_service_call(started_at, True)
+        raise
+      self.record_service_call(started_at, False)
+
+    if duration is not None:
+      self.log(f"{text} on {', '.join(targets)} ({duration}s)")
 
-  # pylint: disable=too-many-branches
   def tts(self, text, areas_off=None, areas_on=None):
     """
       Check targets and generate text to speech API request.
@@ -157,22 +507,15 @@ class AmazonEcho(hass.Hass):
         list: A list of target devices the message to be played on.
       """
 
-    def in_dnd_mode(media_player):
-      """
-      Return True if media player device is in the "Do Not Disturb" mode.
-      Return False otherwise.
-      """
-      return is_on(f'switch.{media_player.split(".")[1]}_do_not_disturb')
-
-    def is_on(sensor):
-      """Return True if sensor's state is 'on' otherwise returns False."""
-      return self.get_state(sensor) == self.STATE_ON
+    self.validate(text, areas_off, areas_on)
 
-    def is_playing(sensor):
-      """Return True if sensor's state is 'playing' otherwise returns False."""
-      return self.get_state(sensor) == self.STATE_PLAYING
+    targets = self.route(areas_off, areas_on)
+    self.play(text, targets)
+    return targets
 
-    # tts()
+  @staticmethod
+  def validate(text, areas_off=None, areas_on=None):
+    """Raise ValueError for invalid tts() arguments."""
     if not text:
       raise ValueError("Text field is required.")
 
@@ -181,48 +524,194 @@ class AmazonEcho(hass.Hass):
           "You can't use wildcard targets for both areas_off and areas_on at "
           "the same time.")
 
-    targets_all = {self.rules[rule]['target'] for rule in self.rules}
+  def worker(self):
+    """Dispatch TTS messages from the queue as their targets become free."""
+
+    while True:
+      version = self.messages.version
+      timeout = None
+      try:
+        next_at = self.scheduler.schedule(self.clock())
+        if next_at is not None:
+          timeout = max(next_at - self.clock(), 0)
+      except Exception:  # pylint: disable=broad-except
+        self.count_metric('errors')
+        self.log(sys.exc_info())
+        # Don't leave the pending messages until the next queue change.
+        timeout = self.WORKER_ERROR_DELAY_SECONDS
 
-    self.set_environment()
+      self.messages.wait(version, timeout)
 
-    for targets in (self.play_always_normal_time, self.play_always_quite_time,
-                    self.play_default_normal_time,
-                    self.play_default_quite_time):
-      if targets:
-        targets_all.update(targets)
 
-    if areas_off == '*':
-      targets_off = targets_all.copy()
-    else:
-      targets_off = {self.get_target(area) for area in areas_off or ()}
+class RoutingPlan:
+  """
+  Routing data compiled from the `env` and `rules` config values.
+
+  The plan is built once per app (re)initialization so that routing a message
+  doesn't need to walk the config or format entity IDs.
+  """
+
+  WILDCARD = '*'
+
+  def __init__(self, env, rules, quite_time):
+    self.area_targets = {}
+    self.dnd_switches = {}
+    self.quite_time = quite_time
+
+    self.play_always_normal_time = self._get_env_targets(
+        env, 'play_always', 'normal_time')
+    self.play_always_quite_time = self._get_env_targets(
+        env, 'play_always', 'quite_time')
+    self.play_default_normal_time = self._get_env_targets(
+        env, 'play_default', 'normal_time')
+    self.play_default_quite_time = self._get_env_targets(
+        env, 'play_default', 'quite_time')
+
+    # (target, conditions) pairs in the config order.
+    self.rules = tuple((rule['target'], tuple(rule['conditions']))
+                       for rule in rules.values())
+
+    # (rule target, if_not target, if_not conditions) in the config order.
+    self.if_not = tuple(
+        (rule['target'], rule['if_not'].get('target'),
+         tuple(rule['if_not'].get('conditions', ())))
+        for rule in rules.values()
+        if 'if_not' in rule)
+
+    self.targets_all = frozenset(
+        {target for target, _ in self.rules}.union(
+            self.play_always_normal_time, self.play_always_quite_time,
+            self.play_default_normal_time, self.play_default_quite_time))
+
+    for area in rules:
+      self.get_target(area)
+
+    # All entities the routing depends on in a hash seed independent order.
+    targets = sorted(self.targets_all)
+    self.entities = tuple(
+        dict.fromkeys((
+            quite_time,
+            *(c for _, conditions in self.rules for c in conditions),
+            *(c for _, _, conditions in self.if_not for c in conditions),
+            *targets,
+            *(self.get_dnd_switch(target) for target in targets),
+        )))
+
+  def _get_env_targets(self, env, env_type, time_type):
+    """Return a set of targets for `env_type`/`time_type` env value."""
+    try:
+      areas = env[env_type][time_type]
+    except KeyError:
+      areas = ()
+
+    return frozenset(self.get_target(area) for area in areas or ())
+
+  def get_dnd_switch(self, target):
+    """Return "Do Not Disturb" switch ID for a media player target."""
+    try:
+      return self.dnd_switches[target]
+    except KeyError:
+      switch = f'switch.{target.split(".")[1]}_do_not_disturb'
+      self.dnd_switches[target] = switch
+      return switch
 
-    if areas_on == '*':
-      targets_on = targets_all.copy()
+  def get_target(self, area):
+    """Return media player target ID for an area."""
+    try:
+      return self.area_targets[area]
+    except KeyError:
+      target = AmazonEcho.get_target(area)
+      self.area_targets[area] = target
+      return target
+
+  def get_targets(self, areas):
+    """Return a set of targets for areas_off/areas_on value."""
+    if areas == self.WILDCARD:
+      return self.targets_all
+
+    return frozenset(self.get_target(area) for area in areas or ())
+
+  # pylint: disable=too-many-arguments
+  def finalize(self, targets, quite_time, targets_off, targets_on,
+               in_dnd_mode):
+    """
+      Apply areas_off/areas_on and env targets to the rule based targets.
+
+      Parameters:
+        targets: A set of rule based and currently playing targets.
+        quite_time: Whether it's quite time now.
+        targets_off: A set of explicitly excluded targets.
+        targets_on: A set of explicitly included targets.
+        in_dnd_mode: A function checking the target "Do Not Disturb" mode.
+
+      Returns:
+        list: A sorted list of targets.
+      """
+
+    # Update targets based on areas_off/areas_on values.
+    targets.difference_update(targets_off)
+
+    # Override areas_off with areas_on.
+    targets.update(targets_on)
+
+    if quite_time:
+      targets_play_always = self.play_always_quite_time
+      targets_play_default = self.play_default_quite_time
     else:
-      targets_on = {self.get_target(area) for area in areas_on or ()}
+      targets_play_always = self.play_always_normal_time
+      targets_play_default = self.play_default_normal_time
+
+    targets.update(targets_play_always.difference(targets_off))
+
+    if not targets:
+      targets.update(targets_play_default.difference(targets_off))
+
+    return sorted((target for target in targets if not in_dnd_mode(target)))
+
+  def route(self, states, targets_off, targets_on):
+    """
+      Evaluate the rules against a state snapshot.
+
+      Parameters:
+        states: An entity ID to state mapping.
+        targets_off: A set of explicitly excluded targets.
+        targets_on: A set of explicitly included targets.
+
+      Returns:
+        list: A sorted list of targets.
+      """
+
+    def in_dnd_mode(media_player):
+      """
+      Return True if media player device is in the "Do Not Disturb" mode.
+      Return False otherwise.
+      """
+      return is_on(self.get_dnd_switch(media_player))
 
+    def is_on(sensor):
+      """Return True if sensor's state is 'on' otherwise returns False."""
+      return states.get(sensor) == AmazonEcho.STATE_ON
+
+    def is_playing(sensor):
+      """Return True if sensor's state is 'playing' otherwise returns False."""
+      return states.get(sensor) == AmazonEcho.STATE_PLAYING
+
+    # route()
     targets = set()
 
     # Normal time targets.
-    if not is_on(self.quite_time):
+    quite_time = is_on(self.quite_time)
+    if not quite_time:
       # Add targets based on the rule conditions.
-      for area in self.rules:
-        rule = self.rules[area]
-
-        if any((is_on(c) for c in rule['conditions'])):
-          targets.add(rule['target'])
+      for rule_target, conditions in self.rules:
+        if any((is_on(c) for c in conditions)):
+          targets.add(rule_target)
 
       # Remove targets based on the if_not conditions.
-      for area in self.rules:
-        rule = self.rules[area]
-        rule_target = rule['target']
-
-        if rule_target not in targets or 'if_not' not in rule:
+      for rule_target, target, conditions in self.if_not:
+        if rule_target not in targets:
           continue
 
-        conditions = rule['if_not'].get('conditions', ())
-        target = rule['if_not'].get('target')
-
         if target and target not in targets:
           continue
 
@@ -230,55 +719,322 @@ class AmazonEcho(hass.Hass):
           targets.remove(rule_target)
 
     # Add currently playing media players.
-    for target in targets_all:
+    for target in self.targets_all:
       if is_playing(target):
         targets.add(target)
 
-    # Update targets based on areas_off/areas_on values.
-    targets = targets.difference(targets_off)
+    return self.finalize(targets, quite_time, targets_off, targets_on,
+                         in_dnd_mode)
 
-    # Override areas_off with areas_on.
-    targets.update(targets_on)
 
-    targets_play_always = None
-    targets_play_default = None
-    if is_on(self.quite_time):
-      targets_play_always = self.play_always_quite_time
-      targets_play_default = self.play_default_quite_time
-    else:
-      targets_play_always = self.play_always_normal_time
-      targets_play_default = self.play_default_normal_time
+class RoutingCache:
+  """
+  LRU cache of routing decisions.
 
-    if targets_play_always:
-      targets.update(set(targets_play_always).difference(targets_off))
+  The cache key is the routing index generation and the areas_off/areas_on
+  targets. The generation changes on any change of a contributing entity, so
+  the key is built in O(1) and a stale decision is never returned.
+  """
 
-    if not targets and targets_play_default:
-      targets.update(set(targets_play_default).difference(targets_off))
+  SIZE_DEFAULT = 128
+
+  def __init__(self, size=SIZE_DEFAULT):
+    self.entries = OrderedDict()
+    self.lock = Lock()
+    self.size = size
+
+  def get(self, key):
+    """Return the cached targets or None."""
+    with self.lock:
+      try:
+        targets = self.entries[key]
+      except KeyError:
+        return None
+      self.entries.move_to_end(key)
+
+    return list(targets)
+
+  def put(self, key, targets):
+    """Cache the targets."""
+    with self.lock:
+      self.entries[key] = tuple(targets)
+      if len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+
+class StateMirror:
+  """
+  In-process copy of the routing plan entity states.
+
+  The mirror is kept up to date by state callbacks and maintains a routing
+  index. It is fully resynced with a single state read when it's older than
+  `max_age` seconds in order to recover from missed callbacks. The optional
+  routing cache memoizes the index routing decisions.
+  """
+
+  MAX_AGE_DEFAULT_SECONDS = 300
+
+  def __init__(self, app, plan, max_age=MAX_AGE_DEFAULT_SECONDS):
+    self.app = app
+    self.cache = None
+    self.index = RoutingIndex(plan)
+    self.max_age = max_age
+    self.plan = plan
+    self.resyncs = 0
+    self.synced_at = None
+
+    self.handles = [
+        self.app.listen_state(self.handle_state, entity_id)
+        for entity_id in plan.entities
+    ]
+
+  def cancel(self):
+    """Cancel the state callbacks."""
+    for handle in self.handles:
+      self.app.cancel_listen_state(handle)
+    self.handles = []
+
+  # pylint: disable=too-many-arguments,unused-argument
+  def handle_state(self, entity, attribute, old, new, kwargs):
+    """Update the entity state."""
+    self.index.update(entity, new)
+
+  def route(self, targets_off, targets_on, states_extra):
+    """Return the cached targets or route the message with the index."""
+    if self.cache is None:
+      return self.index.route(targets_off, targets_on, states_extra)
+
+    generation = self.index.generation
+    key = (generation, targets_off, targets_on,
+           frozenset(states_extra.items()))
+    targets = self.cache.get(key)
+    if targets is not None:
+      self.app.count_metric('routing_cache_hits')
+      return targets
+
+    self.app.count_metric('routing_cache_misses')
+    targets = self.index.route(targets_off, targets_on, states_extra)
+    # A state change while routing makes the decision stale.
+    if self.index.generation == generation:
+      self.cache.put(key, targets)
 
-    targets = sorted((target for target in targets if not in_dnd_mode(target)))
-    if targets:
-      self.call_service('notify/alexa_media',
-                        data={'type': 'tts'},
-                        message=text,
-                        target=targets)
     return targets
 
-  def worker(self):
-    """Process TTS messages from the queue."""
+  def is_stale(self):
+    """Return True if the mirror has to be resynced."""
+    return self.synced_at is None or (self.app.clock() - self.synced_at >
+                                      self.max_age)
 
-    while True:
-      try:
-        data = self.messages.get()
-        areas_off = data['areas_off']
-        areas_on = data['areas_on']
-        text = data['text']
+  def resync(self, states):
+    """Replace the mirrored states with the current ones."""
+    self.index.reset(states)
+    self.synced_at = self.app.clock()
+    self.resyncs += 1
 
-        targets = self.tts(areas_off=areas_off, areas_on=areas_on, text=text)
-        duration = self.calculate_duration(text)
 
-        self.log(f"{text} on {', '.join(targets)} ({duration}s)")
-        time.sleep(duration)
-      except Exception:  # pylint: disable=broad-except
-        self.log(sys.exc_info())
+class PlaybackMonitor:
+  """
+  Releases the scheduler targets once they actually finish playing.
+
+  A target is released on its 'playing' to any other state transition after
+  the message is dispatched, so the estimated playback duration is only used
+  as a timeout. The measured playback times calibrate the duration estimator.
+  """
+
+  def __init__(self, app, calibrate=True):
+    self.app = app
+    self.calibrate = calibrate
+    # A target to (dispatched message, playback start time) mapping.
+    self.started = {}
+
+    self.handles = [self.app.listen_state(self.handle_state, 'media_player')]
+
+  def cancel(self):
+    """Cancel the state callbacks."""
+    for handle in self.handles:
+      self.app.cancel_listen_state(handle)
+    self.handles = []
+
+  # pylint: disable=too-many-arguments,unused-argument
+  def handle_state(self, entity, attribute, old, new, kwargs):
+    """Track the dispatched message playback."""
+    scheduler = self.app.scheduler
+    message = scheduler.dispatches.get(entity)
+    if message is None:
+      return
+
+    if new == AmazonEcho.STATE_PLAYING:
+      self.started[entity] = (message, self.app.clock())
+      return
+
+    if old != AmazonEcho.STATE_PLAYING:
+      return
+
+    # The target may have started playing before the message was dispatched.
+    started_message, started_at = self.started.pop(entity, (None, None))
+    if started_message is not message:
+      return
+
+    if not scheduler.release(entity, message):
+      return
+
+    playback_time = self.app.clock() - started_at
+    self.app.observe_metric('playback_seconds', playback_time)
+    if self.calibrate:
+      self.app.durations.calibrate(message['text'], playback_time,
+                                   message.get('voice'))
+    self.app.messages.notify()
+
+
+class RoutingIndex:
+  """
+  Rule based targets maintained incrementally on state changes.
+
+  A reverse index maps each condition entity to the rules mentioning it, so a
+  state change only updates the affected rules. Routing a message reads the
+  precomputed target sets and doesn't depend on the number of rules. The
+  generation is incremented on every change affecting the routing.
+  """
+
+  def __init__(self, plan):
+    self.generation = 0
+    self.plan = plan
+    self.lock = Lock()
+
+    self.dnd_switch_targets = {
+        plan.get_dnd_switch(target): target for target in plan.targets_all
+    }
+    self.if_not_index = defaultdict(list)
+    for idx, (_, _, conditions) in enumerate(plan.if_not):
+      for condition in conditions:
+        self.if_not_index[condition].append(idx)
+    self.rules_index = defaultdict(list)
+    for idx, (_, conditions) in enumerate(plan.rules):
+      for condition in conditions:
+        self.rules_index[condition].append(idx)
+
+    self.reset({})
+
+  def reset(self, states):
+    """Rebuild the index from an entity ID to state mapping."""
+    with self.lock:
+      self.generation += 1
+      self.states = {}
+      self.dnd = set()
+      self.eligible = frozenset()
+      self.if_not_on = [0] * len(self.plan.if_not)
+      self.playing = set()
+      self.quite_time = False
+      self.rules_on = [0] * len(self.plan.rules)
+      self.targets_on = defaultdict(int)
+
+      for entity_id, state in states.items():
+        self._update(entity_id, state)
+      self._evaluate()
+
+  def route(self, targets_off, targets_on, states_extra):
+    """
+      Return a sorted list of targets based on the indexed states.
+
+      Parameters:
+        targets_off: A set of explicitly excluded targets.
+        targets_on: A set of explicitly included targets.
+        states_extra: States of entities outside of the plan.
+      """
+
+    def in_dnd_mode(media_player):
+      """Return True if media player device is in the "Do Not Disturb" mode."""
+      if media_player in self.dnd:
+        return True
+
+      return states_extra.get(self.plan.get_dnd_switch(
+          media_player)) == AmazonEcho.STATE_ON
+
+    with self.lock:
+      if self.quite_time:
+        targets = set(self.playing)
+      else:
+        targets = set(self.eligible)
+        targets.update(self.playing)
+
+      return self.plan.finalize(targets, self.quite_time, targets_off,
+                                targets_on, in_dnd_mode)
+
+  def update(self, entity_id, state):
+    """Update the index on an entity state change."""
+    with self.lock:
+      if self._update(entity_id, state):
+        self._evaluate()
+
+  def _evaluate(self):
+    """Apply the if_not conditions to the rule based targets."""
+    targets = set(self.targets_on)
+
+    for idx, (rule_target, target, conditions) in enumerate(self.plan.if_not):
+      if rule_target not in targets:
+        continue
+
+      if target and target not in targets:
+        continue
+
+      if not conditions or self.if_not_on[idx]:
+        targets.remove(rule_target)
+
+    self.eligible = frozenset(targets)
+
+  def _update(self, entity_id, state):
+    """
+      Update the entity state.
+
+      Returns:
+        bool: True if the rule based targets have to be reevaluated.
+      """
+    state_old = self.states.get(entity_id)
+    if state == state_old:
+      return False
+
+    if state is None:
+      del self.states[entity_id]
+    else:
+      self.states[entity_id] = state
+
+    is_playing = state == AmazonEcho.STATE_PLAYING
+    if (entity_id in self.plan.targets_all and
+        is_playing != (state_old == AmazonEcho.STATE_PLAYING)):
+      self.generation += 1
+      if is_playing:
+        self.playing.add(entity_id)
+      else:
+        self.playing.discard(entity_id)
+
+    is_on = state == AmazonEcho.STATE_ON
+    if is_on == (state_old == AmazonEcho.STATE_ON):
+      return False
+
+    self.generation += 1
+
+    if entity_id == self.plan.quite_time:
+      self.quite_time = is_on
+
+    if entity_id in self.dnd_switch_targets:
+      target = self.dnd_switch_targets[entity_id]
+      if is_on:
+        self.dnd.add(target)
+      else:
+        self.dnd.discard(target)
+
+    delta = 1 if is_on else -1
+    for idx in self.if_not_index.get(entity_id, ()):
+      self.if_not_on[idx] += delta
+
+    for idx in self.rules_index.get(entity_id, ()):
+      self.rules_on[idx] += delta
+      if is_on and self.rules_on[idx] == 1:
+        self.targets_on[self.plan.rules[idx][0]] += 1
+      elif not is_on and self.rules_on[idx] == 0:
+        target = self.plan.rules[idx][0]
+        self.targets_on[target] -= 1
+        if not self.targets_on[target]:
+          del self.targets_on[target]
 
-      self.messages.task_done()
+    return entity_id in self.if_not_index or entity_id in self.rules_index
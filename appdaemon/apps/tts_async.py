@@ -0,0 +1,354 @@
+"""
+Asyncio variant of tts.py.
+
+The app uses AppDaemon async callbacks and API: messages are dispatched by a
+task running on the AppDaemon event loop instead of a worker thread, and state
+reads and service calls don't occupy AppDaemon worker threads.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+# pylint: disable=invalid-overridden-method
+
+import asyncio
+import sys
+import time
+
+import tts
+import tts_queue
+import tts_scheduler
+
+
+class MessageQueue(tts_queue.MessageQueue):
+  """Message queue waking up the dispatch task on new messages."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.event = asyncio.Event()
+
+  def notify(self):
+    super().notify()
+    self.event.set()
+
+  def put(self, message):
+    outcome = super().put(message)
+    self.event.set()
+    return outcome
+
+  async def wait(self, version, timeout=None):
+    """
+      Wait until the queue changes since `version` or `timeout` expires.
+
+      Returns:
+        bool: True if the queue has changed, False on timeout.
+      """
+    while self.version == version:
+      self.event.clear()
+      try:
+        await asyncio.wait_for(self.event.wait(), timeout)
+      except asyncio.TimeoutError:
+        return self.version != version
+
+    return True
+
+
+class DispatchPool(tts_scheduler.DispatchPool):
+  """Bounded pool of tasks playing the dispatched messages."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.tasks = set()
+    # The app times out the service calls with asyncio.wait_for().
+    self.timeout = None
+
+  async def run(self, dispatch_id, message, targets, duration):
+    """Play the dispatch, log its errors."""
+    try:
+      await self.dispatch(message, targets, duration)
+    except Exception:  # pylint: disable=broad-except
+      self.app.count_metric('errors')
+      self.app.log(sys.exc_info())
+    finally:
+      self.release(dispatch_id)
+
+  def shutdown(self):
+    """Cancel the dispatches in flight."""
+    for task in self.tasks:
+      task.cancel()
+
+  def submit(self, message, targets, duration):
+    """Play the dispatch on a separate task."""
+    task = asyncio.ensure_future(
+        self.run(self.acquire(message, targets), message, targets, duration))
+    # The event loop only keeps weak references to the tasks.
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+
+class PlaybackScheduler(tts_scheduler.PlaybackScheduler):
+  """Per target playback scheduler awaiting the app routing and playback."""
+
+  pool_class = DispatchPool
+
+  async def dispatch(self, message, targets, duration):
+    """Play the message on its targets, retry it later on failure."""
+    try:
+      await self.app.play(message['text'], sorted(targets), duration,
+                          message.get('voice'))
+    except Exception:  # pylint: disable=broad-except
+      self.fail(message, targets, sys.exc_info())
+    else:
+      self.start(message, targets, duration)
+
+  async def route(self, message, states=None):
+    """
+      Return the message targets.
+
+      Parameters:
+        message: A pending message.
+        states: The app get_states() entity states of the scheduling pass.
+
+      Returns:
+        frozenset: The message targets or None for invalid messages.
+      """
+    if 'targets' in message:
+      # The rest of a chunked message.
+      return message['targets']
+
+    try:
+      self.app.validate(message['text'], message['areas_off'],
+                        message['areas_on'])
+      started_at = time.perf_counter()
+      targets = frozenset(await self.app.route(message['areas_off'],
+                                               message['areas_on'], states))
+      self.observe_route(started_at)
+      return targets
+    except Exception:  # pylint: disable=broad-except
+      self.messages.remove(message)
+      self.app.log(sys.exc_info())
+      return None
+
+  async def schedule(self, now):
+    """
+      Dispatch the pending messages whose targets are free.
+
+      Returns:
+        float: The time of the next scheduling pass or None if there are no
+        pending messages waiting for busy targets.
+      """
+    self.requeue(now)
+    self.expire(now)
+    self.expire_dispatches(now)
+
+    routes = []
+    messages = self.messages.messages
+    if messages:
+      # All of the pending messages are routed against a single state read.
+      states = await self.app.get_states()
+      self.state_lookups = int(states is not None)
+      for message in messages:
+        targets = await self.route(message, states)
+        if targets is not None:
+          routes.append((message, targets))
+      self.app.observe_metric('state_lookups', self.state_lookups)
+
+    dispatches, next_at = self.plan(routes, now)
+    for message, targets, duration in dispatches:
+      await self.submit(message, targets, duration)
+
+    return self.get_next_at(next_at)
+
+  async def submit(self, message, targets, duration):
+    """Play the message on the dispatch pool or on the dispatch task."""
+    if self.pool is None:
+      await self.dispatch(message, targets, duration)
+    else:
+      self.pool.submit(message, targets, duration)
+
+
+class StateListenerMixin:
+  """Cancels the state callbacks of an async app."""
+
+  def cancel(self):
+    """Cancel the state callbacks."""
+    if self.handles:
+      self.app.create_task(self._cancel(self.handles))
+    self.handles = []
+
+  async def _cancel(self, handles):
+    # Async API calls made outside of a coroutine return futures.
+    for handle in handles:
+      await self.app.cancel_listen_state(await handle)
+
+
+class PlaybackMonitor(StateListenerMixin, tts.PlaybackMonitor):
+  """Playback monitor of an async app."""
+
+  # pylint: disable=too-many-arguments
+  async def handle_state(self, entity, attribute, old, new, kwargs):
+    """Track the dispatched message playback on the event loop."""
+    super().handle_state(entity, attribute, old, new, kwargs)
+
+
+class StateMirror(StateListenerMixin, tts.StateMirror):
+  """State mirror of an async app."""
+
+
+class AmazonEcho(tts.AmazonEcho):
+  """Amazon Echo TTS App Daemon async class."""
+
+  message_queue_class = MessageQueue
+  scheduler_class = PlaybackScheduler
+
+  async def initialize(self):
+    """Initialize event listener and the dispatch task."""
+
+    self.configure()
+    self.worker_task = await self.create_task(self.worker())
+
+    if self.metrics:
+      await self.run_every(self.publish_metrics, 'now', self.metrics.interval)
+
+    await self.listen_event(self.handle_event, self.EVENT_NAME)
+    await self.listen_event(self.handle_profile_event,
+                            self.PROFILE_EVENT_NAME)
+
+  async def terminate(self):
+    """Stop the dispatch task, the dispatch pool and the running profile."""
+    self.worker_task.cancel()
+    super().terminate()
+
+  def create_playback_monitor(self, calibrate):
+    """Return a playback monitor releasing the scheduler targets."""
+    return PlaybackMonitor(self, calibrate)
+
+  def create_state_mirror(self, max_age):
+    """Return a state mirror for the routing plan."""
+    return StateMirror(self, self.plan, max_age)
+
+  # pylint: disable=unused-argument
+  async def publish_metrics(self, kwargs):
+    """Publish the metrics as sensors and to the Prometheus textfile."""
+    self.set_gauges()
+    for entity_id, (state, attributes) in self.metrics.get_sensors().items():
+      await self.set_state(entity_id, state=state, attributes=attributes)
+
+    if self.metrics.path:
+      self.metrics.write_prometheus()
+
+  async def handle_event(self, event, data, kwargs):
+    """Put new message to the queue without blocking."""
+    super().handle_event(event, data, kwargs)
+
+  async def get_states(self):
+    """
+      Return the entity states for routing several messages.
+
+      Returns:
+        dict: The entity states of a single state read or None if the messages
+        are routed against the state mirror.
+      """
+    if self.mirror:
+      return None
+
+    return await self.get_state(copy=False) or {}
+
+  async def read_states(self, entity_ids, states=None):
+    """
+      Return a snapshot of entity states using a single state read.
+
+      Parameters:
+        entity_ids: A list of entity IDs to include into the snapshot.
+        states: The get_states() entity states to use instead of a state read.
+
+      Returns:
+        dict: An entity ID to state mapping. Unknown entities are skipped.
+      """
+    if states is None:
+      self.state_lookups += 1
+      states = await self.get_state(copy=False) or {}
+
+    return self.get_snapshot(states, entity_ids)
+
+  async def route(self, areas_off=None, areas_on=None, states=None):
+    """
+      Return a sorted list of targets a message has to be played on.
+
+      Parameters:
+        areas_off: A list of explicitly excluded areas.
+        areas_on: A list of explicitly included areas.
+        states: The get_states() entity states shared by several messages.
+      """
+    targets_off, targets_on, entities_extra = self.get_route_targets(
+        areas_off, areas_on)
+
+    self.state_lookups = 0
+    if self.mirror:
+      if self.mirror.is_stale():
+        self.mirror.resync(await self.read_states(self.plan.entities, states))
+      states_extra = (await self.read_states(entities_extra, states)
+                      if entities_extra else {})
+      return self.mirror.route(targets_off, targets_on, states_extra)
+
+    states = await self.read_states(self.plan.entities + entities_extra, states)
+    return self.router.route(states, targets_off, targets_on)
+
+  async def call_notify(self, text, targets):
+    """Call the notify service, time out after `service_timeout` seconds."""
+    await asyncio.wait_for(
+        self.call_service('notify/alexa_media',
+                          data={'type': 'tts'},
+                          message=text,
+                          target=targets), self.service_timeout)
+
+  async def play(self, text, targets, duration=None, voice=None):
+    """Play the text on the targets."""
+    if targets:
+      self.check_breaker(text)
+      started_at = time.perf_counter()
+      try:
+        await self.call_notify(self.get_voice_text(text, voice), targets)
+      except Exception:
+        self.record_service_call(started_at, True)
+        raise
+      self.record_service_call(started_at, False)
+
+    if duration is not None:
+      self.log(f"{text} on {', '.join(targets)} ({duration}s)")
+
+  async def tts(self, text, areas_off=None, areas_on=None):
+    """
+      Check targets and generate text to speech API request.
+
+      Parameters:
+        text: A text to play.
+        areas_off: A list of explicitly excluded areas.
+        areas_on: A list of explicitly included areas.
+
+      Returns:
+        list: A list of target devices the message to be played on.
+      """
+
+    self.validate(text, areas_off, areas_on)
+
+    targets = await self.route(areas_off, areas_on)
+    await self.play(text, targets)
+    return targets
+
+  async def worker(self):
+    """Dispatch TTS messages from the queue as their targets become free."""
+
+    while True:
+      version = self.messages.version
+      timeout = None
+      try:
+        next_at = await self.scheduler.schedule(self.clock())
+        if next_at is not None:
+          timeout = max(next_at - self.clock(), 0)
+      except Exception:  # pylint: disable=broad-except
+        self.count_metric('errors')
+        self.log(sys.exc_info())
+        timeout = self.WORKER_ERROR_DELAY_SECONDS
+
+      await self.messages.wait(version, timeout)
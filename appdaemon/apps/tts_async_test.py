@@ -0,0 +1,153 @@
+"""Tests for tts_async.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import hass_fake
+import tts
+import tts_async
+import tts_test
+
+
+class AsyncTestMixin:
+  """Runs tts.py tests against the async app using the fake async backend."""
+
+  def _create_app(self, args):
+    self.backend = hass_fake.AsyncBackend()
+    self.addCleanup(self.backend.close)
+
+    amazon_echo = hass_fake.create_app(tts_async.AmazonEcho, args)
+    self.backend.install(amazon_echo)
+    self.backend.run(amazon_echo.initialize())
+
+    return hass_fake.SyncAdapter(amazon_echo, self.backend)
+
+
+# Async variants of all tts.py test cases.
+for name, test_class in vars(tts_test).copy().items():
+  if (isinstance(test_class, type) and
+      issubclass(test_class, tts_test.TestBase)):
+    globals()[name] = type(name, (AsyncTestMixin, test_class), {})
+del name, test_class
+
+
+class TestHandleEvent(AsyncTestMixin, tts_test.TestHandleEvent):
+  """Event handler tests."""
+
+  def _wait_called(self):
+    for _ in range(100):
+      if self.amazon_echo.call_service.called:
+        break
+      self.backend.run_pending(0.01)
+
+  def _mock_schedule(self, side_effect):
+    schedule = mock.AsyncMock(side_effect=side_effect)
+    self.amazon_echo.scheduler.schedule = schedule
+    return schedule
+
+  def test_worker_recovers_from_errors(self):
+    self.amazon_echo.WORKER_ERROR_DELAY_SECONDS = 0.01
+    schedule = self._mock_schedule([ValueError, None])
+
+    self.amazon_echo.messages.notify()
+    for _ in range(100):
+      if schedule.await_count > 1:
+        break
+      self.backend.run_pending(0.01)
+
+    self.assertEqual(schedule.await_count, 2)
+
+  def test_worker_task(self):
+    self.assertFalse(self.amazon_echo.worker_task.done())
+
+    self.amazon_echo.terminate()
+    self.backend.run_pending()
+
+    self.assertTrue(self.amazon_echo.worker_task.cancelled())
+
+  def test_worker_waits_for_busy_targets(self):
+    for text in ('First', 'Second'):
+      self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+          'areas_on': [tts_test.TestBase.GARAGE],
+          'text': text
+      }, {})
+    self.backend.run_pending(0.01)
+
+    self._assert_hass_called_with('First', [tts_test.TestBase.GARAGE_ECHO])
+    self.assertEqual(len(self.amazon_echo.messages.messages), 1)
+
+
+class TestDispatch(AsyncTestMixin, tts_test.TestDispatch):
+  """Dispatch failure handling tests."""
+
+  def _mock_hanging_service(self):
+
+    async def hang(*args, **kwargs):
+      del args, kwargs
+      await asyncio.Event().wait()
+
+    self.amazon_echo.call_service.side_effect = hang
+
+  def _schedule(self):
+    return self.backend.run(self.amazon_echo.scheduler.schedule(self.now))
+
+  def test_service_threads_busy(self):
+    self.amazon_echo.args['service_timeout'] = 0.01
+    self.amazon_echo.args.pop('circuit_breaker')
+    self.amazon_echo.configure()
+    self._mock_hanging_service()
+
+    # The timed out calls are cancelled and don't hold any threads.
+    for _ in range(tts.AmazonEcho.SERVICE_THREADS + 1):
+      with self.assertRaises(asyncio.TimeoutError):
+        self._tts()
+
+    self.assertIsNone(self.amazon_echo.service_executor)
+
+
+class TestChunk(AsyncTestMixin, tts_test.TestChunk):
+  """Long message chunking tests."""
+
+  def _schedule(self):
+    return self.backend.run(
+        self.amazon_echo.scheduler.schedule(time.monotonic()))
+
+
+class TestMetrics(AsyncTestMixin, tts_test.TestMetrics):
+  """Metrics tests."""
+
+  def _schedule(self):
+    return self.backend.run(
+        self.amazon_echo.scheduler.schedule(time.monotonic()))
+
+
+class TestPlaybackMonitor(AsyncTestMixin, tts_test.TestPlaybackMonitor):
+  """Playback monitor tests."""
+
+  def _set_state(self, entity_id, old, new):
+    self.backend.run(
+        self.monitor.handle_state(entity_id, 'state', old, new, {}))
+
+
+class TestStateMirror(AsyncTestMixin, tts_test.TestStateMirror):
+  """State mirror tests."""
+
+  def test_cancel_on_configure_routing(self):
+    handles = self.mirror.handles
+
+    self.amazon_echo.configure_routing()
+    self.backend.run_pending()
+
+    self.assertEqual(self.amazon_echo.cancel_listen_state.await_count,
+                     len(handles))
+    self.assertIsNot(self.amazon_echo.mirror, self.mirror)
+
+
+if __name__ == '__main__':
+  unittest.main()
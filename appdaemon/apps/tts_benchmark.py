@@ -0,0 +1,316 @@
+"""
+Routing benchmarks for tts.py.
+
+Generates synthetic homes in the shape of the apps.yaml tts config. The
+`engines` benchmark compares the routing engines on randomized state
+snapshots. The `tts` benchmark drives AmazonEcho.tts() against a fake state
+backend with randomly changing sensor states and reports the routing latency
+percentiles, the state lookups and the peak allocated memory per message for
+each app configuration variant. Its results can be saved as a baseline file
+and compared with a previously saved baseline.
+
+Usage:
+
+  python tts_benchmark.py engines --areas 10 100 1000 5000
+  python tts_benchmark.py tts --areas 10 100 1000 10000 --save baseline.json
+  python tts_benchmark.py tts --compare baseline.json
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import hass_fake
+import tts
+import tts_bitset
+import tts_metrics
+
+STATES = ('off', 'on', 'playing', 'unavailable')
+
+
+def generate_config(areas_count, rnd):
+  """Return a synthetic tts config with `areas_count` areas."""
+  areas = [f'area_{idx:05d}' for idx in range(areas_count)]
+
+  rules = {}
+  for idx, area in enumerate(areas):
+    conditions = [
+        f'binary_sensor.{area}_lights',
+        f'binary_sensor.{area}_motion_5m',
+    ]
+    if rnd.random() < 0.3:
+      conditions.append(f'binary_sensor.{area}_tv')
+    if rnd.random() < 0.1:
+      # Shared sensors, e.g. a hallway motion.
+      conditions.append(f'binary_sensor.shared_{idx % 10}_motion')
+
+    rule = {
+        'conditions': conditions,
+        'target': tts.AmazonEcho.get_target(area),
+    }
+    if rnd.random() < 0.3:
+      rule['if_not'] = {'conditions': [f'binary_sensor.{area}_door']}
+      if rnd.random() < 0.3:
+        rule['if_not']['target'] = tts.AmazonEcho.get_target(
+            areas[(idx + 1) % areas_count])
+    rules[area] = rule
+
+  return {
+      'env': {
+          'play_always': {
+              'normal_time': areas[:1],
+              'quite_time': areas[1:2],
+          },
+          'play_default': {
+              'normal_time': areas[2:3],
+              'quite_time': [],
+          },
+      },
+      'quite_time': 'binary_sensor.quite_time',
+      'rules': rules,
+      'throttle': [{
+          f'binary_sensor.{area}_door': 60 * rnd.randint(1, 5)
+      } for area in areas if rnd.random() < 0.1],
+  }
+
+
+def generate_states(plan, rnd, on_ratio=0.2):
+  """Return a random state snapshot for the plan entities."""
+  states = {}
+  for entity_id in plan.entities:
+    if rnd.random() < on_ratio:
+      states[entity_id] = rnd.choice(STATES[1:3])
+    else:
+      states[entity_id] = rnd.choice(STATES[::3])
+
+  return states
+
+
+def generate_areas(config, rnd):
+  """Return random areas_off/areas_on values."""
+  areas = list(config['rules'])
+  return (
+      rnd.choice((None, (), '*', rnd.sample(areas, min(3, len(areas))))),
+      rnd.choice((None, (), rnd.sample(areas, min(2, len(areas))))),
+  )
+
+
+def run(areas_count, messages, seed):
+  """Return per message routing time in microseconds for each engine."""
+  rnd = random.Random(seed)
+  config = generate_config(areas_count, rnd)
+
+  plan = tts.RoutingPlan(config['env'], config['rules'], config['quite_time'])
+  engines = {
+      tts.AmazonEcho.ROUTING_ENGINE_PLAN: plan,
+      tts.AmazonEcho.ROUTING_ENGINE_BITSET: tts_bitset.BitsetRouter(plan),
+  }
+
+  samples = []
+  for _ in range(messages):
+    areas_off, areas_on = generate_areas(config, rnd)
+    if areas_off == '*':
+      areas_on = None
+    samples.append((generate_states(plan, rnd), plan.get_targets(areas_off),
+                    plan.get_targets(areas_on)))
+
+  results = {}
+  expected = None
+  for name, engine in engines.items():
+    targets = []
+    started_at = time.perf_counter()
+    for states, targets_off, targets_on in samples:
+      targets.append(engine.route(states, targets_off, targets_on))
+    results[name] = (time.perf_counter() - started_at) / messages * 1e6
+
+    if expected is None:
+      expected = targets
+    elif targets != expected:
+      raise AssertionError(f'{name} targets differ from the plan targets.')
+
+  return results
+
+
+# App configuration variants of the tts benchmark.
+VARIANTS = {
+    'plan': {},
+    'bitset': {
+        'routing_engine': tts.AmazonEcho.ROUTING_ENGINE_BITSET
+    },
+    'mirror': {
+        'state_mirror': {}
+    },
+    'cache': {
+        'routing_cache': {},
+        'state_mirror': {}
+    },
+}
+
+
+def run_tts(areas_count, messages, seed, variant_args, changes=5):
+  """
+    Drive tts() against a fake state backend.
+
+    Parameters:
+      areas_count: The number of synthetic areas.
+      messages: The number of messages to route.
+      seed: The random seed, the same seed produces the same workload.
+      variant_args: The app args overrides.
+      changes: The number of entity state changes between messages.
+
+    Returns:
+      dict: The routing latency percentiles in microseconds, the state lookups
+      and the peak allocated bytes per message.
+  """
+  rnd = random.Random(seed)
+  config = generate_config(areas_count, rnd)
+  config.update(variant_args)
+
+  backend = hass_fake.StateBackend()
+  app = hass_fake.create_app(tts.AmazonEcho, config)
+  backend.install(app)
+  app.configure()
+
+  plan = app.plan
+  for entity_id, state in generate_states(plan, rnd).items():
+    backend.set_state(entity_id, state)
+
+  workload = []
+  for _ in range(messages):
+    areas_off, areas_on = generate_areas(config, rnd)
+    if areas_off == '*':
+      areas_on = None
+    state_changes = [(rnd.choice(plan.entities), rnd.choice(STATES))
+                     for _ in range(changes)]
+    workload.append((state_changes, areas_off, areas_on))
+
+  # Warm up the lazily built structures.
+  app.tts('Warm up')
+
+  latencies = []
+  lookups = 0
+  for state_changes, areas_off, areas_on in workload:
+    for entity_id, state in state_changes:
+      backend.set_state(entity_id, state)
+
+    started_at = time.perf_counter()
+    app.tts('Benchmark', areas_off, areas_on)
+    latencies.append((time.perf_counter() - started_at) * 1e6)
+    lookups += app.state_lookups
+
+  tracemalloc.start()
+  allocated = 0
+  try:
+    for _, areas_off, areas_on in workload:
+      tracemalloc.reset_peak()
+      current, _ = tracemalloc.get_traced_memory()
+      app.tts('Benchmark', areas_off, areas_on)
+      allocated += tracemalloc.get_traced_memory()[1] - current
+  finally:
+    tracemalloc.stop()
+
+  if app.mirror:
+    app.mirror.cancel()
+
+  return {
+      'alloc_bytes': round(allocated / messages),
+      'lookups': round(lookups / messages, 2),
+      'p50_us': round(tts_metrics.get_percentile(latencies, 50), 1),
+      'p99_us': round(tts_metrics.get_percentile(latencies, 99), 1),
+  }
+
+
+def run_engines(args):
+  """Print the routing engines comparison."""
+  print(f'{"areas":>8} {"plan, us":>12} {"bitset, us":>12} {"speedup":>8}')
+  for areas_count in args.areas:
+    results = run(areas_count, args.messages, args.seed)
+    plan = results[tts.AmazonEcho.ROUTING_ENGINE_PLAN]
+    bitset = results[tts.AmazonEcho.ROUTING_ENGINE_BITSET]
+    print(f'{areas_count:>8} {plan:>12.1f} {bitset:>12.1f} '
+          f'{plan / bitset:>7.1f}x')
+
+
+def run_suite(args):
+  """Print the tts benchmark results and save or compare the baseline."""
+  baseline = None
+  if args.compare:
+    with open(args.compare, 'r', encoding='utf-8') as baseline_file:
+      baseline = json.load(baseline_file)['results']
+
+  results = {}
+  print(f'{"areas":>8} {"variant":>8} {"p50, us":>10} {"p99, us":>10} '
+        f'{"lookups":>8} {"alloc, B":>10}')
+  for areas_count in args.areas:
+    for variant in args.variants:
+      stats = run_tts(areas_count, args.messages, args.seed, VARIANTS[variant])
+      results.setdefault(str(areas_count), {})[variant] = stats
+
+      line = (f'{areas_count:>8} {variant:>8} {stats["p50_us"]:>10.1f} '
+              f'{stats["p99_us"]:>10.1f} {stats["lookups"]:>8.2f} '
+              f'{stats["alloc_bytes"]:>10}')
+      try:
+        previous = baseline[str(areas_count)][variant]
+      except (KeyError, TypeError):
+        pass
+      else:
+        line += (f'  p50 {stats["p50_us"] / previous["p50_us"]:.2f}x'
+                 f' p99 {stats["p99_us"] / previous["p99_us"]:.2f}x')
+      print(line)
+
+  if args.save:
+    with open(args.save, 'w', encoding='utf-8') as baseline_file:
+      json.dump(
+          {
+              'meta': {
+                  'messages': args.messages,
+                  'python': platform.python_version(),
+                  'seed': args.seed,
+              },
+              'results': results,
+          },
+          baseline_file,
+          indent=2,
+          sort_keys=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  engines = subparsers.add_parser('engines', help='compare routing engines')
+  engines.add_argument('--areas',
+                       default=(10, 100, 1000, 5000),
+                       nargs='+',
+                       type=int)
+  engines.add_argument('--messages', default=200, type=int)
+  engines.add_argument('--seed', default=42, type=int)
+  engines.set_defaults(func=run_engines)
+
+  suite = subparsers.add_parser('tts', help='benchmark tts() routing')
+  suite.add_argument('--areas',
+                     default=(10, 100, 1000, 10000),
+                     nargs='+',
+                     type=int)
+  suite.add_argument('--compare', help='a baseline file to compare with')
+  suite.add_argument('--messages', default=200, type=int)
+  suite.add_argument('--save', help='a baseline file to save results to')
+  suite.add_argument('--seed', default=42, type=int)
+  suite.add_argument('--variants',
+                     choices=tuple(VARIANTS),
+                     default=tuple(VARIANTS),
+                     nargs='+')
+  suite.set_defaults(func=run_suite)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
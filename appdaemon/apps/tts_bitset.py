@@ -0,0 +1,195 @@
+"""
+Bitset based routing engine for tts.py.
+
+Each routing plan target gets a bit index. Rule conditions, if_not conditions
+and target sets are stored as masks so that routing a message is a sequence
+of mask operations over the current state bitmaps.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+from functools import reduce
+from itertools import compress
+from operator import or_
+
+STATE_ON = 'on'
+STATE_PLAYING = 'playing'
+
+# The binary digits of a bitmap to per target 0/1 flags.
+BINARY_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+class BitsetRouter:
+  """
+  Routing plan compiled into bitmaps.
+
+  A bitmap is a single int over the target space: the media player targets
+  sorted by ID. The targets "Do Not Disturb" switches share the target space
+  bits. Mask operations over all of the targets run in C.
+
+  Each condition entity maps to the OR of its rules target bits and the OR of
+  the target bits its if_not blocks remove, so the rule based targets are an
+  OR over the masks of the conditions that are 'on'.
+  """
+
+  def __init__(self, plan):
+    self.plan = plan
+
+    self.targets = tuple(sorted(plan.targets_all))
+    self.targets_reversed = self.targets[::-1]
+    self.target_bits = {
+        target: 1 << idx for idx, target in enumerate(self.targets)
+    }
+    self.dnd_bits = {
+        plan.get_dnd_switch(target): bit
+        for target, bit in self.target_bits.items()
+    }
+
+    rule_masks = {}
+    for target, conditions in plan.rules:
+      self._add_mask(rule_masks, conditions, self.target_bits[target])
+
+    # The if_not blocks without a target are applied as a single mask unless
+    # an earlier if_not block depends on their rule target. The rest is
+    # evaluated in the config order.
+    if_not = []
+    if_not_masks = {}
+    self.if_not_always = 0
+    depends_on = 0
+    for rule_target, target, conditions in plan.if_not:
+      # The if_not blocks referring to a target outside of the plan never
+      # apply.
+      if target and target not in self.target_bits:
+        continue
+
+      rule_target = self.target_bits[rule_target]
+      target = self.target_bits[target] if target else 0
+      if target or rule_target & depends_on:
+        depends_on |= target
+        if_not.append((rule_target, target, frozenset(conditions)))
+      elif conditions:
+        self._add_mask(if_not_masks, conditions, rule_target)
+      else:
+        self.if_not_always |= rule_target
+    self.if_not = tuple(if_not)
+
+    # Condition entity ID to (rule targets mask, if_not removed targets mask).
+    self.conditions = {
+        entity_id: (rule_masks.get(entity_id, 0),
+                    if_not_masks.get(entity_id, 0))
+        for entity_id in (plan.quite_time, *rule_masks, *if_not_masks,
+                          *(c for _, _, conditions in if_not
+                            for c in conditions))
+    }
+
+    self.targets_all = self.get_bitmap(self.targets)
+    self.play_always_normal_time = self.get_bitmap(
+        plan.play_always_normal_time)
+    self.play_always_quite_time = self.get_bitmap(plan.play_always_quite_time)
+    self.play_default_normal_time = self.get_bitmap(
+        plan.play_default_normal_time)
+    self.play_default_quite_time = self.get_bitmap(
+        plan.play_default_quite_time)
+
+  @staticmethod
+  def _add_mask(masks, conditions, mask):
+    """Add a target space mask to the condition entities masks."""
+    for condition in conditions:
+      masks[condition] = masks.get(condition, 0) | mask
+
+  def get_bitmap(self, targets):
+    """Return a target space bitmap for a set of the plan targets."""
+    return reduce(or_, map(self.target_bits.__getitem__, targets), 0)
+
+  def get_bitmaps(self, states):
+    """
+      Return bitmaps for an entity ID to state mapping.
+
+      Returns:
+        tuple: A set of 'on' condition entities, the target space
+        "Do Not Disturb", 'playing', rule based and if_not removed targets
+        bitmaps.
+      """
+    conditions = self.conditions
+    dnd_bits = self.dnd_bits
+    target_bits = self.target_bits
+
+    on = set()
+    dnd = playing = removed = rules = 0
+    for entity_id, state in states.items():
+      if state == STATE_ON:
+        if entity_id in conditions:
+          on.add(entity_id)
+          rule_mask, if_not_mask = conditions[entity_id]
+          if rule_mask:
+            rules |= rule_mask
+          if if_not_mask:
+            removed |= if_not_mask
+        if entity_id in dnd_bits:
+          dnd |= dnd_bits[entity_id]
+      elif state == STATE_PLAYING and entity_id in target_bits:
+        playing |= target_bits[entity_id]
+
+    return on, dnd, playing, rules, removed
+
+  def get_targets(self, bitmap):
+    """Return a sorted list of targets for a target space bitmap."""
+    flags = format(bitmap, f'0{len(self.targets)}b').encode()
+    targets = list(
+        compress(self.targets_reversed, flags.translate(BINARY_FLAGS)))
+    targets.reverse()
+    return targets
+
+  def route(self, states, targets_off, targets_on):
+    """
+      Evaluate the rules against a state snapshot.
+
+      Parameters:
+        states: An entity ID to state mapping.
+        targets_off: A set of explicitly excluded targets.
+        targets_on: A set of explicitly included targets.
+
+      Returns:
+        list: A sorted list of targets.
+      """
+    on, dnd, playing, targets, removed = self.get_bitmaps(states)
+    target_bits = self.target_bits
+
+    if targets_off is self.plan.targets_all:
+      bitmap_off = self.targets_all
+    else:
+      bitmap_off = self.get_bitmap(t for t in targets_off if t in target_bits)
+
+    # Explicitly included targets may be outside of the plan.
+    bitmap_on = 0
+    targets_extra = []
+    for target in targets_on:
+      if target in target_bits:
+        bitmap_on |= target_bits[target]
+      elif states.get(self.plan.get_dnd_switch(target)) != STATE_ON:
+        targets_extra.append(target)
+
+    if self.plan.quite_time in on:
+      targets = 0
+      play_always = self.play_always_quite_time
+      play_default = self.play_default_quite_time
+    else:
+      targets &= ~(removed | self.if_not_always)
+      for bit, target, conditions in self.if_not:
+        if (targets & bit and (not target or targets & target) and
+            (not conditions or not on.isdisjoint(conditions))):
+          targets &= ~bit
+
+      play_always = self.play_always_normal_time
+      play_default = self.play_default_normal_time
+
+    targets = ((targets | playing | play_always) & ~bitmap_off) | bitmap_on
+    if not targets and not targets_on:
+      targets = play_default & ~bitmap_off
+
+    targets = self.get_targets(targets & ~dnd)
+    if not targets_extra:
+      return targets
+
+    return sorted(targets + targets_extra)
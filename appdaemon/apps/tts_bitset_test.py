@@ -0,0 +1,119 @@
+"""Tests for tts_bitset.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import random
+import unittest
+
+import yaml  # pylint: disable=import-error
+
+import tts
+import tts_benchmark
+import tts_bitset
+
+
+class TestBitsetRouter(unittest.TestCase):
+  """Bitset router tests."""
+
+  def _assert_same_targets(self, config, seed, messages=300):
+    rnd = random.Random(seed)
+    plan = tts.RoutingPlan(config['env'], config['rules'], config['quite_time'])
+    router = tts_bitset.BitsetRouter(plan)
+
+    for _ in range(messages):
+      states = tts_benchmark.generate_states(plan, rnd, rnd.random())
+      if rnd.random() < 0.2:
+        states[plan.quite_time] = tts_bitset.STATE_ON
+      if rnd.random() < 0.2:
+        states['switch.attic_echo_do_not_disturb'] = tts_bitset.STATE_ON
+
+      areas_off, areas_on = tts_benchmark.generate_areas(config, rnd)
+      if areas_off == '*':
+        areas_on = None
+      elif rnd.random() < 0.3:
+        areas_on = ('attic', 'cellar')
+      targets_off = plan.get_targets(areas_off)
+      targets_on = plan.get_targets(areas_on)
+
+      self.assertListEqual(
+          router.route(states, targets_off, targets_on),
+          plan.route(states, targets_off, targets_on),
+      )
+
+  def test_apps_config(self):
+    with open('apps.yaml', 'r', encoding='utf-8') as config_file:
+      config = yaml.safe_load(config_file)['tts']
+
+    self._assert_same_targets(config, 42)
+
+  def test_synthetic_config(self):
+    for areas_count in (1, 3, 29, 30, 31, 100):
+      rnd = random.Random(areas_count)
+      self._assert_same_targets(
+          tts_benchmark.generate_config(areas_count, rnd), areas_count)
+
+  def test_if_not_target_outside_of_plan(self):
+    rules = {
+        'den': {
+            'conditions': ['binary_sensor.den_lights'],
+            'if_not': {
+                'conditions': [],
+                'target': 'media_player.attic_echo',
+            },
+            'target': 'media_player.den_echo',
+        }
+    }
+    plan = tts.RoutingPlan({}, rules, 'binary_sensor.quite_time')
+    router = tts_bitset.BitsetRouter(plan)
+    states = {'binary_sensor.den_lights': tts_bitset.STATE_ON}
+
+    self.assertListEqual(router.route(states, frozenset(), frozenset()),
+                         ['media_player.den_echo'])
+    self.assertListEqual(plan.route(states, frozenset(), frozenset()),
+                         ['media_player.den_echo'])
+
+  def test_if_not_order(self):
+    rules = {
+        'den': {
+            'conditions': ['binary_sensor.den_lights'],
+            'if_not': {
+                'conditions': [],
+                'target': 'media_player.attic_echo',
+            },
+            'target': 'media_player.den_echo',
+        },
+        'attic': {
+            'conditions': ['binary_sensor.attic_lights'],
+            'if_not': {
+                'conditions': ['binary_sensor.attic_door'],
+            },
+            'target': 'media_player.attic_echo',
+        },
+    }
+    plan = tts.RoutingPlan({}, rules, 'binary_sensor.quite_time')
+    router = tts_bitset.BitsetRouter(plan)
+    states = {
+        'binary_sensor.attic_door': tts_bitset.STATE_ON,
+        'binary_sensor.attic_lights': tts_bitset.STATE_ON,
+        'binary_sensor.den_lights': tts_bitset.STATE_ON,
+    }
+
+    # The attic if_not block depends on the den one and can't be a mask.
+    self.assertEqual(len(router.if_not), 2)
+    self.assertListEqual(plan.route(states, frozenset(), frozenset()), [])
+    self.assertListEqual(router.route(states, frozenset(), frozenset()), [])
+
+  def test_bitmaps(self):
+    config = tts_benchmark.generate_config(100, random.Random(0))
+    plan = tts.RoutingPlan(config['env'], config['rules'], config['quite_time'])
+    router = tts_bitset.BitsetRouter(plan)
+
+    self.assertEqual(router.targets_all, (1 << len(plan.targets_all)) - 1)
+    self.assertListEqual(router.get_targets(router.targets_all),
+                         sorted(plan.targets_all))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+"""
+Long message chunking for tts.py.
+
+Splits SSML text at the sentence ends and after the `<break>` and `<audio>`
+tags. The text inside of the other SSML elements, e.g. `<prosody>` or
+`<speak>`, is never split so every chunk stays well-formed.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import tts_duration
+
+BOUNDARY_TAGS = frozenset(('audio', 'break'))
+
+
+def get_boundaries(text):
+  """Yield the positions the text can be split at in ascending order."""
+  depth = 0
+  position = 0
+
+  for match in tts_duration.TAG_RE.finditer(text):
+    if not depth:
+      for sentence in tts_duration.SENTENCE_RE.finditer(
+          text, position, match.start()):
+        yield sentence.end()
+    position = match.end()
+
+    closing, name, _, self_closing = match.groups()
+    name = name.lower()
+    if closing:
+      depth = max(depth - 1, 0)
+      if not depth and name in BOUNDARY_TAGS:
+        yield position
+    elif self_closing or name == 'break':
+      if not depth and name in BOUNDARY_TAGS:
+        yield position
+    else:
+      depth += 1
+
+  if not depth:
+    for sentence in tts_duration.SENTENCE_RE.finditer(text, position):
+      yield sentence.end()
+
+
+def split(text, length):
+  """
+    Split the first chunk of up to `length` characters off the text.
+
+    A first sentence longer than `length` is a chunk on its own.
+
+    Returns:
+      tuple: The first chunk and the rest of the text or None if the text
+      doesn't need or can't be split.
+    """
+  if len(text) <= length:
+    return text, None
+
+  end = len(text.rstrip())
+  position = None
+  for boundary in get_boundaries(text):
+    if boundary >= end or (position is not None and boundary > length):
+      break
+    position = boundary
+
+  if position is None:
+    return text, None
+
+  return text[:position].rstrip(), text[position:].lstrip()
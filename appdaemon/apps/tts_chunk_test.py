@@ -0,0 +1,67 @@
+"""Tests for tts_chunk.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+
+import tts_chunk
+
+
+class TestSplit(unittest.TestCase):
+  """Text chunking tests."""
+
+  def _split_all(self, text, length):
+    chunks = []
+    while text is not None:
+      chunk, text = tts_chunk.split(text, length)
+      chunks.append(chunk)
+    return chunks
+
+  def test_short_text(self):
+    self.assertTupleEqual(tts_chunk.split('One. Two.', 9), ('One. Two.', None))
+
+  def test_sentences(self):
+    self.assertListEqual(
+        self._split_all('One two. Three four! Five six? Seven.', 20),
+        ['One two. Three four!', 'Five six? Seven.'])
+
+  def test_long_sentence(self):
+    self.assertTupleEqual(
+        tts_chunk.split('A rather long first sentence. Short.', 10),
+        ('A rather long first sentence.', 'Short.'))
+
+  def test_no_boundaries(self):
+    self.assertTupleEqual(tts_chunk.split('No sentence end here', 5),
+                          ('No sentence end here', None))
+    self.assertTupleEqual(tts_chunk.split('Single sentence.  ', 5),
+                          ('Single sentence.  ', None))
+
+  def test_ssml_tags(self):
+    text = ('Doorbell <audio src="soundbank://doorbell"/> Front door '
+            '<break time="1s"/> Back door')
+
+    self.assertListEqual(self._split_all(text, 10), [
+        'Doorbell <audio src="soundbank://doorbell"/>',
+        'Front door <break time="1s"/>',
+        'Back door',
+    ])
+
+  def test_ssml_elements(self):
+    text = ('<prosody rate="slow">One. <break time="1s"/> Two.</prosody> '
+            'Three. Four.')
+
+    self.assertListEqual(self._split_all(text, 10), [
+        '<prosody rate="slow">One. <break time="1s"/> Two.</prosody> Three.',
+        'Four.',
+    ])
+
+  def test_speak_element(self):
+    text = '<speak>One. Two. Three.</speak>'
+
+    self.assertTupleEqual(tts_chunk.split(text, 10), (text, None))
+
+
+if __name__ == '__main__':
+  unittest.main()
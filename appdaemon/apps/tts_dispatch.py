@@ -0,0 +1,216 @@
+"""
+Dispatch failure handling for tts.py.
+
+A circuit breaker fails the notify/alexa_media calls fast while the service
+keeps failing, and a bounded retry queue returns the failed messages to the
+message queue with an exponential backoff unless they would expire first.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from threading import Lock
+
+
+class CircuitOpenError(Exception):
+  """The service call is rejected by the open circuit breaker."""
+
+
+class ServiceBusyError(Exception):
+  """All the service call threads are busy with the hung calls."""
+
+
+class CircuitBreaker:
+  """
+  Consecutive failures circuit breaker.
+
+  The breaker opens after `failures` consecutive failed calls and rejects the
+  calls for `reset_time` seconds. Then it lets a single trial call through
+  (half-open) and closes if the call succeeds or opens again otherwise.
+  """
+
+  FAILURES_DEFAULT = 3
+  RESET_TIME_DEFAULT_SECONDS = 60
+
+  STATE_CLOSED = 'closed'
+  STATE_HALF_OPEN = 'half_open'
+  STATE_OPEN = 'open'
+
+  def __init__(self,
+               failures=FAILURES_DEFAULT,
+               reset_time=RESET_TIME_DEFAULT_SECONDS,
+               clock=time.monotonic):
+    """
+      Parameters:
+        failures: The number of consecutive failures opening the breaker.
+        reset_time: The time in seconds before the trial call.
+        clock: A function returning the current time in seconds.
+      """
+    self.clock = clock
+    self.failures = 0
+    self.failures_limit = failures
+    self.lock = Lock()
+    self.opened_at = None
+    self.rejected = 0
+    self.reset_time = reset_time
+    self.state = self.STATE_CLOSED
+    self.trips = 0
+
+  @classmethod
+  def from_config(cls, config, clock=time.monotonic):
+    """Return a breaker for the `circuit_breaker` config value or None."""
+    if config is None:
+      return None
+
+    config = config or {}
+    return cls(config.get('failures', cls.FAILURES_DEFAULT),
+               config.get('reset_time', cls.RESET_TIME_DEFAULT_SECONDS), clock)
+
+  def allow(self):
+    """
+      Check whether a call may proceed.
+
+      Returns:
+        bool: False if the call has to be rejected.
+      """
+    with self.lock:
+      if self.state == self.STATE_CLOSED:
+        return True
+
+      if (self.state == self.STATE_OPEN and
+          self.clock() - self.opened_at >= self.reset_time):
+        self.state = self.STATE_HALF_OPEN
+        return True
+
+      self.rejected += 1
+      return False
+
+  def record_failure(self):
+    """
+      Record a failed call.
+
+      Returns:
+        bool: True if the failure has opened the breaker.
+      """
+    with self.lock:
+      self.failures += 1
+      if (self.state == self.STATE_CLOSED and
+          self.failures < self.failures_limit):
+        return False
+
+      tripped = self.state != self.STATE_OPEN
+      self.opened_at = self.clock()
+      self.state = self.STATE_OPEN
+      if tripped:
+        self.trips += 1
+      return tripped
+
+  def record_success(self):
+    """Record a successful call, close the breaker."""
+    with self.lock:
+      self.failures = 0
+      self.opened_at = None
+      self.state = self.STATE_CLOSED
+
+
+class RetryQueue:
+  """Bounded queue of failed messages waiting for their retry time."""
+
+  ATTEMPTS_DEFAULT = 3
+  BACKOFF_DEFAULT_SECONDS = 5
+  BACKOFF_MAX_SECONDS = 300
+  SIZE_DEFAULT = 20
+
+  OUTCOME_DROPPED_ATTEMPTS = 'dropped_attempts'
+  OUTCOME_DROPPED_EXPIRED = 'dropped_expired'
+  OUTCOME_DROPPED_FULL = 'dropped_full'
+  OUTCOME_REQUEUED = 'requeued'
+  OUTCOME_SCHEDULED = 'scheduled'
+
+  def __init__(self,
+               size=SIZE_DEFAULT,
+               attempts=ATTEMPTS_DEFAULT,
+               backoff=BACKOFF_DEFAULT_SECONDS,
+               backoff_max=BACKOFF_MAX_SECONDS):
+    """
+      Parameters:
+        size: The maximum number of messages waiting for a retry.
+        attempts: The maximum number of retries per message.
+        backoff: The first retry delay in seconds, doubled for each retry.
+        backoff_max: The maximum retry delay in seconds.
+      """
+    self.attempts = attempts
+    self.backoff = backoff
+    self.backoff_max = backoff_max
+    self.counters = defaultdict(int)
+    # A heap of (retry at, sequence number, message) entries.
+    self.entries = []
+    self.lock = Lock()
+    self.sequence = itertools.count()
+    self.size = size
+
+  def __len__(self):
+    return len(self.entries)
+
+  @classmethod
+  def from_config(cls, config):
+    """Return a retry queue for the `retry` config value or None."""
+    if config is None:
+      return None
+
+    config = config or {}
+    return cls(config.get('size', cls.SIZE_DEFAULT),
+               config.get('attempts', cls.ATTEMPTS_DEFAULT),
+               config.get('backoff', cls.BACKOFF_DEFAULT_SECONDS),
+               config.get('backoff_max', cls.BACKOFF_MAX_SECONDS))
+
+  def get_next_at(self):
+    """Return the earliest retry time or None if the queue is empty."""
+    with self.lock:
+      return self.entries[0][0] if self.entries else None
+
+  def pop(self, now):
+    """
+      Remove the messages due for a retry by `now`.
+
+      Returns:
+        list: The messages in the retry time order.
+      """
+    messages = []
+    with self.lock:
+      while self.entries and self.entries[0][0] <= now:
+        messages.append(heapq.heappop(self.entries)[2])
+      self.counters[self.OUTCOME_REQUEUED] += len(messages)
+
+    return messages
+
+  def put(self, message, now):
+    """
+      Schedule the failed message retry.
+
+      Returns:
+        str: The OUTCOME_SCHEDULED outcome or the reason the message was
+        dropped, one of OUTCOME_DROPPED_* values.
+      """
+    attempt = message.get('attempts', 0) + 1
+    retry_at = now + min(self.backoff * 2**(attempt - 1), self.backoff_max)
+
+    with self.lock:
+      if attempt > self.attempts:
+        outcome = self.OUTCOME_DROPPED_ATTEMPTS
+      elif retry_at > message.get('expires_at', retry_at):
+        outcome = self.OUTCOME_DROPPED_EXPIRED
+      elif len(self.entries) >= self.size:
+        outcome = self.OUTCOME_DROPPED_FULL
+      else:
+        message['attempts'] = attempt
+        heapq.heappush(self.entries, (retry_at, next(self.sequence), message))
+        outcome = self.OUTCOME_SCHEDULED
+
+      self.counters[outcome] += 1
+
+    return outcome
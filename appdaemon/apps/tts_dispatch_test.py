@@ -0,0 +1,168 @@
+"""Tests for tts_dispatch.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+
+import tts_dispatch
+
+
+class TestCircuitBreaker(unittest.TestCase):
+  """Circuit breaker tests."""
+
+  def setUp(self):
+    self.now = 0
+    self.breaker = tts_dispatch.CircuitBreaker(failures=2,
+                                               reset_time=10,
+                                               clock=lambda: self.now)
+
+  def _open(self):
+    self.assertFalse(self.breaker.record_failure())
+    self.assertTrue(self.breaker.record_failure())
+
+  def test_from_config(self):
+    self.assertIsNone(tts_dispatch.CircuitBreaker.from_config(None))
+
+    breaker = tts_dispatch.CircuitBreaker.from_config({})
+    self.assertEqual(breaker.failures_limit,
+                     tts_dispatch.CircuitBreaker.FAILURES_DEFAULT)
+    self.assertEqual(breaker.reset_time,
+                     tts_dispatch.CircuitBreaker.RESET_TIME_DEFAULT_SECONDS)
+
+    breaker = tts_dispatch.CircuitBreaker.from_config({
+        'failures': 5,
+        'reset_time': 30
+    })
+    self.assertEqual(breaker.failures_limit, 5)
+    self.assertEqual(breaker.reset_time, 30)
+
+  def test_closed(self):
+    self.assertFalse(self.breaker.record_failure())
+    self.breaker.record_success()
+    self.assertFalse(self.breaker.record_failure())
+
+    self.assertTrue(self.breaker.allow())
+    self.assertEqual(self.breaker.state,
+                     tts_dispatch.CircuitBreaker.STATE_CLOSED)
+
+  def test_open(self):
+    self._open()
+
+    self.assertEqual(self.breaker.state, tts_dispatch.CircuitBreaker.STATE_OPEN)
+    self.now = 9.9
+    self.assertFalse(self.breaker.allow())
+    self.assertEqual(self.breaker.rejected, 1)
+    self.assertEqual(self.breaker.trips, 1)
+
+  def test_half_open_success(self):
+    self._open()
+    self.now = 10
+
+    self.assertTrue(self.breaker.allow())
+    self.assertEqual(self.breaker.state,
+                     tts_dispatch.CircuitBreaker.STATE_HALF_OPEN)
+    # A single trial call at a time.
+    self.assertFalse(self.breaker.allow())
+
+    self.breaker.record_success()
+
+    self.assertEqual(self.breaker.state,
+                     tts_dispatch.CircuitBreaker.STATE_CLOSED)
+    self.assertTrue(self.breaker.allow())
+
+  def test_half_open_failure(self):
+    self._open()
+    self.now = 10
+    self.breaker.allow()
+
+    self.assertTrue(self.breaker.record_failure())
+
+    self.assertEqual(self.breaker.state, tts_dispatch.CircuitBreaker.STATE_OPEN)
+    self.assertEqual(self.breaker.trips, 2)
+    self.now = 19.9
+    self.assertFalse(self.breaker.allow())
+    self.now = 20
+    self.assertTrue(self.breaker.allow())
+
+  def test_failure_while_open(self):
+    self._open()
+
+    self.now = 5
+    self.assertFalse(self.breaker.record_failure())
+
+    self.assertEqual(self.breaker.trips, 1)
+    self.now = 10
+    self.assertFalse(self.breaker.allow())
+
+
+class TestRetryQueue(unittest.TestCase):
+  """Retry queue tests."""
+
+  def setUp(self):
+    self.retries = tts_dispatch.RetryQueue(size=2,
+                                           attempts=3,
+                                           backoff=1,
+                                           backoff_max=3)
+
+  def test_from_config(self):
+    self.assertIsNone(tts_dispatch.RetryQueue.from_config(None))
+
+    retries = tts_dispatch.RetryQueue.from_config({'attempts': 5})
+    self.assertEqual(retries.attempts, 5)
+    self.assertEqual(retries.backoff,
+                     tts_dispatch.RetryQueue.BACKOFF_DEFAULT_SECONDS)
+    self.assertEqual(retries.size, tts_dispatch.RetryQueue.SIZE_DEFAULT)
+
+  def test_backoff(self):
+    message = {'text': 'Test'}
+    retry_times = []
+
+    for _ in range(3):
+      self.assertEqual(self.retries.put(message, 10),
+                       tts_dispatch.RetryQueue.OUTCOME_SCHEDULED)
+      retry_times.append(self.retries.get_next_at())
+      self.assertListEqual(self.retries.pop(20), [message])
+
+    self.assertListEqual(retry_times, [11, 12, 13])
+    self.assertEqual(message['attempts'], 3)
+    self.assertEqual(self.retries.put(message, 10),
+                     tts_dispatch.RetryQueue.OUTCOME_DROPPED_ATTEMPTS)
+
+  def test_pop(self):
+    first = {'text': 'First'}
+    second = {'text': 'Second', 'attempts': 1}
+    self.retries.put(second, 0)
+    self.retries.put(first, 0)
+
+    self.assertListEqual(self.retries.pop(0.5), [])
+    self.assertListEqual(self.retries.pop(1), [first])
+    self.assertEqual(self.retries.get_next_at(), 2)
+    self.assertListEqual(self.retries.pop(2), [second])
+    self.assertIsNone(self.retries.get_next_at())
+    self.assertEqual(
+        self.retries.counters[tts_dispatch.RetryQueue.OUTCOME_REQUEUED], 2)
+
+  def test_expired(self):
+    self.assertEqual(self.retries.put({'expires_at': 0.5}, 0),
+                     tts_dispatch.RetryQueue.OUTCOME_DROPPED_EXPIRED)
+    self.assertEqual(self.retries.put({'expires_at': 1}, 0),
+                     tts_dispatch.RetryQueue.OUTCOME_SCHEDULED)
+
+  def test_full(self):
+    for idx in range(2):
+      self.retries.put({'text': str(idx)}, 0)
+
+    self.assertEqual(self.retries.put({'text': '2'}, 0),
+                     tts_dispatch.RetryQueue.OUTCOME_DROPPED_FULL)
+    self.assertEqual(len(self.retries), 2)
+    self.assertDictEqual(
+        dict(self.retries.counters), {
+            tts_dispatch.RetryQueue.OUTCOME_DROPPED_FULL: 1,
+            tts_dispatch.RetryQueue.OUTCOME_SCHEDULED: 2,
+        })
+
+
+if __name__ == '__main__':
+  unittest.main()
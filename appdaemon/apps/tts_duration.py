@@ -0,0 +1,260 @@
+"""
+Speech duration estimation for tts.py.
+
+Estimates how long a message takes to play based on its SSML markup: spoken
+words at the voice speaking rate, `<break>` pauses, `<audio>` clip lengths,
+`<say-as>` spelled out content, `<sub>` aliases and `<prosody>` rate changes.
+The speaking rate can be calibrated per voice from measured playback times.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import re
+from collections import OrderedDict
+from threading import Lock
+
+ATTRIBUTE_RE = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+CLAUSE_RE = re.compile(r'[,;:]')
+SENTENCE_RE = re.compile(r'[.!?]+(?=\s|$)')
+TAG_RE = re.compile(r'<\s*(/?)\s*([\w:-]+)([^>]*?)(/?)\s*>')
+TIME_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s)\s*$')
+WORD_RE = re.compile(r"\w[\w'-]*")
+
+
+class DurationEstimator:
+  """SSML aware speech duration estimator."""
+
+  AUDIO_DURATION_DEFAULT_SECONDS = 2
+  AUDIO_DURATIONS = {
+      'soundbank://soundlibrary/alarms/beeps_and_bloops/tone_05': 1,
+      'soundbank://soundlibrary/home/amzn_sfx_doorbell_chime_02': 3,
+  }
+  BREAK_MAX_SECONDS = 10
+  BREAK_STRENGTHS = {
+      'none': 0,
+      'x-weak': 0,
+      'weak': 0.25,
+      'medium': 0.5,
+      'strong': 0.75,
+      'x-strong': 1,
+  }
+  CACHE_SIZE_DEFAULT = 512
+  CALIBRATION_WEIGHT = 0.2
+  CLAUSE_PAUSE_SECONDS = 0.2
+  PROSODY_RATES = {
+      'x-slow': 0.5,
+      'slow': 0.75,
+      'medium': 1,
+      'fast': 1.25,
+      'x-fast': 1.5,
+  }
+  SAY_AS_SPELLED = frozenset(('characters', 'digits', 'spell-out',
+                              'telephone'))
+  SENTENCE_PAUSE_SECONDS = 0.4
+  WORDS_PER_SECOND_DEFAULT = 2.5
+
+  def __init__(self,
+               words_per_second=WORDS_PER_SECOND_DEFAULT,
+               audio_durations=None,
+               voices=None,
+               size=CACHE_SIZE_DEFAULT):
+    """
+      Parameters:
+        words_per_second: The default voice speaking rate.
+        audio_durations: An audio clip source to duration in seconds mapping.
+          Extends the known clip durations.
+        voices: A voice name to speaking rate mapping.
+        size: The maximum number of memoized texts.
+      """
+    self.audio_durations = dict(self.AUDIO_DURATIONS)
+    self.audio_durations.update(audio_durations or {})
+    self.calibrations = 0
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.lock = Lock()
+    self.misses = 0
+    self.size = size
+    self.voices = dict(voices or {})
+    self.words_per_second = words_per_second
+
+  def calibrate(self, text, seconds, voice=None):
+    """
+      Adjust the voice speaking rate using a measured playback time.
+
+      Parameters:
+        text: The played text.
+        seconds: The measured playback time.
+        voice: The voice name, None for the default voice.
+
+      Returns:
+        float: The adjusted speaking rate in words per second.
+      """
+    words, pauses = self.parse(text)
+    words_per_second = self.get_words_per_second(voice)
+    if not words or seconds <= pauses:
+      return words_per_second
+
+    words_per_second += self.CALIBRATION_WEIGHT * (
+        words / (seconds - pauses) - words_per_second)
+    if voice is None:
+      self.words_per_second = words_per_second
+    else:
+      self.voices[voice] = words_per_second
+    self.calibrations += 1
+
+    return words_per_second
+
+  def estimate(self, text, voice=None):
+    """
+      Return the text playback duration in seconds.
+
+      Parameters:
+        text: A text to play, may contain SSML tags.
+        voice: The voice name, None for the default voice.
+      """
+    words, pauses = self.parse(text)
+    return round(pauses + words / self.get_words_per_second(voice), 1)
+
+  def get_audio_duration(self, src):
+    """Return the audio clip duration in seconds."""
+    return self.audio_durations.get(src, self.AUDIO_DURATION_DEFAULT_SECONDS)
+
+  def get_break_duration(self, attributes):
+    """Return the `<break>` tag duration in seconds."""
+    match = TIME_RE.match(attributes.get('time', ''))
+    if match:
+      value, unit = match.groups()
+      seconds = float(value) / (1000 if unit == 'ms' else 1)
+    else:
+      seconds = self.BREAK_STRENGTHS.get(attributes.get('strength'),
+                                         self.BREAK_STRENGTHS['medium'])
+
+    return min(seconds, self.BREAK_MAX_SECONDS)
+
+  def get_words_per_second(self, voice=None):
+    """Return the voice speaking rate."""
+    if voice is None:
+      return self.words_per_second
+
+    return self.voices.get(voice, self.words_per_second)
+
+  @staticmethod
+  def get_attributes(attributes):
+    """Return a tag attribute name to value mapping."""
+    return {
+        name: double_quoted or single_quoted
+        for name, double_quoted, single_quoted in ATTRIBUTE_RE.findall(
+            attributes)
+    }
+
+  def get_prosody_rate(self, rate):
+    """Return the `<prosody>` rate as a speaking rate multiplier."""
+    if rate is None:
+      return None
+
+    rate = rate.strip()
+    if rate.endswith('%'):
+      try:
+        return max(float(rate[:-1]), 20) / 100
+      except ValueError:
+        return None
+
+    return self.PROSODY_RATES.get(rate)
+
+  def parse(self, text):
+    """
+      Return the text speech workload, memoized per text.
+
+      Returns:
+        tuple: The number of words normalized to the default speaking rate
+        and the voice independent duration (pauses and audio) in seconds.
+      """
+    with self.lock:
+      try:
+        result = self.entries[text]
+      except KeyError:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.entries.move_to_end(text)
+        return result
+
+    result = self._parse(text)
+    with self.lock:
+      self.entries[text] = result
+      if len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+    return result
+
+  def _count(self, text, spelled):
+    """Return the number of words and the punctuation pauses for text."""
+    if spelled:
+      return sum(c.isalnum() for c in text), 0
+
+    pauses = (len(SENTENCE_RE.findall(text)) * self.SENTENCE_PAUSE_SECONDS +
+              len(CLAUSE_RE.findall(text)) * self.CLAUSE_PAUSE_SECONDS)
+    return len(WORD_RE.findall(text)), pauses
+
+  def _parse(self, text):
+    """Walk the SSML text and sum up its words and pauses."""
+    pauses = 0
+    text = text or ''
+    words = 0
+
+    # A stack of (tag name, speaking rate multiplier, spelled out, muted).
+    stack = [(None, 1, False, False)]
+
+    position = 0
+    for match in TAG_RE.finditer(text):
+      _, rate, spelled, muted = stack[-1]
+      if not muted:
+        segment_words, segment_pauses = self._count(
+            text[position:match.start()], spelled)
+        words += segment_words / rate
+        pauses += segment_pauses
+      position = match.end()
+
+      closing, name, attributes, self_closing = match.groups()
+      name = name.lower()
+      if closing:
+        for idx in range(len(stack) - 1, 0, -1):
+          if stack[idx][0] == name:
+            del stack[idx:]
+            break
+        continue
+
+      attributes = self.get_attributes(attributes)
+      if muted:
+        pass
+      elif name == 'audio':
+        pauses += self.get_audio_duration(attributes.get('src'))
+      elif name == 'break':
+        pauses += self.get_break_duration(attributes)
+      elif name == 'sub':
+        alias_words, alias_pauses = self._count(attributes.get('alias', ''),
+                                                spelled)
+        words += alias_words / rate
+        pauses += alias_pauses
+        muted = True
+
+      if self_closing or name == 'break':
+        continue
+
+      # The audio tag content is played only if the audio is unavailable.
+      if name == 'audio':
+        muted = True
+      elif name == 'prosody':
+        rate *= self.get_prosody_rate(attributes.get('rate')) or 1
+      elif name == 'say-as':
+        spelled = attributes.get('interpret-as') in self.SAY_AS_SPELLED
+      stack.append((name, rate, spelled, muted))
+
+    _, rate, spelled, muted = stack[-1]
+    if not muted:
+      segment_words, segment_pauses = self._count(text[position:], spelled)
+      words += segment_words / rate
+      pauses += segment_pauses
+
+    return words, pauses
@@ -0,0 +1,138 @@
+"""Tests for tts_duration.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+
+import tts_duration
+
+TONE_05 = ('<audio src="soundbank://soundlibrary/alarms/beeps_and_bloops/'
+           'tone_05"/>')
+
+
+class TestDurationEstimator(unittest.TestCase):
+  """Duration estimator tests."""
+
+  def setUp(self):
+    self.estimator = tts_duration.DurationEstimator(words_per_second=2)
+
+  def test_words(self):
+    self.assertEqual(self.estimator.parse('One two three four'), (4, 0))
+    self.assertEqual(self.estimator.estimate('One two three four'), 2)
+
+  def test_punctuation_pauses(self):
+    words, pauses = self.estimator.parse('One, two. Three!')
+
+    self.assertEqual(words, 3)
+    self.assertAlmostEqual(
+        pauses, tts_duration.DurationEstimator.CLAUSE_PAUSE_SECONDS +
+        2 * tts_duration.DurationEstimator.SENTENCE_PAUSE_SECONDS)
+
+  def test_break(self):
+    for text, pauses in (
+        ('<break time="350ms"/>', 0.35),
+        ('<break time="2s"/>', 2),
+        ("<break time='1.5s'/>", 1.5),
+        ('<break time="30s"/>', 10),
+        ('<break strength="strong"/>', 0.75),
+        ('<break/>', 0.5),
+    ):
+      self.assertEqual(self.estimator.parse(text), (0, pauses), text)
+
+  def test_audio(self):
+    self.assertEqual(self.estimator.parse(f'{TONE_05}Garage'), (1, 1))
+    self.assertEqual(self.estimator.parse('<audio src="unknown"/>'),
+                     (0, tts_duration.DurationEstimator.
+                      AUDIO_DURATION_DEFAULT_SECONDS))
+    self.assertEqual(
+        self.estimator.parse(
+            '<audio src="soundbank://soundlibrary/alarms/beeps_and_bloops/'
+            'tone_05">Fallback text</audio> Garage'), (1, 1))
+
+  def test_audio_durations(self):
+    estimator = tts_duration.DurationEstimator(audio_durations={'clip': 5})
+
+    self.assertEqual(estimator.parse('<audio src="clip"/>'), (0, 5))
+    self.assertEqual(estimator.parse(TONE_05), (0, 1))
+
+  def test_say_as(self):
+    self.assertEqual(
+        self.estimator.parse(
+            'Code <say-as interpret-as="digits">1234</say-as> ok'), (6, 0))
+    self.assertEqual(
+        self.estimator.parse(
+            '<say-as interpret-as="cardinal">1234</say-as>'), (1, 0))
+
+  def test_sub(self):
+    self.assertEqual(
+        self.estimator.parse('<sub alias="World Wide Web">WWW</sub>'), (3, 0))
+
+  def test_prosody_rate(self):
+    for rate, words in (
+        ('x-slow', 4),
+        ('slow', 8 / 3),
+        ('fast', 1.6),
+        ('200%', 1),
+        ('unknown', 2),
+    ):
+      self.assertAlmostEqual(
+          self.estimator.parse(
+              f'<prosody rate="{rate}">One two</prosody>')[0], words, msg=rate)
+
+    self.assertAlmostEqual(
+        self.estimator.parse('<prosody rate="x-slow"><prosody rate="200%">'
+                             'One two</prosody> three</prosody> four')[0], 5)
+
+  def test_prosody_pitch(self):
+    self.assertEqual(
+        self.estimator.parse(
+            'Still open. <break time="350ms"/><prosody pitch="x-low">I\'m '
+            'just saying</prosody>'), (5, 0.75))
+
+  def test_empty_text(self):
+    self.assertEqual(self.estimator.estimate(''), 0)
+    self.assertEqual(self.estimator.estimate(None), 0)
+
+  def test_memoized(self):
+    for _ in range(3):
+      self.estimator.estimate('One two')
+
+    self.assertEqual((self.estimator.hits, self.estimator.misses), (2, 1))
+
+  def test_memoized_size(self):
+    estimator = tts_duration.DurationEstimator(size=2)
+    for text in ('One', 'Two', 'One', 'Three'):
+      estimator.estimate(text)
+
+    self.assertListEqual(list(estimator.entries), ['One', 'Three'])
+
+  def test_calibrate(self):
+    text = f'{TONE_05}One two three four'
+
+    for _ in range(50):
+      self.estimator.calibrate(text, 2)
+
+    self.assertAlmostEqual(self.estimator.words_per_second, 4, places=2)
+    self.assertAlmostEqual(self.estimator.estimate(text), 2)
+    self.assertEqual(self.estimator.calibrations, 50)
+
+  def test_calibrate_voice(self):
+    self.estimator.calibrate('One two three four', 1, voice='fast')
+
+    self.assertGreater(self.estimator.get_words_per_second('fast'), 2)
+    self.assertEqual(self.estimator.get_words_per_second(), 2)
+    self.assertLess(self.estimator.estimate('One two three four', 'fast'),
+                    self.estimator.estimate('One two three four'))
+
+  def test_calibrate_ignores_invalid_measurements(self):
+    self.estimator.calibrate(TONE_05, 5)
+    self.estimator.calibrate(f'{TONE_05}One', 0.5)
+
+    self.assertEqual(self.estimator.words_per_second, 2)
+    self.assertEqual(self.estimator.calibrations, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,340 @@
+"""
+Metrics for tts.py and mp_volume.py.
+
+Fixed bucket histograms, rolling histograms over a sliding time window and a
+per app registry of span histograms and counters. The registry exports them as
+Home Assistant sensor states and in the Prometheus text format for the node
+exporter textfile collector.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import bisect
+import os
+import time
+from collections import defaultdict, deque
+from threading import Lock
+
+
+def get_percentile(values, percentile):
+  """Return the nearest rank percentile of the values."""
+  values = sorted(values)
+  return values[max(0, round(percentile / 100 * len(values)) - 1)]
+
+
+class Histogram:
+  """Fixed bucket histogram."""
+
+  BUCKETS_DEFAULT = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+  def __init__(self, buckets=BUCKETS_DEFAULT):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.max = 0
+    self.sum = 0
+
+  def add(self, value):
+    """Add a value to the histogram."""
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.max = max(self.max, value)
+    self.sum += value
+
+  def merge(self, other):
+    """Add the values of a histogram with the same buckets."""
+    self.counts = [
+        count + other_count
+        for count, other_count in zip(self.counts, other.counts)
+    ]
+    self.count += other.count
+    self.max = max(self.max, other.max)
+    self.sum += other.sum
+
+  def quantile(self, quantile):
+    """Return the upper bound of the bucket containing the quantile value."""
+    if not self.count:
+      return 0
+
+    rank = quantile * self.count
+    total = 0
+    for idx, count in enumerate(self.counts):
+      total += count
+      if total >= rank and count:
+        return self.buckets[idx] if idx < len(self.buckets) else self.max
+
+    return self.max
+
+
+class RollingHistogram:
+  """Histogram of the values added within the last `window` seconds."""
+
+  SLOTS = 10
+
+  def __init__(self,
+               window,
+               buckets=Histogram.BUCKETS_DEFAULT,
+               clock=time.monotonic,
+               slots=SLOTS):
+    """
+      Parameters:
+        window: The sliding window length in seconds.
+        buckets: The histogram bucket upper bounds.
+        clock: A function returning the current time in seconds.
+        slots: The number of sub-histograms the window is split into.
+      """
+    self.buckets = tuple(buckets)
+    self.clock = clock
+    self.slot_seconds = window / slots
+    # (slot number, histogram) pairs in the time order.
+    self.slots = deque()
+    self.slots_max = slots
+
+  def _expire(self, slot):
+    """Drop the sub-histograms older than the window."""
+    while self.slots and self.slots[0][0] <= slot - self.slots_max:
+      self.slots.popleft()
+
+  def add(self, value):
+    """Add a value to the current sub-histogram."""
+    slot = int(self.clock() // self.slot_seconds)
+    if not self.slots or self.slots[-1][0] != slot:
+      self.slots.append((slot, Histogram(self.buckets)))
+      self._expire(slot)
+    self.slots[-1][1].add(value)
+
+  def get(self):
+    """Return a histogram of the values within the window."""
+    self._expire(int(self.clock() // self.slot_seconds))
+
+    histogram = Histogram(self.buckets)
+    for _, slot_histogram in self.slots:
+      histogram.merge(slot_histogram)
+
+    return histogram
+
+
+class Metrics:
+  """
+  Span histograms and counters of an app.
+
+  Each span (e.g. the message routing time) is aggregated into a rolling
+  histogram. The span totals and the counters are kept since the app start.
+  The labeled histograms are histograms kept by the app components since the
+  app start (e.g. the queue wait times by priority).
+  """
+
+  INTERVAL_DEFAULT_SECONDS = 60
+  LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+                     0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+  LOOKUP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+  QUANTILES = (0.5, 0.9, 0.99)
+  WINDOW_DEFAULT_SECONDS = 300
+
+  # pylint: disable=too-many-arguments
+  def __init__(self,
+               prefix,
+               window=WINDOW_DEFAULT_SECONDS,
+               buckets=None,
+               clock=time.monotonic,
+               path=None,
+               interval=INTERVAL_DEFAULT_SECONDS):
+    """
+      Parameters:
+        prefix: The sensor entity and Prometheus metric name prefix.
+        window: The rolling histograms window in seconds.
+        buckets: A span name to histogram buckets mapping.
+        clock: A function returning the current time in seconds.
+        path: The Prometheus textfile path, None disables the export.
+        interval: The publishing interval in seconds.
+      """
+    self.buckets = dict(buckets or {})
+    self.clock = clock
+    self.counters = defaultdict(int)
+    self.gauges = {}
+    self.histograms = {}
+    # A name to (label, label value to histogram mapping) mapping.
+    self.labeled_histograms = {}
+    self.interval = interval
+    self.lock = Lock()
+    self.path = path
+    self.prefix = prefix
+    # A span name to [count, sum] of all observed values.
+    self.totals = defaultdict(lambda: [0, 0])
+    self.window = window
+
+  @classmethod
+  def from_config(cls, prefix, config, config_dir, buckets=None,
+                  clock=time.monotonic):
+    """
+      Return the app metrics for the `metrics` config value.
+
+      Parameters:
+        prefix: The sensor entity and Prometheus metric name prefix.
+        config: The `metrics` config value, None disables the metrics.
+        config_dir: The AppDaemon config directory for relative paths.
+        buckets: A span name to histogram buckets mapping.
+        clock: A function returning the current time in seconds.
+
+      Returns:
+        Metrics: The app metrics or None if the metrics are disabled.
+      """
+    if config is None:
+      return None
+
+    config = config or {}
+    path = config.get('prometheus')
+    return cls(prefix, config.get('window', cls.WINDOW_DEFAULT_SECONDS),
+               buckets, clock, path and os.path.join(config_dir, path),
+               config.get('interval', cls.INTERVAL_DEFAULT_SECONDS))
+
+  def increment(self, name, value=1):
+    """Increment a counter."""
+    with self.lock:
+      self.counters[name] += value
+
+  def observe(self, name, value):
+    """Add a span value to its rolling histogram."""
+    with self.lock:
+      try:
+        histogram = self.histograms[name]
+      except KeyError:
+        histogram = self.histograms[name] = RollingHistogram(
+            self.window, self.buckets.get(name, Histogram.BUCKETS_DEFAULT),
+            self.clock)
+      histogram.add(value)
+
+      totals = self.totals[name]
+      totals[0] += 1
+      totals[1] += value
+
+  def publish(self, set_state):
+    """Set the sensor states using `set_state` and write the textfile."""
+    for entity_id, (state, attributes) in self.get_sensors().items():
+      set_state(entity_id, state=state, attributes=attributes)
+
+    if self.path:
+      self.write_prometheus()
+
+  def set_gauge(self, name, value):
+    """Set a gauge value."""
+    with self.lock:
+      self.gauges[name] = value
+
+  def set_histograms(self, name, label, histograms):
+    """
+      Set labeled histograms to copies of the histograms.
+
+      Parameters:
+        name: The metric name.
+        label: The label name, e.g. 'priority'.
+        histograms: A label value to histogram mapping.
+      """
+    copies = {}
+    for value, histogram in list(histograms.items()):
+      copies[value] = Histogram(histogram.buckets)
+      copies[value].merge(histogram)
+
+    with self.lock:
+      self.labeled_histograms[name] = (label, copies)
+
+  def get_attributes(self, histogram):
+    """Return the histogram quantiles, maximum and number of values."""
+    attributes = {
+        f'p{round(quantile * 100)}': histogram.quantile(quantile)
+        for quantile in self.QUANTILES
+    }
+    attributes.update({
+        'count': histogram.count,
+        'max': round(histogram.max, 6),
+    })
+    return attributes
+
+  def get_sensors(self):
+    """
+      Return the sensor states.
+
+      The span sensor state is the window median, the other quantiles, the
+      maximum and the number of values are its attributes. A labeled
+      histograms sensor is the same for all label values without the window,
+      its label attribute maps the label values to their histogram
+      attributes. The counter and gauge sensor states are their values.
+
+      Returns:
+        dict: A sensor entity ID to (state, attributes) mapping.
+      """
+    sensors = {}
+    with self.lock:
+      for name, rolling_histogram in self.histograms.items():
+        attributes = self.get_attributes(rolling_histogram.get())
+        attributes['window'] = self.window
+        sensors[f'sensor.{self.prefix}_{name}'] = (attributes['p50'],
+                                                   attributes)
+
+      for name, (label, histograms) in self.labeled_histograms.items():
+        merged = None
+        for histogram in histograms.values():
+          if merged is None:
+            merged = Histogram(histogram.buckets)
+          merged.merge(histogram)
+        attributes = self.get_attributes(merged or Histogram())
+        attributes[label] = {
+            str(value): self.get_attributes(histogram)
+            for value, histogram in sorted(histograms.items())
+        }
+        sensors[f'sensor.{self.prefix}_{name}'] = (attributes['p50'],
+                                                   attributes)
+
+      for name, value in (*self.counters.items(), *self.gauges.items()):
+        sensors[f'sensor.{self.prefix}_{name}'] = (value, {})
+
+    return sensors
+
+  def to_prometheus(self):
+    """Return the metrics in the Prometheus text exposition format."""
+    lines = []
+    with self.lock:
+      for name in sorted(self.histograms):
+        metric = f'{self.prefix}_{name}'
+        histogram = self.histograms[name].get()
+        count, total = self.totals[name]
+
+        lines.append(f'# TYPE {metric} summary')
+        lines.extend(f'{metric}{{quantile="{quantile}"}} '
+                     f'{histogram.quantile(quantile)}'
+                     for quantile in self.QUANTILES)
+        lines.append(f'{metric}_sum {total}')
+        lines.append(f'{metric}_count {count}')
+
+      for name in sorted(self.labeled_histograms):
+        metric = f'{self.prefix}_{name}'
+        label, histograms = self.labeled_histograms[name]
+
+        lines.append(f'# TYPE {metric} summary')
+        for value, histogram in sorted(histograms.items()):
+          labels = f'{label}="{value}"'
+          lines.extend(f'{metric}{{{labels},quantile="{quantile}"}} '
+                       f'{histogram.quantile(quantile)}'
+                       for quantile in self.QUANTILES)
+          lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+          lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+
+      for name in sorted(self.counters):
+        metric = f'{self.prefix}_{name}_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {self.counters[name]}')
+
+      for name in sorted(self.gauges):
+        metric = f'{self.prefix}_{name}'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {self.gauges[name]}')
+
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self):
+    """Replace the Prometheus textfile atomically."""
+    path = f'{self.path}.tmp'
+    with open(path, 'w', encoding='utf-8') as prometheus_file:
+      prometheus_file.write(self.to_prometheus())
+    os.replace(path, self.path)
@@ -0,0 +1,224 @@
+"""Tests for tts_metrics.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import tts_metrics
+
+
+class TestHistogram(unittest.TestCase):
+  """Histogram tests."""
+
+  def test_empty(self):
+    histogram = tts_metrics.Histogram()
+
+    self.assertEqual(histogram.count, 0)
+    self.assertEqual(histogram.quantile(0.5), 0)
+
+  def test_quantile(self):
+    histogram = tts_metrics.Histogram((1, 2, 5))
+    for value in (0.5, 0.7, 1.5, 3, 4, 4.5, 7):
+      histogram.add(value)
+
+    self.assertListEqual(histogram.counts, [2, 1, 3, 1])
+    self.assertEqual(histogram.count, 7)
+    self.assertEqual(histogram.max, 7)
+    self.assertAlmostEqual(histogram.sum, 21.2)
+    self.assertEqual(histogram.quantile(0.25), 1)
+    self.assertEqual(histogram.quantile(0.5), 5)
+    self.assertEqual(histogram.quantile(0.99), 7)
+
+  def test_merge(self):
+    histogram = tts_metrics.Histogram((1, 2))
+    other = tts_metrics.Histogram((1, 2))
+    for value in (0.5, 1.5):
+      histogram.add(value)
+    other.add(3)
+
+    histogram.merge(other)
+
+    self.assertListEqual(histogram.counts, [1, 1, 1])
+    self.assertEqual(histogram.count, 3)
+    self.assertEqual(histogram.max, 3)
+    self.assertAlmostEqual(histogram.sum, 5)
+
+
+class TestGetPercentile(unittest.TestCase):
+  """Percentile tests."""
+
+  def test_get_percentile(self):
+    values = list(range(100, 0, -1))
+
+    self.assertEqual(tts_metrics.get_percentile(values, 50), 50)
+    self.assertEqual(tts_metrics.get_percentile(values, 99), 99)
+    self.assertEqual(tts_metrics.get_percentile(values, 100), 100)
+    self.assertEqual(tts_metrics.get_percentile([7], 1), 7)
+
+
+class TestRollingHistogram(unittest.TestCase):
+  """Rolling histogram tests."""
+
+  def setUp(self):
+    self.now = 0
+    self.histogram = tts_metrics.RollingHistogram(60, (1, 2),
+                                                  clock=lambda: self.now)
+
+  def test_window(self):
+    for self.now, value in ((0, 0.5), (30, 1.5), (55, 3)):
+      self.histogram.add(value)
+
+    self.assertListEqual(self.histogram.get().counts, [1, 1, 1])
+
+    self.now = 65
+    self.assertListEqual(self.histogram.get().counts, [0, 1, 1])
+
+    self.now = 120
+    self.assertEqual(self.histogram.get().count, 0)
+
+  def test_slots(self):
+    for self.now in range(0, 600, 5):
+      self.histogram.add(1)
+
+    self.assertLessEqual(len(self.histogram.slots), 10)
+    self.assertEqual(self.histogram.get().count, 12)
+
+
+class TestMetrics(unittest.TestCase):
+  """App metrics tests."""
+
+  def setUp(self):
+    self.metrics = tts_metrics.Metrics(
+        'tts', buckets={'routing_seconds': (0.001, 0.01)})
+
+  def test_from_config(self):
+    self.assertIsNone(tts_metrics.Metrics.from_config('tts', None, '/config'))
+
+    metrics = tts_metrics.Metrics.from_config('tts', {}, '/config')
+    self.assertEqual(metrics.window,
+                     tts_metrics.Metrics.WINDOW_DEFAULT_SECONDS)
+    self.assertEqual(metrics.interval,
+                     tts_metrics.Metrics.INTERVAL_DEFAULT_SECONDS)
+    self.assertIsNone(metrics.path)
+
+    metrics = tts_metrics.Metrics.from_config('tts', {
+        'interval': 10,
+        'prometheus': 'tts.prom',
+        'window': 60,
+    }, '/config')
+    self.assertEqual(metrics.interval, 10)
+    self.assertEqual(metrics.path, '/config/tts.prom')
+    self.assertEqual(metrics.window, 60)
+
+  def test_get_sensors(self):
+    for value in (0.0005, 0.005, 0.005):
+      self.metrics.observe('routing_seconds', value)
+    self.metrics.increment('dispatched', 2)
+    self.metrics.set_gauge('queue_depth', 3)
+
+    self.assertDictEqual(
+        self.metrics.get_sensors(), {
+            'sensor.tts_routing_seconds': (0.01, {
+                'count': 3,
+                'max': 0.005,
+                'p50': 0.01,
+                'p90': 0.01,
+                'p99': 0.01,
+                'window': 300,
+            }),
+            'sensor.tts_dispatched': (2, {}),
+            'sensor.tts_queue_depth': (3, {}),
+        })
+
+  def test_to_prometheus(self):
+    self.metrics.observe('wait_seconds', 2)
+    self.metrics.observe('wait_seconds', 4)
+    self.metrics.increment('dispatched')
+    self.metrics.set_gauge('queue_depth', 1)
+
+    self.assertEqual(
+        self.metrics.to_prometheus(), '# TYPE tts_wait_seconds summary\n'
+        'tts_wait_seconds{quantile="0.5"} 2.5\n'
+        'tts_wait_seconds{quantile="0.9"} 5\n'
+        'tts_wait_seconds{quantile="0.99"} 5\n'
+        'tts_wait_seconds_sum 6\n'
+        'tts_wait_seconds_count 2\n'
+        '# TYPE tts_dispatched_total counter\n'
+        'tts_dispatched_total 1\n'
+        '# TYPE tts_queue_depth gauge\n'
+        'tts_queue_depth 1\n')
+
+  def test_set_histograms(self):
+    histograms = {
+        -1: tts_metrics.Histogram((1, 10)),
+        0: tts_metrics.Histogram((1, 10)),
+    }
+    histograms[-1].add(0.5)
+    for value in (2, 4):
+      histograms[0].add(value)
+
+    self.metrics.set_histograms('queue_wait_seconds', 'priority', histograms)
+    histograms[0].add(20)
+
+    self.assertDictEqual(
+        self.metrics.get_sensors(), {
+            'sensor.tts_queue_wait_seconds': (10, {
+                'count': 3,
+                'max': 4,
+                'p50': 10,
+                'p90': 10,
+                'p99': 10,
+                'priority': {
+                    '-1': {
+                        'count': 1,
+                        'max': 0.5,
+                        'p50': 1,
+                        'p90': 1,
+                        'p99': 1,
+                    },
+                    '0': {
+                        'count': 2,
+                        'max': 4,
+                        'p50': 10,
+                        'p90': 10,
+                        'p99': 10,
+                    },
+                },
+            }),
+        })
+    self.assertEqual(
+        self.metrics.to_prometheus(), '# TYPE tts_queue_wait_seconds summary\n'
+        'tts_queue_wait_seconds{priority="-1",quantile="0.5"} 1\n'
+        'tts_queue_wait_seconds{priority="-1",quantile="0.9"} 1\n'
+        'tts_queue_wait_seconds{priority="-1",quantile="0.99"} 1\n'
+        'tts_queue_wait_seconds_sum{priority="-1"} 0.5\n'
+        'tts_queue_wait_seconds_count{priority="-1"} 1\n'
+        'tts_queue_wait_seconds{priority="0",quantile="0.5"} 10\n'
+        'tts_queue_wait_seconds{priority="0",quantile="0.9"} 10\n'
+        'tts_queue_wait_seconds{priority="0",quantile="0.99"} 10\n'
+        'tts_queue_wait_seconds_sum{priority="0"} 6\n'
+        'tts_queue_wait_seconds_count{priority="0"} 2\n')
+
+  def test_publish(self):
+    set_state = mock.Mock()
+    self.metrics.increment('dispatched')
+
+    with tempfile.TemporaryDirectory() as directory:
+      self.metrics.path = os.path.join(directory, 'tts.prom')
+      self.metrics.publish(set_state)
+
+      with open(self.metrics.path, 'r', encoding='utf-8') as prometheus_file:
+        self.assertIn('tts_dispatched_total 1', prometheus_file.read())
+
+    set_state.assert_called_once_with('sensor.tts_dispatched',
+                                      state=1,
+                                      attributes={})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+"""
+Sampling profiler for tts.py.
+
+Periodically samples the stacks of the threads running the app entry points
+(the worker and the event callbacks) and aggregates them into the collapsed
+stack format read by flamegraph.pl, speedscope and similar tools:
+
+  worker (tts.py:340);schedule (tts_scheduler.py:276);route (tts.py:280) 42
+
+Nothing is installed into the app code paths, the sampler thread only exists
+while a profile is being recorded.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import os
+import sys
+import time
+from collections import defaultdict
+from threading import Event
+
+
+class SamplingProfiler:
+  """Collapsed stacks sampling profiler."""
+
+  DURATION_DEFAULT_SECONDS = 30
+  DURATION_MAX_SECONDS = 600
+  INTERVAL_DEFAULT_SECONDS = 0.01
+
+  def __init__(self, entries, interval=INTERVAL_DEFAULT_SECONDS):
+    """
+      Parameters:
+        entries: The code objects of the profiled entry points. A thread stack
+          is sampled from the outermost entry point frame, the threads outside
+          of the entry points are skipped.
+        interval: The sampling interval in seconds.
+      """
+    self.entries = frozenset(entries)
+    self.interval = interval
+    self.samples = 0
+    # A collapsed stack to its sample count mapping.
+    self.stacks = defaultdict(int)
+    self.stopped = Event()
+
+  @staticmethod
+  def get_frame_name(frame):
+    """Return the frame function name and location."""
+    code = frame.f_code
+    return (f'{code.co_name} '
+            f'({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+
+  def get_stack(self, frame):
+    """
+      Return the collapsed stack starting from the outermost entry point.
+
+      Returns:
+        str: The root first `;` separated frame names or None if the stack
+        doesn't contain an entry point.
+      """
+    names = []
+    entry_depth = None
+    while frame is not None:
+      names.append(self.get_frame_name(frame))
+      if frame.f_code in self.entries:
+        entry_depth = len(names)
+      frame = frame.f_back
+
+    if entry_depth is None:
+      return None
+
+    return ';'.join(reversed(names[:entry_depth]))
+
+  def sample(self):
+    """Record the current stacks of the threads running the entry points."""
+    # pylint: disable=protected-access
+    for frame in sys._current_frames().values():
+      stack = self.get_stack(frame)
+      if stack is not None:
+        self.stacks[stack] += 1
+    self.samples += 1
+
+  def run(self, duration):
+    """Sample the stacks for `duration` seconds or until stopped."""
+    deadline = time.monotonic() + duration
+    while True:
+      self.sample()
+      remaining = deadline - time.monotonic()
+      if remaining <= 0 or self.stopped.wait(min(self.interval, remaining)):
+        break
+
+  def stop(self):
+    """Stop the sampling."""
+    self.stopped.set()
+
+  def to_collapsed(self):
+    """Return the recorded stacks in the collapsed stack format."""
+    return ''.join(f'{stack} {count}\n'
+                   for stack, count in sorted(self.stacks.items()))
+
+  def write(self, path):
+    """Write the collapsed stacks to the file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as profile_file:
+      profile_file.write(self.to_collapsed())
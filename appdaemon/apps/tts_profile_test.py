@@ -0,0 +1,109 @@
+"""Tests for tts_profile.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import os
+import tempfile
+import unittest
+from threading import Event, Thread
+
+import tts_profile
+
+
+def entry(started, stopped):
+  inner(started, stopped)
+
+
+def inner(started, stopped):
+  started.set()
+  stopped.wait()
+
+
+def outer(started, stopped):
+  entry(started, stopped)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+  """Sampling profiler tests."""
+
+  def setUp(self):
+    self.started = Event()
+    self.stopped = Event()
+    self.addCleanup(self.stopped.set)
+
+  def _start(self, target):
+    thread = Thread(target=target, args=(self.started, self.stopped))
+    thread.daemon = True
+    thread.start()
+    self.started.wait()
+
+  def test_sample(self):
+    self._start(entry)
+    profiler = tts_profile.SamplingProfiler((entry.__code__,))
+
+    profiler.sample()
+    profiler.sample()
+
+    self.assertEqual(profiler.samples, 2)
+    self.assertEqual(len(profiler.stacks), 1)
+    stack, count = next(iter(profiler.stacks.items()))
+    names = stack.split(';')
+    self.assertEqual(count, 2)
+    self.assertTrue(names[0].startswith('entry (tts_profile_test.py:'))
+    self.assertTrue(names[1].startswith('inner (tts_profile_test.py:'))
+
+  def test_outermost_entry(self):
+    self._start(outer)
+    profiler = tts_profile.SamplingProfiler((entry.__code__, outer.__code__))
+
+    profiler.sample()
+
+    stack = next(iter(profiler.stacks))
+    self.assertTrue(stack.startswith('outer (tts_profile_test.py:'))
+    self.assertIn(';entry (tts_profile_test.py:', stack)
+
+  def test_skip_other_threads(self):
+    self._start(outer)
+    profiler = tts_profile.SamplingProfiler(
+        (TestSamplingProfiler.test_skip_other_threads.__code__,))
+
+    profiler.sample()
+
+    # Only the test thread runs the entry point.
+    stack = next(iter(profiler.stacks))
+    self.assertEqual(len(profiler.stacks), 1)
+    self.assertTrue(stack.startswith('test_skip_other_threads ('))
+    self.assertIn(';sample (tts_profile.py:', stack)
+
+  def test_run(self):
+    profiler = tts_profile.SamplingProfiler((), interval=0.001)
+
+    profiler.run(0.05)
+
+    self.assertGreater(profiler.samples, 1)
+
+  def test_stop(self):
+    profiler = tts_profile.SamplingProfiler((), interval=0.001)
+    profiler.stop()
+
+    profiler.run(60)
+
+    self.assertEqual(profiler.samples, 1)
+
+  def test_write(self):
+    profiler = tts_profile.SamplingProfiler(())
+    profiler.stacks.update({'b (b.py:1)': 1, 'a (a.py:1);c (c.py:2)': 3})
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+      path = os.path.join(temp_dir, 'profiles', 'tts.folded')
+      profiler.write(path)
+
+      with open(path, 'r', encoding='utf-8') as profile_file:
+        self.assertEqual(profile_file.read(),
+                         'a (a.py:1);c (c.py:2) 3\nb (b.py:1) 1\n')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,318 @@
+"""
+Message queue for tts.py.
+
+A bounded priority queue that never blocks the producer. Messages with higher
+priority are dispatched first, messages with the same priority are played in the
+order they were added. When the queue is full the configured overflow policy
+decides which message is dropped or whether the new message is coalesced with
+a pending one. A new message with the same text and voice as a pending one is
+merged into the pending message.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from threading import Condition
+
+import tts_metrics
+
+PRIORITY_DEFAULT = 0
+WILDCARD = '*'
+
+
+class MessageQueue:
+  """Bounded non-blocking priority message queue with overflow policies."""
+
+  COALESCE_SEPARATOR = ' <break time="1s"/>'
+
+  OUTCOME_COALESCED = 'coalesced'
+  OUTCOME_DEDUPLICATED = 'deduplicated'
+  OUTCOME_DROPPED_LOWEST_PRIORITY = 'dropped_lowest_priority'
+  OUTCOME_DROPPED_NEWEST = 'dropped_newest'
+  OUTCOME_DROPPED_OLDEST = 'dropped_oldest'
+  OUTCOME_ENQUEUED = 'enqueued'
+  OUTCOME_EXPIRED = 'expired'
+
+  POLICY_COALESCE = 'coalesce'
+  POLICY_DROP_LOWEST_PRIORITY = 'drop_lowest_priority'
+  POLICY_DROP_NEWEST = 'drop_newest'
+  POLICY_DROP_OLDEST = 'drop_oldest'
+  POLICIES = (
+      POLICY_COALESCE,
+      POLICY_DROP_LOWEST_PRIORITY,
+      POLICY_DROP_NEWEST,
+      POLICY_DROP_OLDEST,
+  )
+
+  SIZE_DEFAULT = 5
+
+  def __init__(self,
+               size=SIZE_DEFAULT,
+               policy=POLICY_DROP_OLDEST,
+               deduplicate=True,
+               clock=time.monotonic):
+    """
+      Parameters:
+        size: The maximum number of pending messages.
+        policy: The overflow policy, one of POLICY_* values.
+        deduplicate: Whether to merge new messages into the pending messages
+          with the same text and voice.
+        clock: A function returning the current time in seconds.
+      """
+    if policy not in self.POLICIES:
+      raise ValueError(f'Unknown queue overflow policy: {policy}.')
+
+    self.clock = clock
+    self.condition = Condition()
+    self.counters = defaultdict(int)
+    self.deduplicate = deduplicate
+    # The heap of [-priority, sequence number, message] entries.
+    self.entries = []
+    # Expired messages age histograms by priority.
+    self.expired_ages = defaultdict(tts_metrics.Histogram)
+    # A pending message (text, voice) key to its heap entry mapping.
+    self.index = {}
+    self.policy = policy
+    self.sequence = itertools.count()
+    self.size = size
+    # Incremented on every added message and notification.
+    self.version = 0
+    self.wait_times = defaultdict(tts_metrics.Histogram)
+
+  def __len__(self):
+    return len(self.entries)
+
+  @property
+  def messages(self):
+    """Return pending messages in the order they will be played."""
+    with self.condition:
+      return [entry[2] for entry in sorted(self.entries)]
+
+  def _coalesce(self, message):
+    """Append the message text to a pending message for the same areas."""
+    for entry in sorted(self.entries, key=lambda entry: entry[1],
+                        reverse=True):
+      pending = entry[2]
+      if (pending['areas_off'] == message['areas_off'] and
+          pending['areas_on'] == message['areas_on'] and
+          pending.get('voice') == message.get('voice')):
+        self._unindex(entry)
+        pending['text'] += self.COALESCE_SEPARATOR + message['text']
+        self._index(entry)
+        self._raise_priority(entry, message['priority'])
+        return self.OUTCOME_COALESCED
+
+    return self.OUTCOME_DROPPED_NEWEST
+
+  def _drop(self, entry):
+    """Remove an entry from the queue."""
+    self.entries.remove(entry)
+    heapq.heapify(self.entries)
+    self._unindex(entry)
+
+  def _drop_lowest_priority(self, message):
+    """Drop the oldest message with the lowest priority."""
+    lowest = min(self.entries, key=lambda entry: (-entry[0], entry[1]))
+    if message['priority'] <= lowest[2]['priority']:
+      return self.OUTCOME_DROPPED_NEWEST
+
+    self._drop(lowest)
+    self._push(message)
+    return self.OUTCOME_DROPPED_LOWEST_PRIORITY
+
+  @staticmethod
+  def _get_key(message):
+    """Return the pending messages index key for a message."""
+    return message['text'], message.get('voice')
+
+  def _index(self, entry):
+    """Add an entry to the pending messages index."""
+    if self.deduplicate:
+      self.index.setdefault(self._get_key(entry[2]), entry)
+
+  def _merge(self, entry, message):
+    """
+      Merge a message into a pending message with the same text and voice.
+
+      The merged message is played on the targets of both messages: its
+      areas_on are unioned and areas_off are intersected.
+      """
+    pending = entry[2]
+    pending['areas_off'] = intersect_areas(pending['areas_off'],
+                                           message['areas_off'])
+    pending['areas_on'] = union_areas(pending['areas_on'], message['areas_on'])
+
+    if 'expires_at' not in message:
+      pending.pop('expires_at', None)
+      pending.pop('ttl', None)
+    elif 'expires_at' in pending:
+      pending['expires_at'] = max(pending['expires_at'], message['expires_at'])
+
+    self._raise_priority(entry, message['priority'])
+
+  def _push(self, message):
+    """Add a message to the heap."""
+    entry = [-message['priority'], next(self.sequence), message]
+    heapq.heappush(self.entries, entry)
+    self._index(entry)
+
+  def _raise_priority(self, entry, priority):
+    """Raise the entry priority up to `priority`."""
+    if priority > entry[2]['priority']:
+      entry[2]['priority'] = priority
+      entry[0] = -priority
+      heapq.heapify(self.entries)
+
+  def _unindex(self, entry):
+    """Remove an entry from the pending messages index."""
+    key = self._get_key(entry[2])
+    if self.index.get(key) is entry:
+      del self.index[key]
+
+  def expire(self, now=None):
+    """
+      Drop the pending messages whose time-to-live has expired by `now`.
+
+      Returns:
+        list: The expired messages.
+      """
+    if now is None:
+      now = self.clock()
+
+    with self.condition:
+      expired = [
+          entry[2]
+          for entry in self.entries
+          if entry[2].get('expires_at', now) < now
+      ]
+      if not expired:
+        return expired
+
+      self.entries = [
+          entry for entry in self.entries
+          if entry[2].get('expires_at', now) >= now
+      ]
+      heapq.heapify(self.entries)
+      self.index = {
+          key: entry
+          for key, entry in self.index.items()
+          if entry[2].get('expires_at', now) >= now
+      }
+      self.counters[self.OUTCOME_EXPIRED] += len(expired)
+
+    for message in expired:
+      self.expired_ages[message['priority']].add(now - message['enqueued_at'])
+
+    return expired
+
+  def notify(self):
+    """Wake up the waiting consumers without adding a message."""
+    with self.condition:
+      self.version += 1
+      self.condition.notify_all()
+
+  def put(self, message):
+    """
+      Add a message to the queue without blocking.
+
+      Returns:
+        str: The outcome, one of OUTCOME_* values.
+      """
+    message.setdefault('enqueued_at', self.clock())
+    if message.get('ttl') is not None:
+      message.setdefault('expires_at', message['enqueued_at'] + message['ttl'])
+
+    with self.condition:
+      entry = self.index.get(self._get_key(message))
+      if entry is not None:
+        self._merge(entry, message)
+        outcome = self.OUTCOME_DEDUPLICATED
+      elif len(self.entries) < self.size:
+        self._push(message)
+        outcome = self.OUTCOME_ENQUEUED
+      elif self.policy == self.POLICY_COALESCE:
+        outcome = self._coalesce(message)
+      elif self.policy == self.POLICY_DROP_LOWEST_PRIORITY:
+        outcome = self._drop_lowest_priority(message)
+      elif self.policy == self.POLICY_DROP_OLDEST:
+        self._drop(min(self.entries, key=lambda entry: entry[1]))
+        self._push(message)
+        outcome = self.OUTCOME_DROPPED_OLDEST
+      else:
+        outcome = self.OUTCOME_DROPPED_NEWEST
+
+      self.counters[outcome] += 1
+      self.version += 1
+      self.condition.notify_all()
+
+    return outcome
+
+  def remove(self, message):
+    """
+      Remove a pending message from the queue.
+
+      Returns:
+        bool: False if the message isn't pending anymore.
+      """
+    with self.condition:
+      for entry in self.entries:
+        if entry[2] is message:
+          self._drop(entry)
+          break
+      else:
+        return False
+
+    self.wait_times[message['priority']].add(self.clock() -
+                                             message['enqueued_at'])
+    return True
+
+  def update_text(self, message, text):
+    """
+      Replace the text of a pending message.
+
+      Returns:
+        bool: False if the message isn't pending anymore.
+      """
+    with self.condition:
+      for entry in self.entries:
+        if entry[2] is message:
+          self._unindex(entry)
+          message['text'] = text
+          self._index(entry)
+          return True
+
+    return False
+
+  def wait(self, version, timeout=None):
+    """
+      Wait until a message is added or notify() is called after the queue
+      `version`.
+
+      Returns:
+        bool: True if the queue version has changed.
+      """
+    with self.condition:
+      return self.condition.wait_for(lambda: self.version != version, timeout)
+
+
+def intersect_areas(areas, other_areas):
+  """Return the areas_off value excluding the areas excluded by both values."""
+  if areas == WILDCARD:
+    return other_areas
+  if other_areas == WILDCARD:
+    return areas
+
+  other_areas = set(other_areas or ())
+  return [area for area in areas or () if area in other_areas] or None
+
+
+def union_areas(areas, other_areas):
+  """Return the areas_on value including the areas of both values."""
+  if WILDCARD in (areas, other_areas):
+    return WILDCARD
+
+  return list(dict.fromkeys((*(areas or ()), *(other_areas or ())))) or None
@@ -0,0 +1,304 @@
+"""Tests for tts_queue.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import threading
+import time
+import unittest
+
+import tts_queue
+
+
+class TestMessageQueue(unittest.TestCase):
+  """Message queue tests."""
+
+  @staticmethod
+  def _message(text, priority=tts_queue.PRIORITY_DEFAULT, areas_on=None):
+    return {
+        'areas_off': None,
+        'areas_on': areas_on,
+        'priority': priority,
+        'text': text,
+    }
+
+  def _fill(self, queue, priorities=(0, 0, 0)):
+    for idx, priority in enumerate(priorities):
+      self.assertEqual(queue.put(self._message(str(idx), priority)),
+                       tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+
+  def _texts(self, queue):
+    return [message['text'] for message in queue.messages]
+
+  def test_unknown_policy(self):
+    with self.assertRaises(ValueError) as ctx:
+      tts_queue.MessageQueue(policy='drop_all')
+    self.assertIn('Unknown queue overflow policy: drop_all',
+                  str(ctx.exception))
+
+  def test_messages(self):
+    queue = tts_queue.MessageQueue(3)
+    self._fill(queue)
+
+    self.assertListEqual(self._texts(queue), ['0', '1', '2'])
+    self.assertEqual(len(queue), 3)
+
+  def test_drop_newest(self):
+    queue = tts_queue.MessageQueue(
+        3, tts_queue.MessageQueue.POLICY_DROP_NEWEST)
+    self._fill(queue)
+
+    self.assertEqual(queue.put(self._message('3')),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST)
+    self.assertListEqual(self._texts(queue), ['0', '1', '2'])
+
+  def test_drop_oldest(self):
+    queue = tts_queue.MessageQueue(
+        3, tts_queue.MessageQueue.POLICY_DROP_OLDEST)
+    self._fill(queue)
+
+    self.assertEqual(queue.put(self._message('3')),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_OLDEST)
+    self.assertListEqual(self._texts(queue), ['1', '2', '3'])
+
+  def test_drop_lowest_priority(self):
+    queue = tts_queue.MessageQueue(
+        3, tts_queue.MessageQueue.POLICY_DROP_LOWEST_PRIORITY)
+    self._fill(queue, (1, 0, 0))
+
+    self.assertEqual(queue.put(self._message('3', 0)),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST)
+    self.assertEqual(queue.put(self._message('4', 1)),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_LOWEST_PRIORITY)
+    self.assertListEqual(self._texts(queue), ['0', '4', '2'])
+
+  def test_coalesce(self):
+    queue = tts_queue.MessageQueue(2, tts_queue.MessageQueue.POLICY_COALESCE)
+    queue.put(self._message('0'))
+    queue.put(self._message('1', areas_on=['den']))
+
+    self.assertEqual(queue.put(self._message('2', 1)),
+                     tts_queue.MessageQueue.OUTCOME_COALESCED)
+    self.assertEqual(queue.put(self._message('3', areas_on=['garage'])),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST)
+    self.assertListEqual(self._texts(queue),
+                         ['0 <break time="1s"/>2', '1'])
+    self.assertEqual(queue.messages[0]['priority'], 1)
+
+  def test_coalesce_same_voice(self):
+    queue = tts_queue.MessageQueue(1, tts_queue.MessageQueue.POLICY_COALESCE)
+    queue.put(self._message('0'))
+
+    self.assertEqual(queue.put(dict(self._message('1'), voice='Matthew')),
+                     tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST)
+    self.assertListEqual(self._texts(queue), ['0'])
+
+  def test_priority(self):
+    queue = tts_queue.MessageQueue(5)
+    self._fill(queue, (0, 1, 0, 2, 1))
+
+    self.assertListEqual(self._texts(queue), ['3', '1', '4', '0', '2'])
+    for message in queue.messages:
+      queue.remove(message)
+    self.assertListEqual(sorted(queue.wait_times), [0, 1, 2])
+    self.assertEqual(queue.wait_times[0].count, 2)
+    self.assertEqual(queue.wait_times[2].count, 1)
+
+  def test_remove(self):
+    queue = tts_queue.MessageQueue(3)
+    self._fill(queue, (0, 1, 0))
+    message = queue.messages[1]
+
+    self.assertTrue(queue.remove(message))
+    self.assertFalse(queue.remove(message))
+    self.assertListEqual(self._texts(queue), ['1', '2'])
+    self.assertEqual(queue.wait_times[0].count, 1)
+
+  def test_update_text(self):
+    queue = tts_queue.MessageQueue(3)
+    self._fill(queue, (0, 0))
+    message = queue.messages[0]
+
+    self.assertTrue(queue.update_text(message, 'rest'))
+    self.assertListEqual(self._texts(queue), ['rest', '1'])
+    self.assertEqual(queue.put(self._message('rest')),
+                     tts_queue.MessageQueue.OUTCOME_DEDUPLICATED)
+    self.assertEqual(queue.put(self._message('0')),
+                     tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+
+    queue.remove(message)
+    self.assertFalse(queue.update_text(message, 'more'))
+
+  def test_clock(self):
+    now = [100]
+    queue = tts_queue.MessageQueue(5, clock=lambda: now[0])
+    message = self._message('0', 0)
+    message['ttl'] = 10
+    queue.put(message)
+
+    now[0] = 107
+    self.assertEqual(message['expires_at'], 110)
+    self.assertListEqual(queue.expire(), [])
+    self.assertTrue(queue.remove(message))
+    self.assertEqual(queue.wait_times[0].sum, 7)
+
+  def test_expire(self):
+    queue = tts_queue.MessageQueue(5)
+    for text, priority, ttl in (('0', 0, 10), ('1', 1, 30), ('2', 0, None),
+                                ('3', 2, 5)):
+      message = self._message(text, priority)
+      message['enqueued_at'] = 100
+      message['ttl'] = ttl
+      queue.put(message)
+
+    self.assertListEqual(queue.expire(105), [])
+    self.assertListEqual(
+        sorted(message['text'] for message in queue.expire(111)), ['0', '3'])
+    self.assertListEqual(self._texts(queue), ['1', '2'])
+    message = queue.messages[0]
+    self.assertListEqual(queue.expire(1000), [message])
+    self.assertListEqual(self._texts(queue), ['2'])
+
+    self.assertEqual(
+        queue.counters[tts_queue.MessageQueue.OUTCOME_EXPIRED], 3)
+    self.assertEqual(queue.expired_ages[0].count, 1)
+    self.assertEqual(queue.expired_ages[1].max, 900)
+    self.assertEqual(queue.expired_ages[2].sum, 11)
+
+  def test_deduplicate(self):
+    queue = tts_queue.MessageQueue(2)
+    self._fill(queue, (0, 0))
+
+    self.assertEqual(queue.put(self._message('0', 1, areas_on=['den'])),
+                     tts_queue.MessageQueue.OUTCOME_DEDUPLICATED)
+    self.assertEqual(queue.put(self._message('0', 0, areas_on=['garage'])),
+                     tts_queue.MessageQueue.OUTCOME_DEDUPLICATED)
+
+    self.assertEqual(len(queue), 2)
+    self.assertListEqual(queue.messages, [{
+        'areas_off': None,
+        'areas_on': ['den', 'garage'],
+        'enqueued_at': queue.messages[0]['enqueued_at'],
+        'priority': 1,
+        'text': '0',
+    }, queue.messages[1]])
+    self.assertEqual(
+        queue.counters[tts_queue.MessageQueue.OUTCOME_DEDUPLICATED], 2)
+
+  def test_deduplicate_index(self):
+    queue = tts_queue.MessageQueue(3)
+    self._fill(queue, (0, 0, 0))
+
+    queue.remove(queue.messages[0])
+    queue.remove(queue.messages[0])
+    self.assertListEqual(list(queue.index), [('2', None)])
+
+    self.assertEqual(queue.put(self._message('0')),
+                     tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+    self.assertEqual(queue.put(self._message('1')),
+                     tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+    self.assertEqual(queue.put(self._message('2')),
+                     tts_queue.MessageQueue.OUTCOME_DEDUPLICATED)
+
+  def test_deduplicate_voice(self):
+    queue = tts_queue.MessageQueue()
+    queue.put(dict(self._message('0'), voice='Joanna'))
+
+    self.assertEqual(queue.put(self._message('0')),
+                     tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+    self.assertEqual(queue.put(dict(self._message('0'), voice='Matthew')),
+                     tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+    self.assertEqual(queue.put(dict(self._message('0'), voice='Joanna')),
+                     tts_queue.MessageQueue.OUTCOME_DEDUPLICATED)
+    self.assertEqual(len(queue), 3)
+
+  def test_deduplicate_coalesced(self):
+    queue = tts_queue.MessageQueue(1, tts_queue.MessageQueue.POLICY_COALESCE)
+    self._fill(queue, (0,))
+    queue.put(self._message('1'))
+
+    self.assertListEqual(list(queue.index),
+                         [('0 <break time="1s"/>1', None)])
+    self.assertEqual(queue.put(self._message('0')),
+                     tts_queue.MessageQueue.OUTCOME_COALESCED)
+
+  def test_deduplicate_ttl(self):
+    queue = tts_queue.MessageQueue()
+    for ttl in (10, 30):
+      message = self._message('0')
+      message['enqueued_at'] = 100
+      message['ttl'] = ttl
+      queue.put(message)
+    self.assertEqual(queue.messages[0]['expires_at'], 130)
+
+    queue.put(self._message('0'))
+    self.assertNotIn('expires_at', queue.messages[0])
+
+  def test_deduplicate_disabled(self):
+    queue = tts_queue.MessageQueue(deduplicate=False)
+    for _ in range(2):
+      self.assertEqual(queue.put(self._message('0')),
+                       tts_queue.MessageQueue.OUTCOME_ENQUEUED)
+
+    self.assertEqual(len(queue), 2)
+
+  def test_intersect_areas(self):
+    for areas, other_areas, expected in (
+        (None, ['den'], None),
+        (['den', 'garage'], ['garage', 'office_1'], ['garage']),
+        (['den'], ['garage'], None),
+        ('*', ['den'], ['den']),
+        (['den'], '*', ['den']),
+        ('*', '*', '*'),
+    ):
+      self.assertEqual(tts_queue.intersect_areas(areas, other_areas),
+                       expected)
+
+  def test_union_areas(self):
+    for areas, other_areas, expected in (
+        (None, None, None),
+        (None, ['den'], ['den']),
+        (['den', 'garage'], ['garage', 'office_1'],
+         ['den', 'garage', 'office_1']),
+        ('*', ['den'], '*'),
+        (['den'], '*', '*'),
+    ):
+      self.assertEqual(tts_queue.union_areas(areas, other_areas), expected)
+
+  def test_wait(self):
+    queue = tts_queue.MessageQueue()
+    version = queue.version
+
+    self.assertFalse(queue.wait(version, 0.01))
+
+    queue.put(self._message('0'))
+    self.assertTrue(queue.wait(version, 60))
+    self.assertFalse(queue.wait(queue.version, 0.01))
+
+  def test_wait_for_new_message(self):
+    queue = tts_queue.MessageQueue()
+    timer = threading.Timer(0.05, queue.put, (self._message('0'),))
+    timer.start()
+
+    started_at = time.monotonic()
+    self.assertTrue(queue.wait(queue.version, 60))
+    self.assertLess(time.monotonic() - started_at, 30)
+    timer.join()
+
+  def test_counters(self):
+    queue = tts_queue.MessageQueue(
+        1, tts_queue.MessageQueue.POLICY_DROP_NEWEST)
+
+    for idx in range(3):
+      queue.put(self._message(str(idx)))
+
+    self.assertDictEqual(
+        dict(queue.counters), {
+            tts_queue.MessageQueue.OUTCOME_DROPPED_NEWEST: 2,
+            tts_queue.MessageQueue.OUTCOME_ENQUEUED: 1,
+        })
+
+
+if __name__ == '__main__':
+  unittest.main()
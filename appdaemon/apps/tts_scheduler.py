@@ -0,0 +1,672 @@
+"""
+Playback scheduler for tts.py.
+
+Tracks until when each media player target is busy playing a message and
+dispatches a pending message as soon as all of its targets are free. A target
+is busy for the estimated playback duration since its service call returns,
+and it stays reserved while the call is in flight. Messages with
+non-overlapping targets are played in parallel while the messages for the same
+target are played in the queue order. The failed dispatches release their
+targets and go to the optional retry queue. Long messages are optionally
+played chunk by chunk, the rest of a message stays in the queue so higher
+priority messages can be played between the chunks.
+
+The optional dispatch pool makes the scheduling a pipeline: the worker routes
+and plans the messages, the pool threads make the service calls and the
+target reservations pace the playback. A target stays reserved while its
+dispatch is in flight so the messages for the same target are never played out
+of order. The pool threads make the service calls themselves, a dispatch in
+flight for longer than the pool timeout is failed by the next scheduling pass
+while its thread stays busy until the call returns.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import itertools
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+
+import tts_chunk
+import tts_dispatch
+import tts_queue
+
+
+class DispatchPool:
+  """Bounded pool of threads playing the dispatched messages."""
+
+  SIZE_DEFAULT = 4
+
+  # pylint: disable=too-many-arguments
+  def __init__(self, app, messages, dispatch, size=SIZE_DEFAULT, timeout=None):
+    """
+      Parameters:
+        app: The tts app logging the dispatch errors.
+        messages: The pending messages queue woken up on dispatch completion.
+        dispatch: A function playing a (message, targets, duration) dispatch.
+        size: The maximum number of dispatches in flight.
+        timeout: The time in seconds a dispatch may be in flight. None never
+          times out the dispatches.
+      """
+    self.active = 0
+    self.app = app
+    self.dispatch = dispatch
+    self.executor = None
+    # A dispatch ID to (deadline, message, targets) mapping of the dispatches
+    # in flight that haven't timed out.
+    self.inflight = {}
+    self.local = local()
+    self.lock = Lock()
+    self.messages = messages
+    self.sequence = itertools.count()
+    self.size = size
+    # Targets of the dispatches in flight.
+    self.targets = set()
+    self.timeout = timeout
+
+  def get_capacity(self):
+    """Return the number of dispatches the pool can accept."""
+    return self.size - self.active
+
+  def is_busy(self, target):
+    """Return True if a dispatch for the target is in flight."""
+    return target in self.targets
+
+  def is_pool_thread(self):
+    """Return True if called on one of the pool threads."""
+    return getattr(self.local, 'running', False)
+
+  def acquire(self, message, targets):
+    """
+      Mark the dispatch targets in flight.
+
+      Returns:
+        int: The dispatch ID.
+      """
+    deadline = None
+    if self.timeout is not None:
+      deadline = self.app.clock() + self.timeout
+
+    with self.lock:
+      dispatch_id = next(self.sequence)
+      self.inflight[dispatch_id] = (deadline, message, targets)
+      self.active += 1
+      self.targets.update(targets)
+
+    return dispatch_id
+
+  def release(self, dispatch_id):
+    """Mark the dispatch targets free and wake up the scheduler."""
+    with self.lock:
+      self.active -= 1
+      # The targets of a timed out dispatch are already free.
+      entry = self.inflight.pop(dispatch_id, None)
+      if entry is not None:
+        self.targets.difference_update(entry[2])
+    self.messages.notify()
+
+  def expire(self, now):
+    """
+      Give up on the dispatches in flight for longer than the timeout.
+
+      Their threads stay busy until the service calls return.
+
+      Returns:
+        list: The (message, targets) pairs of the timed out dispatches.
+      """
+    expired = []
+    if self.timeout is None:
+      return expired
+
+    with self.lock:
+      for dispatch_id, (deadline, message,
+                        targets) in list(self.inflight.items()):
+        if deadline <= now:
+          del self.inflight[dispatch_id]
+          self.targets.difference_update(targets)
+          expired.append((message, targets))
+
+    return expired
+
+  def get_next_at(self):
+    """Return the earliest dispatch deadline or None."""
+    with self.lock:
+      return min((deadline for deadline, _, _ in self.inflight.values()
+                  if deadline is not None),
+                 default=None)
+
+  def run(self, dispatch_id, message, targets, duration):
+    """Play the dispatch, log its errors."""
+    self.local.running = True
+    try:
+      self.dispatch(message, targets, duration)
+    except Exception:  # pylint: disable=broad-except
+      self.app.count_metric('errors')
+      self.app.log(sys.exc_info())
+    finally:
+      self.release(dispatch_id)
+
+  def shutdown(self):
+    """Stop the pool threads once the dispatches in flight complete."""
+    if self.executor is not None:
+      self.executor.shutdown(wait=False)
+
+  def submit(self, message, targets, duration):
+    """Play the dispatch on a pool thread."""
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(self.size,
+                                         thread_name_prefix='tts_dispatch')
+    self.executor.submit(self.run, self.acquire(message, targets), message,
+                         targets, duration)
+
+
+class PlaybackScheduler:
+  """Per target playback scheduler."""
+
+  CHUNK_LENGTH_DEFAULT = 250
+  COALESCE_LENGTH_DEFAULT = 500
+
+  pool_class = DispatchPool
+
+  # pylint: disable=too-many-arguments
+  def __init__(self,
+               app,
+               messages,
+               preempt_priority=None,
+               coalesce_length=None,
+               dispatch_threads=None,
+               retries=None,
+               chunk_length=None,
+               dispatch_timeout=None):
+    """
+      Parameters:
+        app: The tts app routing and playing messages.
+        messages: The pending messages queue.
+        preempt_priority: The lowest priority of messages interrupting the
+          playback of lower priority messages. None disables preemption.
+        coalesce_length: The maximum text length of pending messages for the
+          same targets merged into a single message. None disables merging.
+        dispatch_threads: The dispatch pool size. None dispatches the messages
+          on the scheduling thread.
+        retries: The failed messages retry queue. None drops them.
+        chunk_length: The maximum text length of a played message chunk. None
+          plays the messages whole.
+        dispatch_timeout: The time in seconds a dispatch may be in flight on
+          the dispatch pool. None never times out the dispatches.
+      """
+    self.app = app
+    # A target to (busy until, message priority) mapping.
+    self.busy = {}
+    self.chunk_length = chunk_length
+    self.chunked = 0
+    self.coalesce_length = coalesce_length
+    self.coalesced = 0
+    self.dispatched = 0
+    # A target to the last dispatched message mapping.
+    self.dispatches = {}
+    self.messages = messages
+    self.pool = (None if dispatch_threads is None else self.pool_class(
+        app, messages, self.dispatch, dispatch_threads, dispatch_timeout))
+    self.preempt_priority = preempt_priority
+    self.preempted = 0
+    self.released = 0
+    self.retries = retries
+    # The state reads of the current scheduling pass.
+    self.state_lookups = 0
+
+  def get_busy_until(self, target, priority, now):
+    """
+      Return until when the target is busy for a `priority` message.
+
+      Returns:
+        float: The busy until time or None if the target is free.
+      """
+    try:
+      busy_until, busy_priority = self.busy[target]
+    except KeyError:
+      return None
+
+    if busy_until <= now:
+      self.busy.pop(target, None)
+      return None
+
+    if (self.preempt_priority is not None and
+        priority >= self.preempt_priority and priority > busy_priority):
+      return None
+
+    return busy_until
+
+  def dispatch(self, message, targets, duration):
+    """Play the message on its targets, retry it later on failure."""
+    try:
+      self.app.play(message['text'], sorted(targets), duration,
+                    message.get('voice'))
+    except Exception:  # pylint: disable=broad-except
+      self.fail(message, targets, sys.exc_info())
+    else:
+      self.start(message, targets, duration)
+
+  def fail(self, message, targets, exc_info):
+    """Log the failed dispatch and schedule the message retry."""
+    if exc_info[0] is tts_dispatch.CircuitOpenError:
+      self.app.log(f"Circuit breaker is open: {message['text']}")
+    else:
+      self.app.log(exc_info)
+
+    self.retry(message, targets)
+
+  def expire_dispatches(self, now):
+    """Fail the dispatches in flight for longer than the pool timeout."""
+    if self.pool is None:
+      return
+
+    for message, targets in self.pool.expire(now):
+      self.app.count_metric('dispatch_timeouts')
+      self.app.log(f"Dispatch timed out: {message['text']}")
+      self.retry(message, targets)
+
+  def retry(self, message, targets):
+    """Free the failed dispatch targets and schedule the message retry."""
+    current = not targets
+    for target in targets:
+      if self.dispatches.get(target) is message:
+        self.dispatches.pop(target, None)
+        self.busy.pop(target, None)
+        current = True
+
+    if not current:
+      # A timed out dispatch has failed after all, it's already retried.
+      return
+
+    if self.retries is not None:
+      message = self.rejoin(message)
+      outcome = self.retries.put(message, self.app.clock())
+      self.app.count_metric(f'retry_{outcome}')
+      if outcome != tts_dispatch.RetryQueue.OUTCOME_SCHEDULED:
+        self.app.log(f"Retry dropped: {message['text']} ({outcome})")
+
+    # Reschedule the messages waiting for the released targets.
+    self.messages.notify()
+
+  def rejoin(self, message):
+    """
+      Join a failed chunk with the pending rest of its message.
+
+      The rest waits for the chunk retry instead of being played before it.
+
+      Returns:
+        dict: The message to retry.
+      """
+    message = dict(message)
+    pending = message.pop('pending', None)
+    if pending is None or not self.messages.remove(pending):
+      return message
+
+    return dict(message, text=f"{message['text']} {pending['text']}")
+
+  def get_next_at(self, next_at):
+    """Return the next scheduling pass time including retries and timeouts."""
+    for other_at in (self.retries.get_next_at()
+                     if self.retries is not None else None,
+                     self.pool.get_next_at() if self.pool else None):
+      if next_at is None or (other_at is not None and other_at < next_at):
+        next_at = other_at
+    return next_at
+
+  def get_depths(self, now):
+    """
+      Return the pipeline stage queue depths.
+
+      Returns:
+        dict: The number of dispatches in flight, of the busy targets and of
+        the messages waiting for a retry.
+    """
+    return {
+        'dispatch': self.pool.active if self.pool else 0,
+        'pacing': sum(busy_until > now
+                      for busy_until, _ in list(self.busy.values())),
+        'retry': len(self.retries) if self.retries is not None else 0,
+    }
+
+  def is_dispatching(self, target):
+    """Return True if a dispatch for the target is in flight."""
+    return self.pool is not None and self.pool.is_busy(target)
+
+  def occupy(self, message, targets, now):
+    """
+      Mark the message targets busy for the message playback duration.
+
+      The busy time is restarted once the dispatch completes, so the service
+      call latency isn't taken out of the playback time.
+
+      Returns:
+        float: The message playback duration in seconds.
+      """
+    priority = message['priority']
+    duration = self.app.calculate_duration(message['text'],
+                                           message.get('voice'))
+
+    for target in targets:
+      if target in self.busy:
+        self.preempted += 1
+      self.busy[target] = (now + duration, priority)
+      self.dispatches[target] = message
+
+    self.dispatched += 1
+    return duration
+
+  def start(self, message, targets, duration):
+    """Mark the targets busy for the playback duration since the dispatch."""
+    busy_until = self.app.clock() + duration
+    for target in targets:
+      # The target may be preempted or released while the dispatch is in
+      # flight.
+      if self.dispatches.get(target) is message:
+        self.busy[target] = (busy_until, message['priority'])
+
+  def release(self, target, message):
+    """
+      Mark the target free once it finished playing the message.
+
+      The estimated playback duration is only used as a timeout then.
+
+      Returns:
+        bool: True if the target was busy playing the message.
+      """
+    if self.dispatches.get(target) is not message:
+      return False
+
+    self.dispatches.pop(target, None)
+    if self.busy.pop(target, None) is None:
+      return False
+
+    self.released += 1
+    return True
+
+  def reserve(self, message, targets, reserved, now):
+    """
+      Check whether the message targets are free.
+
+      Parameters:
+        message: The message to check.
+        targets: The message targets.
+        reserved: Targets of the earlier messages waiting for busy targets.
+          Updated with the message targets if the message has to wait.
+        now: The current time.
+
+      Returns:
+        float: The earliest time a busy message target becomes free, 0 if it's
+        reserved by an earlier message or by a dispatch in flight, or None if
+        the targets are free.
+      """
+    blocked_until = None
+    priority = message['priority']
+
+    for target in targets:
+      busy_until = self.get_busy_until(target, priority, now)
+      if busy_until is not None:
+        if blocked_until is None or busy_until < blocked_until:
+          blocked_until = busy_until
+      elif blocked_until is None and (target in reserved or
+                                      self.is_dispatching(target)):
+        blocked_until = 0
+
+    if blocked_until is not None:
+      reserved.update(targets)
+
+    return blocked_until
+
+  # pylint: disable=too-many-arguments
+  def coalesce(self, message, targets, routes, merged, now):
+    """
+      Merge the later pending messages for the same targets into the message.
+
+      Parameters:
+        message: The message to dispatch.
+        targets: The message targets.
+        routes: The later (message, targets) pairs in the queue order.
+        merged: Updated with the IDs of the merged messages.
+        now: The current time.
+
+      Returns:
+        dict: The message to play.
+      """
+    if not self.coalesce_length or not targets:
+      return message
+
+    # The merged text is never chunked.
+    length_max = self.coalesce_length
+    if self.chunk_length:
+      length_max = min(length_max, self.chunk_length)
+
+    separator = tts_queue.MessageQueue.COALESCE_SEPARATOR
+    length = len(message['text'])
+    texts = [message['text']]
+    for other, other_targets in routes:
+      if id(other) in merged:
+        continue
+
+      if other_targets != targets or other.get('voice') != message.get('voice'):
+        # Keep the order of the messages for the overlapping targets.
+        if not targets.isdisjoint(other_targets):
+          break
+        continue
+
+      length += len(separator) + len(other['text'])
+      if length > length_max:
+        break
+
+      if self.messages.remove(other):
+        merged.add(id(other))
+        texts.append(other['text'])
+        self.coalesced += 1
+        self.app.observe_metric('wait_seconds', now - other['enqueued_at'])
+
+    if len(texts) == 1:
+      return message
+
+    return dict(message, text=separator.join(texts))
+
+  def expire(self, now):
+    """Drop the pending messages whose time-to-live has expired."""
+    for message in self.messages.expire(now):
+      self.app.count_metric('expired')
+      self.app.log(f"Message expired: {message['text']}")
+
+  def requeue(self, now):
+    """Return the messages due for a retry to the message queue."""
+    if self.retries is None:
+      return
+
+    for message in self.retries.pop(now):
+      self.messages.put(message)
+
+  def plan(self, routes, now):
+    """
+      Select the routed messages whose targets are free.
+
+      Parameters:
+        routes: The pending (message, targets) pairs in the queue order.
+        now: The current time.
+
+      Returns:
+        tuple: A list of (message, targets, duration) tuples to dispatch and
+        the time of the next scheduling pass or None if there are no pending
+        messages waiting for busy targets.
+      """
+    capacity = self.pool.get_capacity() if self.pool else None
+    dispatches = []
+    merged = set()
+    next_at = None
+    reserved = set()
+
+    for idx, (message, targets) in enumerate(routes):
+      if id(message) in merged:
+        continue
+
+      blocked_until = self.reserve(message, targets, reserved, now)
+      if blocked_until is None and len(dispatches) == capacity:
+        # Wait for a dispatch pool completion to wake up the scheduler.
+        reserved.update(targets)
+      elif blocked_until is None:
+        targets = self.limit(message, targets, now)
+        if targets is None:
+          continue
+        message, pending = self.take(message, targets, routes[idx + 1:],
+                                     merged, now)
+        if message is not None:
+          # A separate object per dispatch tells a retried message from
+          # its earlier timed out dispatch.
+          message = dict(message)
+          duration = self.occupy(message, targets, now)
+          self.app.count_metric('dispatched')
+          self.app.observe_metric('pacing_seconds', duration)
+          dispatches.append((message, targets, duration))
+          # Keep the later messages for the targets out of this pass.
+          reserved.update(targets)
+          # The rest of a chunked message waits for its targets.
+          if pending and (next_at is None or now + duration < next_at):
+            next_at = now + duration
+      elif blocked_until and (next_at is None or blocked_until < next_at):
+        next_at = blocked_until
+
+    return dispatches, next_at
+
+  def limit(self, message, targets, now):
+    """
+      Drop the message targets over their per area rate limits.
+
+      Returns:
+        frozenset: The allowed targets or None if all of them are limited.
+      """
+    if not targets or 'targets' in message:
+      # The rest of a chunked message plays where its first chunk did.
+      return targets
+
+    limited = self.app.limit_targets(targets, now)
+    if not limited:
+      return targets
+
+    self.app.count_metric('rate_limited')
+    self.app.log(f"Rate limited: {message['text']} on "
+                 f"{', '.join(sorted(limited))}")
+    if limited < targets:
+      return targets - limited
+
+    self.messages.remove(message)
+    return None
+
+  # pylint: disable=too-many-arguments
+  def take(self, message, targets, routes, merged, now):
+    """
+      Remove the message or its first chunk from the queue.
+
+      Parameters:
+        message: The message to dispatch.
+        targets: The message targets.
+        routes: The later (message, targets) pairs in the queue order.
+        merged: Updated with the IDs of the merged messages.
+        now: The current time.
+
+      Returns:
+        tuple: The message to play or None if it isn't pending anymore and
+        whether the rest of the message is still pending.
+      """
+    chunk, rest = message['text'], None
+    if self.chunk_length:
+      chunk, rest = tts_chunk.split(message['text'], self.chunk_length)
+
+    chunks = message.get('chunks', 0)
+    if rest is None:
+      if not self.messages.remove(message):
+        return None, False
+      if not chunks:
+        self.app.observe_metric('wait_seconds', now - message['enqueued_at'])
+      return self.coalesce(message, targets, routes, merged, now), False
+
+    # The rest of the message keeps its place in the queue, plays on the same
+    # targets and doesn't expire.
+    message.pop('expires_at', None)
+    message.pop('ttl', None)
+    if not self.messages.update_text(message, rest):
+      return None, False
+    message['targets'] = targets
+
+    if not chunks:
+      self.app.observe_metric('wait_seconds', now - message['enqueued_at'])
+    message['chunks'] = chunks + 1
+    self.chunked += 1
+    self.app.count_metric('chunks')
+    return dict(message, pending=message, text=chunk), True
+
+  def observe_route(self, started_at):
+    """Record the message routing time, count its state lookups."""
+    self.app.observe_metric('routing_seconds', time.perf_counter() - started_at)
+    self.state_lookups += self.app.state_lookups
+
+  def route(self, message, states=None):
+    """
+      Return the message targets.
+
+      Parameters:
+        message: A pending message.
+        states: The app get_states() entity states of the scheduling pass.
+
+      Returns:
+        frozenset: The message targets or None for invalid messages.
+      """
+    if 'targets' in message:
+      # The rest of a chunked message.
+      return message['targets']
+
+    try:
+      self.app.validate(message['text'], message['areas_off'],
+                        message['areas_on'])
+      started_at = time.perf_counter()
+      targets = frozenset(
+          self.app.route(message['areas_off'], message['areas_on'], states))
+      self.observe_route(started_at)
+      return targets
+    except Exception:  # pylint: disable=broad-except
+      self.messages.remove(message)
+      self.app.log(sys.exc_info())
+      return None
+
+  def schedule(self, now):
+    """
+      Dispatch the pending messages whose targets are free.
+
+      Returns:
+        float: The time of the next scheduling pass or None if there are no
+        pending messages waiting for busy targets.
+      """
+    self.requeue(now)
+    self.expire(now)
+    self.expire_dispatches(now)
+
+    routes = []
+    messages = self.messages.messages
+    if messages:
+      # All of the pending messages are routed against a single state read.
+      states = self.app.get_states()
+      self.state_lookups = int(states is not None)
+      for message in messages:
+        targets = self.route(message, states)
+        if targets is not None:
+          routes.append((message, targets))
+      self.app.observe_metric('state_lookups', self.state_lookups)
+
+    dispatches, next_at = self.plan(routes, now)
+    for message, targets, duration in dispatches:
+      self.submit(message, targets, duration)
+
+    return self.get_next_at(next_at)
+
+  def submit(self, message, targets, duration):
+    """Play the message on the dispatch pool or on the scheduling thread."""
+    if self.pool is None:
+      self.dispatch(message, targets, duration)
+    else:
+      self.pool.submit(message, targets, duration)
@@ -0,0 +1,656 @@
+"""Tests for tts_scheduler.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+from threading import Event
+
+import tts
+import tts_dispatch
+import tts_queue
+import tts_scheduler
+
+
+class FakeApp:
+  """A tts app stand-in routing messages to their areas_on targets."""
+
+  validate = staticmethod(tts.AmazonEcho.validate)
+
+  def __init__(self):
+    self.counters = {}
+    self.error = ValueError
+    # Blocks the playback until set if not None.
+    self.gate = None
+    # The service call latency added to the clock on every playback.
+    self.latency = 0
+    # The targets over their rate limits.
+    self.limited = set()
+    self.logs = []
+    self.now = 0
+    self.played = []
+    self.spans = {}
+    self.state_lookups = 0
+    self.state_reads = 0
+    self.voices = []
+
+  @staticmethod
+  def calculate_duration(text, voice=None):
+    del voice
+    return int(text.split()[-1].rstrip('.'))
+
+  def clock(self):
+    return self.now
+
+  def count_metric(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def observe_metric(self, name, value):
+    self.spans.setdefault(name, []).append(value)
+
+  def get_states(self):
+    self.state_reads += 1
+    return {}
+
+  def limit_targets(self, targets, now):
+    del now
+    return frozenset(target for target in targets if target in self.limited)
+
+  def log(self, message):
+    self.logs.append(message)
+
+  def play(self, text, targets, duration=None, voice=None):
+    if self.gate is not None:
+      self.gate.wait()
+    if text.startswith('error'):
+      raise self.error(text)
+    self.now += self.latency
+    self.played.append((text, targets, duration))
+    self.voices.append(voice)
+
+  @staticmethod
+  def route(areas_off=None, areas_on=None, states=None):
+    del areas_off, states
+    return sorted(tts.AmazonEcho.get_target(area) for area in areas_on)
+
+
+class TestPlaybackScheduler(unittest.TestCase):
+  """Playback scheduler tests."""
+
+  DEN_ECHO = tts.AmazonEcho.get_target('den')
+  GARAGE_ECHO = tts.AmazonEcho.get_target('garage')
+
+  def setUp(self):
+    self.app = FakeApp()
+    self.messages = tts_queue.MessageQueue(10)
+    self.scheduler = tts_scheduler.PlaybackScheduler(self.app,
+                                                     self.messages,
+                                                     preempt_priority=10)
+
+  def _put(self, text, areas_on, priority=tts_queue.PRIORITY_DEFAULT):
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': areas_on,
+        'priority': priority,
+        'text': text,
+    })
+
+  def _played(self):
+    return [text for text, _, _ in self.app.played]
+
+  def test_parallel_playback(self):
+    self._put('den 5', ['den'])
+    self._put('garage 3', ['garage'])
+
+    self.assertIsNone(self.scheduler.schedule(0))
+    self.assertListEqual(self._played(), ['den 5', 'garage 3'])
+    self.assertDictEqual(self.scheduler.busy, {
+        self.DEN_ECHO: (5, 0),
+        self.GARAGE_ECHO: (3, 0),
+    })
+
+  def test_busy_target(self):
+    self._put('den 5', ['den'])
+    self._put('den 2', ['den'])
+
+    self.assertEqual(self.scheduler.schedule(0), 5)
+    self.assertListEqual(self._played(), ['den 5'])
+    self.assertEqual(len(self.messages), 1)
+
+    self.assertEqual(self.scheduler.schedule(4.9), 5)
+    self.assertIsNone(self.scheduler.schedule(5))
+    self.assertListEqual(self._played(), ['den 5', 'den 2'])
+
+  def test_busy_since_dispatch(self):
+    self.app.latency = 2
+    self._put('garage 3', ['garage'])
+    self._put('garage 1', ['garage'])
+
+    self.scheduler.schedule(0)
+    self.assertEqual(self.scheduler.busy[self.GARAGE_ECHO], (5, 0))
+
+    self.app.now = 3.6
+    self.assertEqual(self.scheduler.schedule(3.6), 5)
+    self.assertListEqual(self._played(), ['garage 3'])
+
+    self.app.now = 5
+    self.scheduler.schedule(5)
+    self.assertListEqual(self._played(), ['garage 3', 'garage 1'])
+
+  def test_target_order(self):
+    self._put('den 5', ['den'])
+    self._put('den and garage 1', ['den', 'garage'])
+    self._put('garage 1', ['garage'])
+
+    self.assertEqual(self.scheduler.schedule(0), 5)
+    self.assertListEqual(self._played(), ['den 5'])
+
+    self.assertEqual(self.scheduler.schedule(5), 6)
+    self.assertIsNone(self.scheduler.schedule(6))
+    self.assertListEqual(self._played(),
+                         ['den 5', 'den and garage 1', 'garage 1'])
+
+  def test_priority(self):
+    self._put('den 5', ['den'])
+    self._put('den 1', ['den'])
+    self._put('den 2', ['den'], priority=1)
+
+    for now in range(0, 10):
+      self.scheduler.schedule(now)
+
+    self.assertListEqual(self._played(), ['den 2', 'den 5', 'den 1'])
+
+  def test_preemption(self):
+    self._put('den 5', ['den'])
+    self.scheduler.schedule(0)
+
+    self._put('den 2', ['den'], priority=9)
+    self._put('den 1', ['den'], priority=10)
+
+    self.assertEqual(self.scheduler.schedule(1), 2)
+    self.assertListEqual(self._played(), ['den 5', 'den 1'])
+    self.assertEqual(self.scheduler.preempted, 1)
+
+  def test_expired_messages(self):
+    self.app.route = lambda *args: self.fail('Expired message is routed.')
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': ['den'],
+        'enqueued_at': 0,
+        'priority': tts_queue.PRIORITY_DEFAULT,
+        'text': 'den 1',
+        'ttl': 30,
+    })
+
+    self.assertIsNone(self.scheduler.schedule(31))
+    self.assertListEqual(self._played(), [])
+    self.assertListEqual(self.app.logs, ['Message expired: den 1'])
+    self.assertDictEqual(self.app.counters, {'expired': 1})
+    self.assertEqual(len(self.messages), 0)
+
+  def test_invalid_message(self):
+    self._put('', ['den'])
+    self._put('den 1', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), ['den 1'])
+    self.assertEqual(len(self.messages), 0)
+    self.assertEqual(len(self.app.logs), 1)
+
+  def test_burst_drain_time(self):
+    areas = ('den', 'garage', 'office_1', 'den', 'garage', 'office_1')
+    for idx, area in enumerate(areas):
+      self._put(f'{area} {idx} 4', [area])
+
+    now = 0
+    next_at = self.scheduler.schedule(now)
+    while next_at is not None:
+      now = next_at
+      next_at = self.scheduler.schedule(now)
+
+    # Sequential playback would take 24 seconds.
+    self.assertEqual(now, 4)
+    self.assertEqual(len(self.messages), 0)
+    self.assertEqual(self.scheduler.dispatched, len(areas))
+
+  def test_release(self):
+    self._put('den 5', ['den'])
+    self._put('den 2', ['den'])
+    self.scheduler.schedule(0)
+    message = self.scheduler.dispatches[self.DEN_ECHO]
+
+    self.assertFalse(self.scheduler.release(self.DEN_ECHO, {}))
+    self.assertTrue(self.scheduler.release(self.DEN_ECHO, message))
+    self.assertFalse(self.scheduler.release(self.DEN_ECHO, message))
+    self.assertEqual(self.scheduler.released, 1)
+
+    self.assertIsNone(self.scheduler.schedule(1))
+    self.assertListEqual(self._played(), ['den 5', 'den 2'])
+
+  def test_coalesce(self):
+    self.scheduler.coalesce_length = 100
+    self._put('den 1', ['den'])
+    self._put('garage 1', ['garage'])
+    self._put('den 2', ['den'])
+    self._put('den 3', ['den'], priority=1)
+
+    self.assertIsNone(self.scheduler.schedule(0))
+
+    separator = tts_queue.MessageQueue.COALESCE_SEPARATOR
+    self.assertListEqual(self.app.played, [
+        (separator.join(('den 3', 'den 1', 'den 2')), [self.DEN_ECHO], 2),
+        ('garage 1', [self.GARAGE_ECHO], 1),
+    ])
+    self.assertEqual(self.scheduler.coalesced, 2)
+    self.assertEqual(self.scheduler.dispatched, 2)
+    self.assertEqual(len(self.messages), 0)
+
+  def test_metrics(self):
+    self.scheduler.coalesce_length = 100
+    for idx in range(2):
+      self.messages.put({
+          'areas_off': None,
+          'areas_on': ['den'],
+          'enqueued_at': idx,
+          'priority': tts_queue.PRIORITY_DEFAULT,
+          'text': f'den {idx + 1}',
+      })
+
+    self.scheduler.schedule(10)
+
+    self.assertDictEqual(self.app.counters, {'dispatched': 1})
+    self.assertListEqual(self.app.spans['pacing_seconds'], [2])
+    self.assertEqual(len(self.app.spans['routing_seconds']), 2)
+    self.assertListEqual(self.app.spans['state_lookups'], [1])
+    self.assertListEqual(self.app.spans['wait_seconds'], [10, 9])
+
+  def test_single_state_read(self):
+    for area in ('den', 'garage', 'office'):
+      self.messages.put({
+          'areas_off': None,
+          'areas_on': [area],
+          'priority': tts_queue.PRIORITY_DEFAULT,
+          'text': f'{area} 1',
+      })
+
+    self.scheduler.schedule(0)
+    self.scheduler.schedule(0.5)
+
+    self.assertEqual(len(self.app.played), 3)
+    self.assertEqual(self.app.state_reads, 1)
+    self.assertListEqual(self.app.spans['state_lookups'], [1])
+    self.assertEqual(len(self.app.spans['routing_seconds']), 3)
+
+  def test_coalesce_same_voice(self):
+    self.scheduler.coalesce_length = 100
+    self._put('den 1', ['den'])
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': ['den'],
+        'priority': tts_queue.PRIORITY_DEFAULT,
+        'text': 'den 2',
+        'voice': 'Matthew',
+    })
+    self._put('den 3', ['den'])
+
+    for now in (0, 1, 3):
+      self.scheduler.schedule(now)
+
+    self.assertListEqual(self._played(), ['den 1', 'den 2', 'den 3'])
+    self.assertListEqual(self.app.voices, [None, 'Matthew', None])
+    self.assertEqual(self.scheduler.coalesced, 0)
+
+  def test_coalesce_length(self):
+    self.scheduler.coalesce_length = 30
+    for idx in range(1, 4):
+      self._put(f'den {idx}', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), [
+        tts_queue.MessageQueue.COALESCE_SEPARATOR.join(('den 1', 'den 2')),
+    ])
+    self.assertEqual(len(self.messages), 1)
+
+  def test_coalesce_keeps_overlapping_targets_order(self):
+    self.scheduler.coalesce_length = 100
+    self._put('den 1', ['den'])
+    self._put('den and garage 1', ['den', 'garage'])
+    self._put('den 2', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), ['den 1'])
+    self.assertEqual(self.scheduler.coalesced, 0)
+
+  def test_coalesce_disabled(self):
+    self._put('den 1', ['den'])
+    self._put('den 2', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), ['den 1'])
+
+  def test_coalesce_chunk_length(self):
+    self.scheduler.chunk_length = 30
+    self.scheduler.coalesce_length = 100
+    for idx in range(1, 4):
+      self._put(f'den {idx}', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), [
+        tts_queue.MessageQueue.COALESCE_SEPARATOR.join(('den 1', 'den 2')),
+    ])
+
+  def test_chunks(self):
+    self.scheduler.chunk_length = 8
+    self._put('den 2. den 3', ['den'])
+
+    self.assertEqual(self.scheduler.schedule(0), 2)
+    self.assertListEqual(self._played(), ['den 2.'])
+    self.assertListEqual(
+        [message['text'] for message in self.messages.messages], ['den 3'])
+
+    self._put('den later 1', ['den'])
+    self._put('den urgent 1', ['den'], priority=1)
+    for now in (2, 3, 6):
+      self.scheduler.schedule(now)
+
+    self.assertListEqual(self._played(),
+                         ['den 2.', 'den urgent 1', 'den 3', 'den later 1'])
+    self.assertEqual(self.scheduler.chunked, 1)
+    self.assertEqual(self.app.counters['chunks'], 1)
+    self.assertEqual(len(self.app.spans['wait_seconds']), 3)
+
+  def test_chunks_keep_targets(self):
+    self.scheduler.chunk_length = 8
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': ['den'],
+        'expires_at': 1,
+        'priority': tts_queue.PRIORITY_DEFAULT,
+        'text': 'den 2. den 3',
+    })
+
+    self.scheduler.schedule(0)
+    # The routing changes after the first chunk is played.
+    self.app.route = lambda areas_off=None, areas_on=None: [self.GARAGE_ECHO]
+    self.scheduler.schedule(2)
+
+    self.assertListEqual(self.app.played, [
+        ('den 2.', [self.DEN_ECHO], 2),
+        ('den 3', [self.DEN_ECHO], 3),
+    ])
+    self.assertNotIn('expired', self.app.counters)
+
+  def test_chunk_retry_order(self):
+    self.scheduler.chunk_length = 8
+    self.scheduler.retries = tts_dispatch.RetryQueue(backoff=1)
+    self._put('den 2. den 3. den 1', ['den'])
+    play = self.app.play
+
+    def fail_once(text, *args):
+      del args
+      self.app.play = play
+      raise ValueError(text)
+
+    self.app.play = fail_once
+    for now in (0, 1, 3, 6):
+      self.app.now = now
+      self.scheduler.schedule(now)
+
+    self.assertListEqual(self._played(), ['den 2.', 'den 3.', 'den 1'])
+    self.assertEqual(len(self.messages), 0)
+
+  def test_rate_limited_targets(self):
+    self.app.limited.add(self.DEN_ECHO)
+    self._put('den and garage 1', ['den', 'garage'])
+    self._put('den 1', ['den'])
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self.app.played,
+                         [('den and garage 1', [self.GARAGE_ECHO], 1)])
+    self.assertEqual(len(self.messages), 0)
+    self.assertEqual(self.app.counters['rate_limited'], 2)
+    self.assertListEqual(self.app.logs, [
+        f'Rate limited: den and garage 1 on {self.DEN_ECHO}',
+        f'Rate limited: den 1 on {self.DEN_ECHO}',
+    ])
+
+  def test_failure_releases_targets(self):
+    self._put('error 5', ['den'])
+    self._put('den 1', ['den'])
+    version = self.messages.version
+
+    self.scheduler.schedule(0)
+    self.assertGreater(self.messages.version, version)
+    self.assertDictEqual(self.scheduler.busy, {})
+
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._played(), ['den 1'])
+    self.assertEqual(len(self.app.logs), 1)
+
+  def test_retry(self):
+    self.scheduler.retries = tts_dispatch.RetryQueue(attempts=2, backoff=1)
+    self._put('error 5', ['den'])
+
+    self.assertEqual(self.scheduler.schedule(0), 1)
+    self.assertEqual(len(self.messages), 0)
+    self.assertEqual(self.scheduler.get_depths(0)['retry'], 1)
+
+    self.app.now = 1
+    self.assertEqual(self.scheduler.schedule(1), 3)
+
+    self.app.now = 3
+    self.assertIsNone(self.scheduler.schedule(3))
+
+    self.assertEqual(self.scheduler.dispatched, 3)
+    self.assertDictEqual(
+        self.app.counters, {
+            'dispatched': 3,
+            'retry_dropped_attempts': 1,
+            'retry_scheduled': 2,
+        })
+    self.assertEqual(self.app.logs[-1], 'Retry dropped: error 5 '
+                     '(dropped_attempts)')
+
+  def test_retry_keeps_ttl(self):
+    self.scheduler.retries = tts_dispatch.RetryQueue(backoff=10)
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': ['den'],
+        'enqueued_at': 0,
+        'expires_at': 5,
+        'priority': tts_queue.PRIORITY_DEFAULT,
+        'text': 'error 1',
+    })
+
+    self.assertIsNone(self.scheduler.schedule(0))
+
+    self.assertDictEqual(self.app.counters, {
+        'dispatched': 1,
+        'retry_dropped_expired': 1,
+    })
+
+  def test_circuit_open(self):
+    self.app.error = tts_dispatch.CircuitOpenError
+    self._put('error 1', ['den'])
+
+    self.scheduler.schedule(0)
+    self._played()
+
+    self.assertListEqual(self.app.logs, ['Circuit breaker is open: error 1'])
+
+
+class TestPipelinedScheduler(TestPlaybackScheduler):
+  """Playback scheduler tests with the dispatch pool."""
+
+  def setUp(self):
+    super().setUp()
+    self.scheduler = tts_scheduler.PlaybackScheduler(
+        self.app,
+        self.messages,
+        preempt_priority=10,
+        dispatch_threads=tts_scheduler.DispatchPool.SIZE_DEFAULT)
+    self.addCleanup(self.scheduler.pool.shutdown)
+
+    # Complete the dispatches of each pass like the inline dispatch does.
+    schedule = self.scheduler.schedule
+
+    def schedule_and_wait(now):
+      next_at = schedule(now)
+      wait_dispatches(self.scheduler.pool)
+      return next_at
+
+    self.scheduler.schedule = schedule_and_wait
+
+
+class TestDispatchPool(unittest.TestCase):
+  """Dispatch pool tests."""
+
+  DEN_ECHO = tts.AmazonEcho.get_target('den')
+  GARAGE_ECHO = tts.AmazonEcho.get_target('garage')
+
+  def setUp(self):
+    self.app = FakeApp()
+    self.app.gate = Event()
+    self.addCleanup(self.app.gate.set)
+    self.messages = tts_queue.MessageQueue(10)
+    self.scheduler = tts_scheduler.PlaybackScheduler(self.app,
+                                                     self.messages,
+                                                     preempt_priority=10,
+                                                     dispatch_threads=2)
+    self.pool = self.scheduler.pool
+    self.addCleanup(self.pool.shutdown)
+
+  def _put(self, text, areas_on, priority=tts_queue.PRIORITY_DEFAULT):
+    self.messages.put({
+        'areas_off': None,
+        'areas_on': areas_on,
+        'priority': priority,
+        'text': text,
+    })
+
+  def _complete(self):
+    self.app.gate.set()
+    wait_dispatches(self.pool)
+    return [text for text, _, _ in self.app.played]
+
+  def test_pipelined_dispatch(self):
+    self._put('den 5', ['den'])
+    self._put('garage 3', ['garage'])
+
+    self.assertIsNone(self.scheduler.schedule(0))
+    self.assertEqual(self.pool.active, 2)
+    self.assertSetEqual(self.pool.targets, {self.DEN_ECHO, self.GARAGE_ECHO})
+    self.assertDictEqual(self.scheduler.get_depths(0), {
+        'dispatch': 2,
+        'pacing': 2,
+        'retry': 0,
+    })
+
+    version = self.messages.version
+    self.assertListEqual(sorted(self._complete()), ['den 5', 'garage 3'])
+
+    self.assertEqual(self.pool.active, 0)
+    self.assertSetEqual(self.pool.targets, set())
+    self.assertGreater(self.messages.version, version)
+    self.assertDictEqual(self.scheduler.get_depths(5), {
+        'dispatch': 0,
+        'pacing': 0,
+        'retry': 0,
+    })
+
+  def test_target_order(self):
+    self._put('den 0', ['den'])
+    self._put('den 1', ['den'])
+
+    self.scheduler.schedule(0)
+    self.scheduler.schedule(0)
+
+    self.assertEqual(self.pool.active, 1)
+    self.assertEqual(len(self.messages), 1)
+
+    self._complete()
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(self._complete(), ['den 0', 'den 1'])
+
+  def test_preempt_waits_for_dispatch(self):
+    self._put('den 5', ['den'])
+    self.scheduler.schedule(0)
+    self._put('den urgent 1', ['den'], priority=10)
+
+    self.scheduler.schedule(1)
+
+    self.assertEqual(len(self.messages), 1)
+
+    self._complete()
+    self.scheduler.schedule(1)
+
+    self.assertListEqual(self._complete(), ['den 5', 'den urgent 1'])
+    self.assertEqual(self.scheduler.preempted, 1)
+
+  def test_capacity(self):
+    for area in ('den', 'garage', 'office'):
+      self._put(f'{area} 1', [area])
+
+    self.scheduler.schedule(0)
+
+    self.assertEqual(self.pool.active, 2)
+    self.assertEqual(len(self.messages), 1)
+    self.assertIsNone(self.scheduler.schedule(0))
+
+    self._complete()
+    self.scheduler.schedule(0)
+
+    self.assertListEqual(sorted(self._complete()),
+                         ['den 1', 'garage 1', 'office 1'])
+
+  def test_dispatch_errors(self):
+    self._put('error 1', ['den'])
+
+    self.scheduler.schedule(0)
+    self._complete()
+
+    self.assertEqual(len(self.app.logs), 1)
+    self.assertEqual(self.pool.active, 0)
+    self.assertSetEqual(self.pool.targets, set())
+
+  def test_timeout(self):
+    self.pool.timeout = 5
+    self.scheduler.retries = tts_dispatch.RetryQueue(backoff=10)
+    self._put('error 1', ['den'])
+
+    self.assertEqual(self.scheduler.schedule(0), 5)
+
+    self.app.now = 5
+    self._put('den 1', ['den'])
+    self.scheduler.schedule(5)
+
+    self.assertListEqual(self.app.logs, ['Dispatch timed out: error 1'])
+    self.assertEqual(self.app.counters['dispatch_timeouts'], 1)
+    # The hung dispatch keeps its thread but not its targets.
+    self.assertEqual(self.pool.active, 2)
+    self.assertSetEqual(self.pool.targets, {self.DEN_ECHO})
+    self.assertEqual(len(self.scheduler.retries), 1)
+
+    # The late failure of the timed out dispatch isn't retried again.
+    self.assertListEqual(self._complete(), ['den 1'])
+    self.assertEqual(len(self.scheduler.retries), 1)
+    self.assertSetEqual(self.pool.targets, set())
+
+
+def wait_dispatches(pool):
+  """Wait until the dispatch pool completes the dispatches in flight."""
+  if pool.executor is not None:
+    pool.executor.shutdown(wait=True)
+    pool.executor = None
+
+if __name__ == '__main__':
+  unittest.main()
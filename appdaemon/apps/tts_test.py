@@ -5,12 +5,28 @@ __author__ = 'Ark (ark@cho.red)'
 # pylint: disable=cell-var-from-loop
 # pylint: disable=missing-function-docstring
 
+import asyncio
+import contextlib
+import os
+import random
+import tempfile
+import time
 import unittest
+from concurrent import futures
+from threading import Event
 from unittest import mock
 
 import yaml  # pylint: disable=import-error
 
 import tts
+import tts_bitset
+import tts_dispatch
+import tts_duration
+import tts_metrics
+import tts_profile
+import tts_queue
+import tts_scheduler
+import tts_throttle
 
 
 class TestBase(unittest.TestCase):
@@ -107,13 +123,33 @@ class TestBase(unittest.TestCase):
         'rules': self.rules,
         'throttle': self.throttle,
     }
-    self.amazon_echo = tts.AmazonEcho(mock.Mock(), mock.Mock(),
-                                      mock.MagicMock(), args, mock.Mock(),
-                                      mock.Mock(), mock.Mock())
-    self.amazon_echo.initialize()
+    self.amazon_echo = self._create_app(args)
+
+  def _create_app(self, args):
+    amazon_echo = tts.AmazonEcho(mock.Mock(), mock.Mock(), mock.MagicMock(),
+                                 args, mock.Mock(), mock.Mock(), mock.Mock())
+    amazon_echo.initialize()
 
     tts.AmazonEcho.call_service = mock.Mock()
-    tts.AmazonEcho.get_state = mock.Mock()
+    tts.AmazonEcho.get_state = mock.Mock(return_value={})
+
+    return amazon_echo
+
+  def _mock_states(self, states):
+    """Mock entity states, entities not listed in `states` are missing."""
+    self.amazon_echo.get_state.return_value = {
+        entity_id: {
+            'state': state
+        } for entity_id, state in states.items()
+    }
+
+  @contextlib.contextmanager
+  def _patch_config(self, config, values):
+    """Patch the app config and recompile the routing plan."""
+    with mock.patch.dict(config, values):
+      self.amazon_echo.configure_routing()
+      yield
+    self.amazon_echo.configure_routing()
 
   def _assert_hass_called_with(self, text, targets):
     self.amazon_echo.call_service.assert_called_with('notify/alexa_media',
@@ -149,18 +185,983 @@ class TestArgs(TestBase):
   def test_area_off_wildcard_play_always(self):
     env_patch = {'play_always': {'normal_time': [TestBase.STAIRWAY]}}
 
-    with mock.patch.dict(self.amazon_echo.env, env_patch):
+    with self._patch_config(self.amazon_echo.env, env_patch):
       expected_targets = self.amazon_echo.tts(text=self.text, areas_off='*')
       self.assertListEqual(expected_targets, [])
 
   def test_area_off_wildcard_play_default(self):
     env_patch = {'play_default': {'normal_time': [TestBase.GREAT_ROOM]}}
 
-    with mock.patch.dict(self.amazon_echo.env, env_patch):
+    with self._patch_config(self.amazon_echo.env, env_patch):
       expected_targets = self.amazon_echo.tts(text=self.text, areas_off='*')
       self.assertListEqual(expected_targets, [])
 
 
+class TestHandleEvent(TestBase):
+  """Event handler tests."""
+
+  def _wait_called(self):
+    for _ in range(100):
+      if self.amazon_echo.call_service.called:
+        break
+      time.sleep(0.01)
+
+  def test_played_by_worker(self):
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [TestBase.GARAGE],
+        'text': self.text
+    }, {})
+    self._wait_called()
+
+    self._assert_hass_called_with(self.text, [TestBase.GARAGE_ECHO])
+    self.assertIn(TestBase.GARAGE_ECHO, self.amazon_echo.scheduler.busy)
+
+  def test_played_with_voice(self):
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [TestBase.GARAGE],
+        'text': self.text,
+        'voice': 'Matthew',
+    }, {})
+    self._wait_called()
+
+    self._assert_hass_called_with(f'<voice name="Matthew">{self.text}</voice>',
+                                  [TestBase.GARAGE_ECHO])
+
+  def test_played_by_dispatch_pool(self):
+    self.amazon_echo = self._create_app(
+        dict(self.amazon_echo.args, dispatch_threads=2, service_timeout=10))
+    self.assertEqual(self.amazon_echo.scheduler.pool.size, 2)
+
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [TestBase.GARAGE],
+        'text': self.text
+    }, {})
+    self._wait_called()
+    self.amazon_echo.terminate()
+
+    self._assert_hass_called_with(self.text, [TestBase.GARAGE_ECHO])
+    self.assertIn(TestBase.GARAGE_ECHO, self.amazon_echo.scheduler.busy)
+    # The pool threads make the service calls.
+    self.assertIsNone(self.amazon_echo.service_executor)
+
+  def test_worker_recovers_from_errors(self):
+    self.amazon_echo.WORKER_ERROR_DELAY_SECONDS = 0.01
+    schedule = self._mock_schedule([ValueError, None])
+
+    self.amazon_echo.messages.notify()
+    for _ in range(100):
+      if schedule.call_count > 1:
+        break
+      time.sleep(0.01)
+
+    self.assertEqual(schedule.call_count, 2)
+
+  def _mock_schedule(self, side_effect):
+    schedule = mock.Mock(side_effect=side_effect)
+    self.amazon_echo.scheduler.schedule = schedule
+    return schedule
+
+  def test_full_queue_does_not_block(self):
+    self.amazon_echo.messages = tts_queue.MessageQueue(
+        2, tts_queue.MessageQueue.POLICY_DROP_OLDEST)
+
+    for idx in range(4):
+      self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+          'priority': idx,
+          'text': str(idx)
+      }, {})
+
+    messages = self.amazon_echo.messages.messages
+    for message in messages:
+      del message['enqueued_at']
+    self.assertListEqual(
+        messages,
+        [{
+            'areas_off': None,
+            'areas_on': None,
+            'priority': idx,
+            'text': str(idx),
+        } for idx in (3, 2)],
+    )
+    self.assertEqual(
+        self.amazon_echo.messages.counters[
+            tts_queue.MessageQueue.OUTCOME_DROPPED_OLDEST], 2)
+
+
+class TestRateLimit(TestBase):
+  """Rate limit tests."""
+
+  def test_rate_limited(self):
+    self.amazon_echo.messages = tts_queue.MessageQueue()
+    self.amazon_echo.rate_limiter = tts_throttle.RateLimiter(
+        [tts_throttle.GlobalBudget(limit=2)])
+
+    for idx in range(3):
+      self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+          'text': str(idx),
+      }, {})
+
+    self.assertListEqual(
+        [message['text'] for message in self.amazon_echo.messages.messages],
+        ['0', '1'])
+    self.assertEqual(self.amazon_echo.rate_limiter.limited['global_budget'],
+                     1)
+
+  def test_rate_limited_event_not_throttled(self):
+    now = 0
+    self.amazon_echo.clock = lambda: now
+    self.amazon_echo.messages = tts_queue.MessageQueue()
+    self.amazon_echo.rate_limiter = tts_throttle.RateLimiter(
+        [tts_throttle.GlobalBudget(limit=1)])
+    event = {'entity_id': 'binary_sensor.front_door', 'text': 'Front door'}
+
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {'text': 'Other'},
+                                  {})
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, event, {})
+    now = 60
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, event, {})
+
+    self.assertListEqual(
+        [message['text'] for message in self.amazon_echo.messages.messages],
+        ['Other', 'Front door'])
+
+  def test_area_rate_limit(self):
+    self.amazon_echo.args['rate_limit'] = [{
+        'policy': 'sliding_window',
+        'limit': 1,
+        'areas': [TestBase.GARAGE],
+    }]
+    self.amazon_echo.configure()
+    targets = frozenset((TestBase.GARAGE_ECHO, TestBase.OFFICE_1_ECHO))
+
+    self.assertSetEqual(self.amazon_echo.limit_targets(targets, 0), set())
+    self.assertSetEqual(self.amazon_echo.limit_targets(targets, 1),
+                        {TestBase.GARAGE_ECHO})
+
+
+class TestMessageTtl(TestBase):
+  """Message time-to-live tests."""
+
+  def setUp(self):
+    super().setUp()
+
+    self.amazon_echo.messages = tts_queue.MessageQueue()
+    self.amazon_echo.ttl_mapping = {TestBase.GARAGE_LIGHT: 30}
+
+  def _put(self, data):
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, data, {})
+    return self.amazon_echo.messages.messages[-1]
+
+  def test_event_ttl(self):
+    message = self._put({'text': self.text, 'ttl': '10'})
+
+    self.assertEqual(message['ttl'], 10)
+    self.assertEqual(message['expires_at'], message['enqueued_at'] + 10)
+
+  def test_entity_ttl(self):
+    message = self._put({
+        'entity_id': TestBase.GARAGE_LIGHT,
+        'text': self.text,
+    })
+    self.assertEqual(message['ttl'], 30)
+
+    message = self._put({
+        'entity_id': TestBase.GARAGE_LIGHT,
+        'text': 'Other text',
+        'ttl': 5,
+    })
+    self.assertEqual(message['ttl'], 5)
+
+  def test_voice(self):
+    message = self._put({'text': self.text, 'voice': 'Matthew'})
+    self.assertEqual(message['voice'], 'Matthew')
+
+    message = self._put({'text': 'Other text'})
+    self.assertNotIn('voice', message)
+
+  def test_no_ttl(self):
+    message = self._put({'entity_id': TestBase.DEN_LIGHT, 'text': self.text})
+
+    self.assertNotIn('ttl', message)
+    self.assertNotIn('expires_at', message)
+
+  def test_ttl_config(self):
+    self.amazon_echo.args['ttl'] = [{TestBase.DEN_LIGHT: 60}]
+    self.amazon_echo.configure_throttling()
+
+    self.assertDictEqual(self.amazon_echo.ttl_mapping,
+                         {TestBase.DEN_LIGHT: 60})
+
+
+class TestMetrics(TestBase):
+  """Metrics tests."""
+
+  def setUp(self):
+    for method in ('run_every', 'set_state', 'worker'):
+      patcher = mock.patch.object(tts.AmazonEcho, method)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    super().setUp()
+
+    self.amazon_echo.args['metrics'] = {'interval': 30}
+    self.amazon_echo.configure()
+    self.metrics = self.amazon_echo.metrics
+
+  def _put(self, text, areas_on=None):
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': areas_on,
+        'text': text
+    }, {})
+
+  def _schedule(self):
+    return self.amazon_echo.scheduler.schedule(time.monotonic())
+
+  def test_disabled(self):
+    self.amazon_echo.args.pop('metrics')
+    self.amazon_echo.configure()
+
+    self.assertIsNone(self.amazon_echo.metrics)
+    self.amazon_echo.tts(self.text, None, [TestBase.GARAGE])
+
+  def test_initialize_publishes(self):
+    self.amazon_echo.initialize()
+
+    self.assertTupleEqual(self.amazon_echo.run_every.call_args[0][1:],
+                          ('now', 30))
+
+  def test_event_counters(self):
+    self.amazon_echo.rate_limiter = tts_throttle.RateLimiter(
+        [tts_throttle.GlobalBudget(limit=2)])
+
+    for text in ('First', 'First', 'Second'):
+      self._put(text)
+
+    self.assertDictEqual(
+        dict(self.metrics.counters), {
+            'events': 3,
+            'queue_deduplicated': 1,
+            'queue_enqueued': 1,
+            'rate_limited': 1,
+        })
+
+  def test_message_spans(self):
+    self._put(self.text, [TestBase.GARAGE])
+    self._schedule()
+
+    for name in ('pacing_seconds', 'routing_seconds', 'service_seconds',
+                 'state_lookups', 'wait_seconds'):
+      self.assertEqual(self.metrics.totals[name][0], 1, name)
+    self.assertEqual(self.metrics.totals['state_lookups'][1], 1)
+    self.assertEqual(self.metrics.counters['dispatched'], 1)
+
+  def test_single_state_lookup_per_pass(self):
+    for area in (TestBase.DEN, TestBase.GARAGE, TestBase.OFFICE_1):
+      self._put(f'{self.text} {area}', [area])
+    self._schedule()
+
+    self.assertEqual(self.metrics.counters['dispatched'], 3)
+    self.assertEqual(self.metrics.totals['routing_seconds'][0], 3)
+    self.assertListEqual(list(self.metrics.totals['state_lookups']), [1, 1])
+
+  def test_service_errors(self):
+    self.amazon_echo.call_service.side_effect = ValueError
+
+    with self.assertRaises(ValueError):
+      self.amazon_echo.tts(self.text, None, [TestBase.GARAGE])
+
+    self.assertEqual(self.metrics.counters['service_errors'], 1)
+    self.assertEqual(self.metrics.totals['service_seconds'][0], 1)
+
+  def test_publish_metrics(self):
+    self._put(self.text)
+
+    self.amazon_echo.publish_metrics({})
+
+    self.amazon_echo.set_state.assert_any_call('sensor.tts_queue_depth',
+                                               state=1,
+                                               attributes={})
+    self.amazon_echo.set_state.assert_any_call('sensor.tts_events',
+                                               state=1,
+                                               attributes={})
+    for stage in ('dispatch', 'pacing', 'retry'):
+      self.amazon_echo.set_state.assert_any_call(
+          f'sensor.tts_{stage}_queue_depth', state=0, attributes={})
+    for name in ('entries', 'evicted', 'expired'):
+      self.amazon_echo.set_state.assert_any_call(f'sensor.tts_throttle_{name}',
+                                                 state=0,
+                                                 attributes={})
+
+  def test_publish_mirror_resyncs(self):
+    self.amazon_echo.args['state_mirror'] = {}
+    with mock.patch.object(tts.AmazonEcho, 'listen_state'):
+      self.amazon_echo.configure_routing()
+    self.amazon_echo.tts(self.text)
+
+    self.amazon_echo.publish_metrics({})
+
+    self.amazon_echo.set_state.assert_any_call('sensor.tts_mirror_resyncs',
+                                               state=1,
+                                               attributes={})
+
+  def test_publish_queue_histograms(self):
+    self.amazon_echo.messages.wait_times[2].add(3)
+    self.amazon_echo.messages.expired_ages[-1].add(900)
+
+    self.amazon_echo.publish_metrics({})
+
+    sensors = {
+        call.args[0]: call.kwargs
+        for call in self.amazon_echo.set_state.call_args_list
+    }
+    self.assertEqual(sensors['sensor.tts_queue_wait_seconds']['state'], 5)
+    self.assertEqual(
+        sensors['sensor.tts_expired_age_seconds']['attributes']['priority']
+        ['-1']['max'], 900)
+
+  def test_publish_breaker_state(self):
+    self.amazon_echo.args['circuit_breaker'] = {'failures': 1}
+    self.amazon_echo.configure()
+    self.amazon_echo.call_service.side_effect = ValueError
+
+    with self.assertRaises(ValueError):
+      self.amazon_echo.tts(self.text, None, [TestBase.GARAGE])
+    self.amazon_echo.publish_metrics({})
+
+    self.amazon_echo.set_state.assert_any_call('sensor.tts_breaker_open',
+                                               state=1,
+                                               attributes={})
+    self.assertEqual(self.amazon_echo.metrics.counters['breaker_trips'], 1)
+
+
+class TestProfile(TestBase):
+  """Sampling profiler tests."""
+
+  def setUp(self):
+    super().setUp()
+
+    # pylint: disable=consider-using-with
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.amazon_echo.config_dir = temp_dir.name
+    self.profile_dir = os.path.join(temp_dir.name,
+                                    tts.AmazonEcho.PROFILE_DIR_DEFAULT)
+
+  def _profile(self, data):
+    with mock.patch.object(tts, 'Thread') as thread:
+      self.amazon_echo.handle_profile_event(tts.AmazonEcho.PROFILE_EVENT_NAME,
+                                            data, {})
+    return thread
+
+  def test_profile(self):
+    thread = self._profile({'duration': 0, 'interval': 0.5})
+    profiler, duration = thread.call_args[1]['args']
+
+    self.assertIs(self.amazon_echo.profiler, profiler)
+    self.assertEqual(duration, 0)
+    self.assertEqual(profiler.interval, 0.5)
+    self.assertSetEqual(set(profiler.entries),
+                        set(self.amazon_echo.get_profile_entries()))
+    self.assertIn(self.amazon_echo.scheduler.pool_class.run.__code__,
+                  profiler.entries)
+    thread.return_value.start.assert_called_once()
+
+    self.amazon_echo.profile(profiler, duration)
+
+    self.assertIsNone(self.amazon_echo.profiler)
+    self.assertEqual(profiler.samples, 1)
+    self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+    self.assertTrue(os.listdir(self.profile_dir)[0].endswith('.folded'))
+
+  def test_defaults(self):
+    thread = self._profile({})
+    profiler, duration = thread.call_args[1]['args']
+
+    self.assertEqual(duration,
+                     tts_profile.SamplingProfiler.DURATION_DEFAULT_SECONDS)
+    self.assertEqual(profiler.interval,
+                     tts_profile.SamplingProfiler.INTERVAL_DEFAULT_SECONDS)
+
+  def test_duration_limit(self):
+    thread = self._profile({'duration': 86400})
+
+    self.assertEqual(thread.call_args[1]['args'][1],
+                     tts_profile.SamplingProfiler.DURATION_MAX_SECONDS)
+
+  def test_already_running(self):
+    self._profile({})
+    profiler = self.amazon_echo.profiler
+
+    thread = self._profile({})
+
+    thread.assert_not_called()
+    self.assertIs(self.amazon_echo.profiler, profiler)
+
+  def test_terminate(self):
+    self._profile({})
+    profiler = self.amazon_echo.profiler
+
+    self.amazon_echo.terminate()
+
+    self.assertTrue(profiler.stopped.is_set())
+
+
+class TestDispatch(TestBase):
+  """Dispatch failure handling tests."""
+
+  def setUp(self):
+    super().setUp()
+
+    self.now = 0
+    self.amazon_echo.clock = lambda: self.now
+    self.amazon_echo.args.update({
+        'circuit_breaker': {
+            'failures': 2,
+            'reset_time': 60
+        },
+        'retry': {
+            'attempts': 2
+        },
+    })
+    self.amazon_echo.configure()
+    self.breaker = self.amazon_echo.breaker
+
+  def _mock_hanging_service(self):
+    hang = Event()
+    self.addCleanup(hang.set)
+    self.amazon_echo.call_service.side_effect = lambda *args, **kwargs: (
+        hang.wait())
+    return hang.set
+
+  def _tts(self):
+    return self.amazon_echo.tts(self.text, None, [TestBase.GARAGE])
+
+  def test_disabled(self):
+    for name in ('circuit_breaker', 'retry'):
+      self.amazon_echo.args.pop(name)
+    self.amazon_echo.configure()
+
+    self.assertIsNone(self.amazon_echo.breaker)
+    self.assertIsNone(self.amazon_echo.scheduler.retries)
+    self.assertIsNone(self.amazon_echo.service_timeout)
+
+  def test_retry_config(self):
+    self.assertEqual(self.amazon_echo.scheduler.retries.attempts, 2)
+    self.assertEqual(self.amazon_echo.scheduler.retries.size,
+                     tts_dispatch.RetryQueue.SIZE_DEFAULT)
+
+  def test_breaker_opens(self):
+    self.amazon_echo.call_service.side_effect = ValueError
+
+    for _ in range(2):
+      with self.assertRaises(ValueError):
+        self._tts()
+    with self.assertRaises(tts_dispatch.CircuitOpenError):
+      self._tts()
+
+    self.assertEqual(self.amazon_echo.call_service.call_count, 2)
+    self.assertEqual(self.breaker.state,
+                     tts_dispatch.CircuitBreaker.STATE_OPEN)
+    self.assertEqual(self.breaker.rejected, 1)
+    self.assertEqual(self.breaker.trips, 1)
+
+  def test_breaker_closes(self):
+    self.amazon_echo.call_service.side_effect = ValueError
+    for _ in range(2):
+      with self.assertRaises(ValueError):
+        self._tts()
+
+    self.now = 60
+    self.amazon_echo.call_service.side_effect = None
+
+    self.assertListEqual(self._tts(), [TestBase.GARAGE_ECHO])
+    self.assertEqual(self.breaker.state,
+                     tts_dispatch.CircuitBreaker.STATE_CLOSED)
+
+  def test_service_timeout(self):
+    self.amazon_echo.args['service_timeout'] = 0.01
+    self.amazon_echo.configure()
+    self._mock_hanging_service()
+
+    with self.assertRaises((asyncio.TimeoutError, futures.TimeoutError)):
+      self._tts()
+    self.amazon_echo.terminate()
+
+    self.assertEqual(self.amazon_echo.breaker.failures, 1)
+
+  def test_service_threads_busy(self):
+    self.amazon_echo.args['service_timeout'] = 0.01
+    self.amazon_echo.args.pop('circuit_breaker')
+    self.amazon_echo.configure()
+    release = self._mock_hanging_service()
+
+    for _ in range(tts.AmazonEcho.SERVICE_THREADS):
+      with self.assertRaises(futures.TimeoutError):
+        self._tts()
+    with self.assertRaises(tts_dispatch.ServiceBusyError):
+      self._tts()
+    self.assertEqual(self.amazon_echo.call_service.call_count,
+                     tts.AmazonEcho.SERVICE_THREADS)
+
+    release()
+    self.amazon_echo.service_executor.shutdown(wait=True)
+    self.amazon_echo.service_executor = None
+
+    # The returned calls free their threads.
+    self.amazon_echo.call_service.side_effect = None
+    self.assertListEqual(self._tts(), [TestBase.GARAGE_ECHO])
+
+  def test_failed_dispatch_retry(self):
+    self.amazon_echo.call_service.side_effect = ValueError
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [TestBase.GARAGE],
+        'text': self.text
+    }, {})
+    scheduler = self.amazon_echo.scheduler
+
+    self.assertEqual(self._schedule(), 5)
+    self.assertEqual(len(scheduler.retries), 1)
+    self.assertDictEqual(scheduler.busy, {})
+
+    self.now = 5
+    self.amazon_echo.call_service.side_effect = None
+    self._schedule()
+
+    self.assertEqual(len(scheduler.retries), 0)
+    self._assert_hass_called_with(self.text, [TestBase.GARAGE_ECHO])
+    self.assertDictEqual(dict(scheduler.retries.counters), {
+        tts_dispatch.RetryQueue.OUTCOME_REQUEUED: 1,
+        tts_dispatch.RetryQueue.OUTCOME_SCHEDULED: 1,
+    })
+
+  def _schedule(self):
+    return self.amazon_echo.scheduler.schedule(self.now)
+
+
+class TestChunk(TestBase):
+  """Long message chunking tests."""
+
+  def setUp(self):
+    super().setUp()
+
+    self.amazon_echo.args['chunk'] = {'length': 20}
+    self.amazon_echo.configure()
+
+  def _schedule(self):
+    return self.amazon_echo.scheduler.schedule(time.monotonic())
+
+  def test_disabled(self):
+    self.amazon_echo.args.pop('chunk')
+    self.amazon_echo.configure()
+
+    self.assertIsNone(self.amazon_echo.scheduler.chunk_length)
+
+  def test_default_length(self):
+    self.amazon_echo.args['chunk'] = {}
+    self.amazon_echo.configure()
+
+    self.assertEqual(self.amazon_echo.scheduler.chunk_length,
+                     tts_scheduler.PlaybackScheduler.CHUNK_LENGTH_DEFAULT)
+
+  def test_chunks(self):
+    self.amazon_echo.handle_event(tts.AmazonEcho.EVENT_NAME, {
+        'areas_on': [TestBase.GARAGE],
+        'text': 'First sentence here. Second sentence here.'
+    }, {})
+
+    self._schedule()
+
+    self._assert_hass_called_with('First sentence here.',
+                                  [TestBase.GARAGE_ECHO])
+    self.assertListEqual(
+        [message['text'] for message in self.amazon_echo.messages.messages],
+        ['Second sentence here.'])
+
+
+class TestRoutingPlan(TestBase):
+  """Routing plan tests."""
+
+  def test_targets_all(self):
+    plan = tts.RoutingPlan(
+        {'play_default': {
+            'normal_time': [TestBase.STAIRWAY]
+        }}, self.rules, self.quite_time)
+
+    self.assertEqual(
+        plan.targets_all, {rule['target'] for rule in self.rules.values()
+                          }.union((TestBase.STAIRWAY_ECHO,)))
+    self.assertEqual(plan.get_targets('*'), plan.targets_all)
+    self.assertEqual(plan.get_targets(None), set())
+    self.assertEqual(plan.play_always_quite_time, set())
+
+  def test_if_not(self):
+    plan = tts.RoutingPlan(self.env, self.rules, self.quite_time)
+
+    self.assertEqual(
+        plan.if_not,
+        tuple((rule['target'], rule['if_not'].get('target'),
+               tuple(rule['if_not']['conditions']))
+              for rule in self.rules.values()
+              if 'if_not' in rule))
+
+  def test_entities_order(self):
+    plan = tts.RoutingPlan(self.env, self.rules, self.quite_time)
+    targets = sorted(plan.targets_all)
+
+    self.assertEqual(len(plan.entities), len(set(plan.entities)))
+    self.assertEqual(plan.entities[0], self.quite_time)
+    self.assertEqual(
+        plan.entities[-2 * len(targets):],
+        (*targets, *(plan.get_dnd_switch(target) for target in targets)))
+
+  def test_plan_rebuilt_on_configure_routing(self):
+    plan = self.amazon_echo.plan
+
+    self.amazon_echo.tts(self.text)
+    self.assertIs(self.amazon_echo.plan, plan)
+
+    self.amazon_echo.configure_routing()
+    self.assertIsNot(self.amazon_echo.plan, plan)
+
+
+class TestRoutingEngine(TestBase):
+  """Routing engine config tests."""
+
+  def test_bitset(self):
+    self.amazon_echo.args['routing_engine'] = 'bitset'
+    self.amazon_echo.configure_routing()
+    self._mock_states({
+        TestBase.GARAGE_LIGHT: tts.AmazonEcho.STATE_ON,
+        TestBase.DEN_ECHO: tts.AmazonEcho.STATE_PLAYING,
+    })
+
+    self.assertIsInstance(self.amazon_echo.router, tts_bitset.BitsetRouter)
+    self.assertListEqual(self.amazon_echo.tts(self.text),
+                         [TestBase.DEN_ECHO, TestBase.GARAGE_ECHO])
+    self.assertEqual(self.amazon_echo.state_lookups, 1)
+
+  def test_unknown(self):
+    self.amazon_echo.args['routing_engine'] = 'unknown'
+
+    with self.assertRaises(ValueError) as ctx:
+      self.amazon_echo.configure_routing()
+    self.assertIn('Unknown routing engine: unknown', str(ctx.exception))
+
+
+class TestStateSnapshot(TestBase):
+  """State snapshot tests."""
+
+  def test_single_state_lookup(self):
+    self._mock_states({
+        TestBase.GREAT_ROOM_MOTION: tts.AmazonEcho.STATE_ON,
+        TestBase.DEN_ECHO: tts.AmazonEcho.STATE_PLAYING,
+    })
+
+    targets = self.amazon_echo.tts(self.text)
+
+    self.assertListEqual(targets, [TestBase.DEN_ECHO, TestBase.GREAT_ROOM_ECHO])
+    self.amazon_echo.get_state.assert_called_once_with(copy=False)
+    self.assertEqual(self.amazon_echo.state_lookups, 1)
+
+  def test_dnd_mode_areas_on_outside_of_plan(self):
+    self._mock_states({'switch.attic_echo_do_not_disturb': 'on'})
+
+    targets = self.amazon_echo.tts(self.text, areas_on=['attic', 'cellar'])
+
+    self.assertListEqual(targets, ['media_player.cellar_echo'])
+    self.assertEqual(self.amazon_echo.state_lookups, 1)
+
+  def test_read_states_skips_unknown_entities(self):
+    self._mock_states({TestBase.DEN_LIGHT: tts.AmazonEcho.STATE_ON})
+
+    self.assertDictEqual(
+        self.amazon_echo.read_states((TestBase.DEN_LIGHT, TestBase.DEN_MOTION)),
+        {TestBase.DEN_LIGHT: tts.AmazonEcho.STATE_ON})
+
+
+class TestPlaybackMonitor(TestBase):
+  """Playback monitor tests."""
+
+  def setUp(self):
+    for method in ('cancel_listen_state', 'listen_state'):
+      patcher = mock.patch.object(tts.AmazonEcho, method)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    super().setUp()
+
+    self.amazon_echo.monitor = self.amazon_echo.create_playback_monitor(True)
+    self.monitor = self.amazon_echo.monitor
+    self.scheduler = self.amazon_echo.scheduler
+
+  def _dispatch(self, text, targets):
+    message = {'priority': tts_queue.PRIORITY_DEFAULT, 'text': text}
+    self.scheduler.occupy(message, targets, time.monotonic())
+    return message
+
+  def _set_state(self, entity_id, old, new):
+    self.monitor.handle_state(entity_id, 'state', old, new, {})
+
+  def _play(self, entity_id):
+    self._set_state(entity_id, 'idle', tts.AmazonEcho.STATE_PLAYING)
+    self._set_state(entity_id, tts.AmazonEcho.STATE_PLAYING, 'idle')
+
+  def test_listens_to_media_players(self):
+    self.amazon_echo.listen_state.assert_called_with(
+        self.monitor.handle_state, 'media_player')
+
+  def test_release_on_playback_end(self):
+    self._dispatch(self.text, [TestBase.DEN_ECHO, TestBase.GARAGE_ECHO])
+    version = self.amazon_echo.messages.version
+
+    self._play(TestBase.DEN_ECHO)
+
+    self.assertNotIn(TestBase.DEN_ECHO, self.scheduler.busy)
+    self.assertIn(TestBase.GARAGE_ECHO, self.scheduler.busy)
+    self.assertEqual(self.scheduler.released, 1)
+    self.assertEqual(self.amazon_echo.durations.calibrations, 1)
+    self.assertEqual(self.amazon_echo.messages.version, version + 1)
+
+  def test_calibrate_voice(self):
+    self.amazon_echo.durations.voices['Matthew'] = 2
+    message = self._dispatch('One two three four', [TestBase.DEN_ECHO])
+    message['voice'] = 'Matthew'
+    self.amazon_echo.clock = mock.Mock(side_effect=(0, 4))
+
+    self._play(TestBase.DEN_ECHO)
+
+    self.assertAlmostEqual(self.amazon_echo.durations.voices['Matthew'], 1.8)
+    self.assertEqual(self.amazon_echo.durations.words_per_second,
+                     tts_duration.DurationEstimator.WORDS_PER_SECOND_DEFAULT)
+
+  def test_no_calibration(self):
+    self.monitor.calibrate = False
+    self._dispatch(self.text, [TestBase.DEN_ECHO])
+
+    self._play(TestBase.DEN_ECHO)
+
+    self.assertEqual(self.scheduler.released, 1)
+    self.assertEqual(self.amazon_echo.durations.calibrations, 0)
+
+  def test_playback_started_before_dispatch(self):
+    self._dispatch('First', [TestBase.DEN_ECHO])
+    self._set_state(TestBase.DEN_ECHO, 'idle', tts.AmazonEcho.STATE_PLAYING)
+
+    # The first message estimated duration expired.
+    self._dispatch('Second', [TestBase.DEN_ECHO])
+    self._set_state(TestBase.DEN_ECHO, tts.AmazonEcho.STATE_PLAYING, 'idle')
+    self.assertIn(TestBase.DEN_ECHO, self.scheduler.busy)
+
+    self._play(TestBase.DEN_ECHO)
+    self.assertNotIn(TestBase.DEN_ECHO, self.scheduler.busy)
+    self.assertEqual(self.scheduler.released, 1)
+
+  def test_ignores_other_targets(self):
+    self._dispatch(self.text, [TestBase.DEN_ECHO])
+
+    self._play(TestBase.GARAGE_ECHO)
+    self._set_state(TestBase.DEN_ECHO, 'idle', 'paused')
+
+    self.assertIn(TestBase.DEN_ECHO, self.scheduler.busy)
+    self.assertEqual(self.scheduler.released, 0)
+
+
+class TestStateMirror(TestBase):
+  """State mirror tests."""
+
+  def setUp(self):
+    for method in ('cancel_listen_state', 'listen_state'):
+      patcher = mock.patch.object(tts.AmazonEcho, method)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    super().setUp()
+
+    self.amazon_echo.args['state_mirror'] = {'max_age': 60}
+    self.amazon_echo.configure_routing()
+    self.mirror = self.amazon_echo.mirror
+
+  def test_listens_to_plan_entities(self):
+    entity_ids = {
+        c.args[1] for c in self.amazon_echo.listen_state.call_args_list
+    }
+
+    self.assertEqual(entity_ids, set(self.amazon_echo.plan.entities))
+    self.assertIn(self.quite_time, entity_ids)
+    self.assertIn(TestBase.GARAGE_ECHO, entity_ids)
+    self.assertIn('switch.garage_echo_do_not_disturb', entity_ids)
+
+  def test_state_changes_without_state_lookups(self):
+    self.amazon_echo.tts(self.text)
+    self.assertEqual(self.amazon_echo.state_lookups, 1)
+
+    self.mirror.handle_state(TestBase.GARAGE_LIGHT, 'state',
+                             tts.AmazonEcho.STATE_OFF,
+                             tts.AmazonEcho.STATE_ON, {})
+    self.assertListEqual(self.amazon_echo.tts(self.text),
+                         [TestBase.GARAGE_ECHO])
+    self.assertEqual(self.amazon_echo.state_lookups, 0)
+
+    self.mirror.handle_state(TestBase.GARAGE_LIGHT, 'state',
+                             tts.AmazonEcho.STATE_ON, None, {})
+    self.assertListEqual(self.amazon_echo.tts(self.text), [])
+    self.assertEqual(self.amazon_echo.state_lookups, 0)
+    self.assertEqual(self.mirror.resyncs, 1)
+
+  def test_resync_stale_mirror(self):
+    self.amazon_echo.tts(self.text)
+
+    self._mock_states({TestBase.DEN_LIGHT: tts.AmazonEcho.STATE_ON})
+    self.mirror.synced_at -= 61
+
+    self.assertListEqual(self.amazon_echo.tts(self.text), [TestBase.DEN_ECHO])
+    self.assertEqual(self.amazon_echo.state_lookups, 1)
+    self.assertEqual(self.mirror.resyncs, 2)
+
+  def test_cancel_on_configure_routing(self):
+    handles = self.mirror.handles
+
+    self.amazon_echo.configure_routing()
+
+    self.assertEqual(self.amazon_echo.cancel_listen_state.call_count,
+                     len(handles))
+    self.assertIsNot(self.amazon_echo.mirror, self.mirror)
+
+
+class TestRoutingCache(TestBase):
+  """Routing cache tests."""
+
+  def setUp(self):
+    for method in ('cancel_listen_state', 'listen_state'):
+      patcher = mock.patch.object(tts.AmazonEcho, method)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    super().setUp()
+
+    self.amazon_echo.metrics = tts_metrics.Metrics('tts')
+    self.amazon_echo.args['routing_cache'] = {'size': 2}
+    self.amazon_echo.args['state_mirror'] = {}
+    self.amazon_echo.configure_routing()
+    self.mirror = self.amazon_echo.mirror
+
+  def _get_counts(self):
+    counters = self.amazon_echo.metrics.counters
+    return counters['routing_cache_hits'], counters['routing_cache_misses']
+
+  def _set_state(self, entity_id, new):
+    old = self.mirror.index.states.get(entity_id)
+    self.mirror.handle_state(entity_id, 'state', old, new, {})
+
+  def test_requires_state_mirror(self):
+    del self.amazon_echo.args['state_mirror']
+
+    with self.assertRaises(ValueError) as ctx:
+      self.amazon_echo.configure_routing()
+    self.assertIn('requires the state mirror', str(ctx.exception))
+
+  def test_hit(self):
+    self._mock_states({TestBase.DEN_LIGHT: tts.AmazonEcho.STATE_ON})
+
+    for _ in range(3):
+      self.assertListEqual(self.amazon_echo.tts(self.text), [TestBase.DEN_ECHO])
+    self.assertEqual(self._get_counts(), (2, 1))
+
+    self.assertListEqual(
+        self.amazon_echo.tts(self.text, areas_on=[TestBase.GARAGE]),
+        [TestBase.DEN_ECHO, TestBase.GARAGE_ECHO])
+    self.assertEqual(self._get_counts(), (2, 2))
+
+  def test_contributing_entity_change(self):
+    self._mock_states({TestBase.DEN_LIGHT: tts.AmazonEcho.STATE_ON})
+    self.amazon_echo.tts(self.text)
+
+    for entity_id, state, targets in (
+        (TestBase.DEN_LIGHT, tts.AmazonEcho.STATE_OFF, []),
+        (TestBase.DEN_LIGHT, tts.AmazonEcho.STATE_ON, [TestBase.DEN_ECHO]),
+        ('switch.den_echo_do_not_disturb', tts.AmazonEcho.STATE_ON, []),
+        (TestBase.GARAGE_ECHO, tts.AmazonEcho.STATE_PLAYING,
+         [TestBase.GARAGE_ECHO]),
+        (self.quite_time, tts.AmazonEcho.STATE_ON, [TestBase.GARAGE_ECHO]),
+    ):
+      self._set_state(entity_id, state)
+      self.assertListEqual(self.amazon_echo.tts(self.text), targets)
+
+    self.assertEqual(self._get_counts(), (0, 6))
+
+  def test_unrelated_state_change(self):
+    self.amazon_echo.tts(self.text)
+
+    self._set_state(TestBase.DEN_LIGHT, 'unavailable')
+    self._set_state(TestBase.GARAGE_ECHO, 'idle')
+    self.amazon_echo.tts(self.text)
+
+    self.assertEqual(self._get_counts(), (1, 1))
+
+  def test_lru_eviction(self):
+    for areas_on in (['a'], ['b'], ['a'], ['c'], ['b']):
+      self.amazon_echo.tts(self.text, areas_on=areas_on)
+
+    self.assertEqual(self._get_counts(), (1, 4))
+    self.assertEqual(len(self.mirror.cache.entries), 2)
+
+
+class TestRoutingIndex(TestBase):
+  """Routing index tests."""
+
+  def _random_states(self, rnd, entities):
+    states = {}
+    for entity_id in entities:
+      state = rnd.choice((tts.AmazonEcho.STATE_OFF, tts.AmazonEcho.STATE_ON,
+                          tts.AmazonEcho.STATE_PLAYING, None))
+      if state:
+        states[entity_id] = state
+    return states
+
+  def test_same_targets_as_plan(self):
+    rnd = random.Random(42)
+    plan = tts.RoutingPlan(self.env, self.rules, self.quite_time)
+    index = tts.RoutingIndex(plan)
+    areas = (None, (), '*', (TestBase.GARAGE,), (TestBase.DEN, 'attic'))
+
+    for _ in range(500):
+      states = self._random_states(rnd, plan.entities)
+      if rnd.random() < 0.5:
+        index.reset(states)
+      else:
+        for entity_id in plan.entities:
+          index.update(entity_id, states.get(entity_id))
+
+      areas_off = rnd.choice(areas)
+      areas_on = rnd.choice(areas[:2] + areas[3:])
+      targets_off = plan.get_targets(areas_off)
+      targets_on = plan.get_targets(areas_on)
+
+      self.assertListEqual(
+          index.route(targets_off, targets_on, states),
+          plan.route(states, targets_off, targets_on),
+      )
+
+  def test_update_affected_rules_only(self):
+    plan = tts.RoutingPlan(self.env, self.rules, self.quite_time)
+    index = tts.RoutingIndex(plan)
+
+    index.update(TestBase.BATHROOM_2_LIGHT, tts.AmazonEcho.STATE_ON)
+    self.assertEqual(index.eligible, {TestBase.BATHROOM_2_ECHO})
+
+    index.update(TestBase.BATHROOM_2_MOTION, tts.AmazonEcho.STATE_ON)
+    index.update(TestBase.BATHROOM_2_LIGHT, tts.AmazonEcho.STATE_OFF)
+    self.assertEqual(index.eligible, {TestBase.BATHROOM_2_ECHO})
+
+    index.update(TestBase.BATHROOM_2_DOOR, tts.AmazonEcho.STATE_ON)
+    self.assertEqual(index.eligible, set())
+
+    index.update(TestBase.BATHROOM_2_DOOR, None)
+    index.update(self.quite_time, tts.AmazonEcho.STATE_ON)
+    self.assertEqual(index.eligible, {TestBase.BATHROOM_2_ECHO})
+    self.assertListEqual(index.route(frozenset(), frozenset(), {}), [])
+
+
 class TestTargetAreaBase(TestBase):
   """Target area test base."""
 
@@ -224,13 +1225,13 @@ class TestConflictingAreasTargets(TestTargetAreaBase):
   }
 
   def test_not_played(self):
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch):
+    with self._patch_config(self.amazon_echo.env, self.env_patch):
       super()._test_not_played(set(self.areas_on).difference(self.areas_off),
                                areas_off=self.areas_off,
                                areas_on=self.areas_on)
 
   def test_played(self):
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch):
+    with self._patch_config(self.amazon_echo.env, self.env_patch):
       super()._test_played(set(self.areas_on).difference(self.areas_off),
                            areas_off=self.areas_off,
                            areas_on=self.areas_on)
@@ -266,13 +1267,13 @@ class TestPlayAlwaysAndPlayDefaultTargets(TestTargetAreaBase):
 
   def test_not_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_not_played((), areas_off=self.play_always)
       super()._test_not_played((), areas_off=self.play_default)
 
-      self.amazon_echo.get_state.side_effect = lambda sensor: {
+      self._mock_states({
           TestBase.GREAT_ROOM_MOTION: tts.AmazonEcho.STATE_ON
-      }.get(sensor, tts.AmazonEcho.STATE_OFF)
+      })
       super()._test_not_played(
           set(self.play_always).union((TestBase.GREAT_ROOM,)))
       super()._test_not_played((TestBase.GREAT_ROOM,),
@@ -280,18 +1281,18 @@ class TestPlayAlwaysAndPlayDefaultTargets(TestTargetAreaBase):
       super()._test_not_played((TestBase.GREAT_ROOM,))
 
     # Quite time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
-      self.amazon_echo.get_state.side_effect = lambda sensor: {
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
+      self._mock_states({
           self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON
-      }.get(sensor, tts.AmazonEcho.STATE_OFF)
+      })
 
       super()._test_not_played((), areas_off=self.play_always)
       super()._test_not_played((), areas_off=self.play_default)
 
-      self.amazon_echo.get_state.side_effect = lambda sensor: {
+      self._mock_states({
           self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON,
           TestBase.GREAT_ROOM_MOTION: tts.AmazonEcho.STATE_ON
-      }.get(sensor, tts.AmazonEcho.STATE_OFF)
+      })
 
       super()._test_not_played(set(self.play_always))
       super()._test_not_played((), areas_off=self.play_always)
@@ -299,14 +1300,14 @@ class TestPlayAlwaysAndPlayDefaultTargets(TestTargetAreaBase):
 
   def test_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_played(self.play_always)
 
     # Quite time.
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
+    })
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
       super()._test_played(self.play_always)
 
 
@@ -337,26 +1338,26 @@ class TestPlayAlwaysTargets(TestTargetAreaBase):
 
   def test_not_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_not_played((), areas_off=self.areas)
 
     # Quite time.
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
+    })
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
       super()._test_not_played((), areas_off=self.areas)
 
   def test_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_played(self.areas)
 
     # Quite time.
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
+    })
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
       super()._test_played(self.areas)
 
 
@@ -387,26 +1388,26 @@ class TestPlayDefaultTargets(TestTargetAreaBase):
 
   def test_not_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_not_played((), areas_off=self.areas)
 
     # Quite time.
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
+    })
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
       super()._test_not_played((), areas_off=self.areas)
 
   def test_played(self):
     # Normal time.
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_normal_time):
+    with self._patch_config(self.amazon_echo.env, self.env_patch_normal_time):
       super()._test_played(self.areas)
 
     # Quite time.
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch_quite_time):
+    })
+    with self._patch_config(self.amazon_echo.env, self.env_patch_quite_time):
       super()._test_played(self.areas)
 
 
@@ -423,15 +1424,15 @@ class TestTargetConditionBase(TestBase):
   def _test_not_played_normal_time(self, area, conditions=(), media_players=()):
     """Assert text was not played on the target during normal time. """
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         **{c: tts.AmazonEcho.STATE_ON for c in conditions},
         **{mp: tts.AmazonEcho.STATE_PLAYING for mp in media_players}
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
+    })
 
     target = self.amazon_echo.get_target(area)
     actual_targets = self.amazon_echo.tts(text=self.text, areas_off=[area])
-    with mock.patch.dict(self.amazon_echo.env, self.env_patch):
-      with mock.patch.dict(self.amazon_echo.rules, self.rules):
+    with self._patch_config(self.amazon_echo.env, self.env_patch):
+      with self._patch_config(self.amazon_echo.rules, self.rules):
         for condition in conditions:
           self.assertNotIn(
               target,
@@ -453,13 +1454,13 @@ class TestTargetConditionBase(TestBase):
   def _test_played_normal_time(self, area, conditions=(), media_players=()):
     """Assert text was played on the target during normal time."""
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         **{c: tts.AmazonEcho.STATE_ON for c in conditions},
         **{mp: tts.AmazonEcho.STATE_PLAYING for mp in media_players}
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
+    })
 
     target = self.amazon_echo.get_target(area)
-    with mock.patch.dict(self.amazon_echo.rules,
+    with self._patch_config(self.amazon_echo.rules,
                          {area: {
                              'conditions': conditions,
                              'target': target
@@ -485,14 +1486,14 @@ class TestTargetConditionBase(TestBase):
   def _test_not_played_quite_time(self, area, conditions=(), media_players=()):
     """Assert text was not played on the target during quite time."""
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         **{c: tts.AmazonEcho.STATE_ON for c in conditions},
         **{mp: tts.AmazonEcho.STATE_PLAYING for mp in media_players}
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
+    })
 
     target = self.amazon_echo.get_target(area)
     actual_targets = self.amazon_echo.tts(text=self.text, areas_off=[area])
-    with mock.patch.dict(self.amazon_echo.env,
+    with self._patch_config(self.amazon_echo.env,
                          {'play_always': {
                              'quite_time': [area]
                          }}):
@@ -514,11 +1515,11 @@ class TestTargetConditionBase(TestBase):
   def _test_played_quite_time(self, area):
     """Assert text was played on the target during quite time. """
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
+    })
 
-    with mock.patch.dict(self.amazon_echo.env,
+    with self._patch_config(self.amazon_echo.env,
                          {'play_always': {
                              'quite_time': [area]
                          }}):
@@ -540,8 +1541,7 @@ class TestTargetConditionBase(TestBase):
     for condition in tuple(conditions.keys()) + if_not['conditions']:
       condition_dict[condition] = tts.AmazonEcho.STATE_ON
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: condition_dict.get(
-        sensor, tts.AmazonEcho.STATE_OFF)
+    self._mock_states(condition_dict)
 
     target = self.amazon_echo.get_target(area)
     targets = self.amazon_echo.tts(text=self.text)
@@ -556,11 +1556,11 @@ class TestTargetConditionBase(TestBase):
   def _test_played_quite_time(self, area):
     """Assert text was played on the target during quite time. """
 
-    self.amazon_echo.get_state.side_effect = lambda sensor: {
+    self._mock_states({
         self.amazon_echo.quite_time: tts.AmazonEcho.STATE_ON
-    }.get(sensor, tts.AmazonEcho.STATE_OFF)
+    })
 
-    with mock.patch.dict(self.amazon_echo.env,
+    with self._patch_config(self.amazon_echo.env,
                          {'play_always': {
                              'quite_time': [area]
                          }}):
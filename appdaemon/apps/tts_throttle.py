@@ -0,0 +1,302 @@
+"""
+Throttling for tts.py events.
+
+Keeps the recently played entity events for the entity throttle time and
+evicts them once they expire or the store gets full. Composable rate limit
+policies bound the number of events per entity and overall, and the number of
+routed messages per area.
+
+"""
+
+__author__ = 'Arkadii Yakovets (ark@cho.red)'
+
+import heapq
+import time
+from collections import defaultdict, deque
+
+
+class ThrottleStore:
+  """Bounded store of throttled events with time based expiration."""
+
+  SIZE_DEFAULT = 1024
+
+  def __init__(self, throttle_times, size=SIZE_DEFAULT):
+    """
+      Parameters:
+        throttle_times: An entity ID to throttle time in seconds mapping.
+        size: The maximum number of stored events.
+      """
+    self.entries = {}
+    self.evicted = 0
+    self.expired = 0
+    self.expiry = []
+    self.size = size
+    self.throttle_times = throttle_times
+
+  def __len__(self):
+    return len(self.entries)
+
+  def expire(self, now):
+    """Remove events expired by `now`."""
+    entries = self.entries
+    expiry = self.expiry
+
+    while expiry and expiry[0][0] <= now:
+      expires_at, key = heapq.heappop(expiry)
+      if entries.get(key) == expires_at:
+        del entries[key]
+        self.expired += 1
+
+  def is_throttled(self, entity_id, text, now=None):
+    """
+      Return True if the `entity_id` event has to be throttled.
+
+      The event is stored for the entity throttle time if it's not throttled.
+      """
+    if now is None:
+      now = time.monotonic()
+    self.expire(now)
+
+    key = (entity_id, text)
+    if key in self.entries:
+      return True
+
+    expires_at = now + self.throttle_times[entity_id]
+    self.entries[key] = expires_at
+    heapq.heappush(self.expiry, (expires_at, key))
+
+    # Evict the events closest to expiration.
+    while len(self.entries) > self.size:
+      expires_at, key = heapq.heappop(self.expiry)
+      if self.entries.get(key) == expires_at:
+        del self.entries[key]
+        self.evicted += 1
+
+    return False
+
+  def discard(self, entity_id, text):
+    """Forget the stored `entity_id` event, e.g. if it wasn't played."""
+    # The expiry heap entry is skipped once it's popped.
+    self.entries.pop((entity_id, text), None)
+
+  def stats(self):
+    """Return the store stats."""
+    return {
+        'entries': len(self.entries),
+        'evicted': self.evicted,
+        'expired': self.expired,
+    }
+
+
+class RateLimitPolicy:
+  """
+  A base rate limit policy.
+
+  A policy maps an event to a set of keys (e.g. its entity or areas) and
+  limits the events per key. Checking and recording an event key is O(1).
+  A routed policy limits the areas of a routed message when it's dispatched
+  instead of the events.
+  """
+
+  NAME = None
+  ROUTED = False
+
+  def check(self, key, now):
+    """Return True if an event for the key is allowed at `now`."""
+    raise NotImplementedError
+
+  def get_keys(self, entity_id, areas):
+    """Return the keys of an `entity_id` event for `areas`."""
+    raise NotImplementedError
+
+  def record(self, key, now):
+    """Record an allowed event for the key."""
+    raise NotImplementedError
+
+
+class TokenBucket(RateLimitPolicy):
+  """Per entity token bucket."""
+
+  NAME = 'token_bucket'
+
+  def __init__(self, rate, burst=1, entities=None):
+    """
+      Parameters:
+        rate: The number of tokens added per second.
+        burst: The bucket capacity.
+        entities: A list of limited entity IDs, None for all entities.
+      """
+    self.burst = burst
+    self.entities = None if entities is None else frozenset(entities)
+    self.rate = rate
+    # An entity ID to (tokens, updated at) mapping.
+    self.buckets = {}
+
+  def _get_tokens(self, key, now):
+    try:
+      tokens, updated_at = self.buckets[key]
+    except KeyError:
+      return self.burst
+
+    return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+  def check(self, key, now):
+    return self._get_tokens(key, now) >= 1
+
+  # pylint: disable=unused-argument
+  def get_keys(self, entity_id, areas):
+    if not entity_id:
+      return ()
+
+    if self.entities is not None and entity_id not in self.entities:
+      return ()
+
+    return (entity_id,)
+
+  def record(self, key, now):
+    self.buckets[key] = (self._get_tokens(key, now) - 1, now)
+
+
+class SlidingWindow(RateLimitPolicy):
+  """Per area cap of routed messages within a sliding time window."""
+
+  NAME = 'sliding_window'
+  ROUTED = True
+
+  def __init__(self, limit, window=60, areas=None):
+    """
+      Parameters:
+        limit: The maximum number of events within the window.
+        window: The window length in seconds.
+        areas: A list of limited areas, None for all areas.
+      """
+    self.areas = None if areas is None else frozenset(areas)
+    self.limit = limit
+    self.window = window
+    # The last `limit` event times per key.
+    self.events = defaultdict(lambda: deque(maxlen=self.limit))
+
+  def check(self, key, now):
+    events = self.events.get(key)
+    return (not events or len(events) < self.limit or
+            now - events[0] >= self.window)
+
+  # pylint: disable=unused-argument
+  def get_keys(self, entity_id, areas):
+    if not areas:
+      return ()
+
+    if self.areas is None:
+      return areas
+
+    return [area for area in areas if area in self.areas]
+
+  def record(self, key, now):
+    self.events[key].append(now)
+
+
+class GlobalBudget(SlidingWindow):
+  """Cap of all events within a sliding time window."""
+
+  KEY = '*'
+  NAME = 'global_budget'
+  ROUTED = False
+
+  def __init__(self, limit, window=60):
+    super().__init__(limit, window)
+
+  # pylint: disable=unused-argument
+  def get_keys(self, entity_id, areas):
+    return (self.KEY,)
+
+
+class RateLimiter:
+  """A composition of rate limit policies, an event has to pass all of them."""
+
+  POLICIES = {
+      policy.NAME: policy
+      for policy in (GlobalBudget, SlidingWindow, TokenBucket)
+  }
+
+  def __init__(self, policies):
+    self.limited = defaultdict(int)
+    self.policies = tuple(policies)
+    self.event_policies = tuple(
+        policy for policy in self.policies if not policy.ROUTED)
+    self.routed_policies = tuple(
+        policy for policy in self.policies if policy.ROUTED)
+
+  @classmethod
+  def from_config(cls, config):
+    """
+      Return a rate limiter for the `rate_limit` config value.
+
+      Parameters:
+        config: A list of policy mappings with the `policy` name and the
+          policy parameters.
+      """
+    policies = []
+    for policy_config in config or ():
+      policy_config = dict(policy_config)
+      name = policy_config.pop('policy', None)
+      try:
+        policy_class = cls.POLICIES[name]
+      except KeyError as e:
+        raise ValueError(f'Unknown rate limit policy: {name}.') from e
+      policies.append(policy_class(**policy_config))
+
+    return cls(policies)
+
+  def limit(self, entity_id, now=None):
+    """
+      Check the event against the event policies, record it if it's allowed.
+
+      Parameters:
+        entity_id: The event entity ID.
+        now: The event time.
+
+      Returns:
+        str: The name of the policy limiting the event or None.
+      """
+    if now is None:
+      now = time.monotonic()
+
+    return self._limit(self.event_policies, entity_id, None, now)
+
+  def limit_areas(self, areas, now=None):
+    """
+      Check the routed message areas against the routed policies, record the
+      allowed ones.
+
+      Parameters:
+        areas: The message areas.
+        now: The dispatch time.
+
+      Returns:
+        list: The limited areas.
+      """
+    if not self.routed_policies:
+      return []
+
+    if now is None:
+      now = time.monotonic()
+
+    return [
+        area for area in areas
+        if self._limit(self.routed_policies, None, (area,), now)
+    ]
+
+  def _limit(self, policies, entity_id, areas, now):
+    """Return the name of the policy limiting the event or None."""
+    checked = []
+    for policy in policies:
+      for key in policy.get_keys(entity_id, areas):
+        if not policy.check(key, now):
+          self.limited[policy.NAME] += 1
+          return policy.NAME
+        checked.append((policy, key))
+
+    for policy, key in checked:
+      policy.record(key, now)
+
+    return None
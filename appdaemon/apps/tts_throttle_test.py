@@ -0,0 +1,175 @@
+"""Tests for tts_throttle.py"""
+
+__author__ = 'Ark (ark@cho.red)'
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+from collections import defaultdict
+
+import tts_throttle
+
+
+class TestThrottleStore(unittest.TestCase):
+  """Throttle store tests."""
+
+  DOOR = 'binary_sensor.front_door'
+  GATE = 'binary_sensor.garage_gate'
+  TEXT = 'Front door opened.'
+
+  def setUp(self):
+    throttle_times = defaultdict(lambda: 60)
+    throttle_times[self.DOOR] = 150
+    self.store = tts_throttle.ThrottleStore(throttle_times, size=3)
+
+  def test_throttled_within_throttle_time(self):
+    self.assertFalse(self.store.is_throttled(self.DOOR, self.TEXT, now=0))
+    self.assertTrue(self.store.is_throttled(self.DOOR, self.TEXT, now=149))
+    self.assertFalse(self.store.is_throttled(self.DOOR, 'Other', now=149))
+    self.assertFalse(self.store.is_throttled(self.GATE, self.TEXT, now=149))
+
+  def test_expiration(self):
+    self.assertFalse(self.store.is_throttled(self.DOOR, self.TEXT, now=0))
+    self.assertFalse(self.store.is_throttled(self.GATE, self.TEXT, now=0))
+
+    self.assertFalse(self.store.is_throttled(self.DOOR, self.TEXT, now=150))
+    self.assertEqual(self.store.stats(), {
+        'entries': 1,
+        'evicted': 0,
+        'expired': 2,
+    })
+    self.assertTrue(self.store.is_throttled(self.DOOR, self.TEXT, now=299))
+
+  def test_size(self):
+    for idx in range(5):
+      self.assertFalse(self.store.is_throttled(self.GATE, str(idx), now=idx))
+
+    self.assertEqual(len(self.store), 3)
+    self.assertEqual(self.store.evicted, 2)
+    # The oldest events were evicted.
+    self.assertFalse(self.store.is_throttled(self.GATE, '0', now=10))
+    self.assertTrue(self.store.is_throttled(self.GATE, '4', now=10))
+
+  def test_discard(self):
+    self.assertFalse(self.store.is_throttled(self.DOOR, self.TEXT, now=0))
+    self.store.discard(self.DOOR, self.TEXT)
+
+    self.assertFalse(self.store.is_throttled(self.DOOR, self.TEXT, now=1))
+    self.assertTrue(self.store.is_throttled(self.DOOR, self.TEXT, now=2))
+    self.store.expire(151)
+    self.assertEqual(len(self.store), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+  """Rate limit policies tests."""
+
+  DOOR = 'binary_sensor.front_door'
+  GATE = 'binary_sensor.garage_gate'
+
+  def _limit(self, limiter, times, entity_id=DOOR):
+    return [limiter.limit(entity_id, now=now) for now in times]
+
+  @staticmethod
+  def _limit_areas(limiter, times, areas):
+    return [limiter.limit_areas(areas, now=now) for now in times]
+
+  def test_token_bucket(self):
+    limiter = tts_throttle.RateLimiter(
+        [tts_throttle.TokenBucket(rate=0.1, burst=2)])
+
+    self.assertListEqual(self._limit(limiter, (0, 1, 2, 10, 11, 40, 41, 42)), [
+        None, None, 'token_bucket', None, 'token_bucket', None, None,
+        'token_bucket'
+    ])
+    self.assertIsNone(limiter.limit(self.GATE, now=42))
+    self.assertIsNone(limiter.limit(None, now=42))
+    self.assertEqual(limiter.limited['token_bucket'], 3)
+
+  def test_token_bucket_entities(self):
+    limiter = tts_throttle.RateLimiter(
+        [tts_throttle.TokenBucket(rate=0.1, entities=[self.DOOR])])
+
+    self.assertListEqual(self._limit(limiter, (0, 1)), [None, 'token_bucket'])
+    self.assertListEqual(self._limit(limiter, (0, 1), self.GATE), [None, None])
+
+  def test_sliding_window(self):
+    limiter = tts_throttle.RateLimiter(
+        [tts_throttle.SlidingWindow(limit=2, window=60)])
+
+    self.assertListEqual(
+        self._limit_areas(limiter, (0, 10, 20, 60, 65, 70), ['den']),
+        [[], [], ['den'], [], ['den'], []])
+    self.assertListEqual(limiter.limit_areas(['den', 'garage'], now=71),
+                         ['den'])
+    self.assertListEqual(limiter.limit_areas(['garage'], now=71), [])
+    self.assertEqual(limiter.limited['sliding_window'], 3)
+    # The events aren't limited per area.
+    self.assertIsNone(limiter.limit(self.DOOR, now=71))
+
+  def test_sliding_window_areas(self):
+    limiter = tts_throttle.RateLimiter(
+        [tts_throttle.SlidingWindow(limit=1, areas=['den'])])
+
+    self.assertListEqual(self._limit_areas(limiter, (0, 1), ['den']),
+                         [[], ['den']])
+    self.assertListEqual(self._limit_areas(limiter, (0, 1), ['garage']),
+                         [[], []])
+
+  def test_global_budget(self):
+    limiter = tts_throttle.RateLimiter([tts_throttle.GlobalBudget(limit=3)])
+
+    self.assertListEqual(self._limit(limiter, (0, 1, 2, 3, 60, 61)),
+                         [None, None, None, 'global_budget', None, None])
+    self.assertEqual(limiter.limit(None, now=61), 'global_budget')
+    # The routed messages aren't limited again.
+    self.assertListEqual(limiter.limit_areas(['den'], now=61), [])
+
+  def test_composition(self):
+    limiter = tts_throttle.RateLimiter([
+        tts_throttle.GlobalBudget(limit=2),
+        tts_throttle.TokenBucket(rate=0.01),
+    ])
+
+    self.assertListEqual(self._limit(limiter, (0, 1)), [None, 'token_bucket'])
+    # The limited event isn't counted by the global budget.
+    self.assertIsNone(limiter.limit(self.GATE, now=2))
+    self.assertEqual(limiter.limit(self.GATE, now=3), 'global_budget')
+
+  def test_from_config(self):
+    limiter = tts_throttle.RateLimiter.from_config([
+        {
+            'policy': 'token_bucket',
+            'rate': 0.5,
+            'burst': 3
+        },
+        {
+            'policy': 'sliding_window',
+            'limit': 5,
+            'window': 30
+        },
+        {
+            'policy': 'global_budget',
+            'limit': 10
+        },
+    ])
+
+    self.assertListEqual([type(policy) for policy in limiter.policies], [
+        tts_throttle.TokenBucket, tts_throttle.SlidingWindow,
+        tts_throttle.GlobalBudget
+    ])
+    self.assertEqual(limiter.policies[0].burst, 3)
+    self.assertEqual(limiter.policies[1].window, 30)
+    self.assertEqual(limiter.policies[2].limit, 10)
+
+    self.assertTupleEqual(
+        tts_throttle.RateLimiter.from_config(None).policies, ())
+
+  def test_from_config_unknown_policy(self):
+    with self.assertRaises(ValueError) as ctx:
+      tts_throttle.RateLimiter.from_config([{'policy': 'leaky_bucket'}])
+    self.assertIn('Unknown rate limit policy: leaky_bucket',
+                  str(ctx.exception))
+
+
+if __name__ == '__main__':
+  unittest.main()